@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# benchmark.py - Микробенчмарки горячих путей интерпретатора ESYBOT
+
+import sys
+import io
+import json
+import gc
+import time
+import argparse
+import platform
+import statistics
+import tempfile
+import contextlib
+from pathlib import Path
+
+from main import UnifiedBotInterpreter, compile_template, compile_condition, compile_python, coerce_literal
+
+# Размеры синтетических конфигураций: (обработчиков, переменных, строк в Python блоке)
+QUICK_SIZES = [(10, 10, 5), (100, 100, 20)]
+FULL_SIZES = QUICK_SIZES + [(1000, 1000, 50), (10000, 5000, 200)]
+
+FORMATS = ('simple', 'yaml')
+
+# Токен-заглушка: бот не запускается, сеть не нужна
+FAKE_TOKEN = '123456:BENCHMARK'
+
+
+def python_block(lines: int) -> list:
+    """Синтетический Python блок заданной длины"""
+    code = ['acc = 0']
+    for i in range(max(lines - 2, 0)):
+        code.append(f'acc = acc + {i} * 2 if acc < {i * 10} else acc - {i}')
+    code.append('result_value = acc')
+    return code
+
+
+def generate_yaml(handlers: int, variables: int, python_lines: int) -> str:
+    """Синтетическая YAML конфигурация"""
+    out = ['config:', f'  token: "{FAKE_TOKEN}"', '  name: "Benchmark"', '', 'variables:']
+    for i in range(variables):
+        out += [f'  - name: "var{i}"', f'    value: {i}']
+
+    out += ['', 'keyboards:']
+    for k in range(max(handlers // 10, 1)):
+        out += [f'  - name: "kb{k}"', '    type: "inline"', '    buttons:']
+        for b in range(4):
+            out += [f'      - text: "Button {b}"', f'        callback_data: "h{(k * 10 + b) % handlers}"']
+
+    out += ['', 'handlers:']
+    for i in range(handlers):
+        v = [f'var{(i + j) % variables}' for j in range(3)]
+        out += [f'  - name: "h{i}"', f'    condition: "${v[0]} >= 0"']
+        if i % 10 == 0:
+            out.append('    python: |')
+            out += [f'      {line}' for line in python_block(python_lines)]
+        out += [
+            '    effects:',
+            f'      - increment: "{v[0]}"',
+            '      - set:',
+            f'          variable: "{v[1]}"',
+            f'          value: "${v[2]}"',
+            '      - edit:',
+            f'          text: "Handler {i}: ${v[0]} / ${{{v[1]}}} / ${v[2]} for $first_name at $time"',
+            f'          keyboard: "kb{i // 10}"',
+        ]
+    return '\n'.join(out) + '\n'
+
+
+def generate_simple(handlers: int, variables: int, python_lines: int) -> str:
+    """Синтетическая SIMPLE конфигурация"""
+    out = ['[BOT]', f'token = {FAKE_TOKEN}', 'name = Benchmark', '', '[VARS]']
+    out += [f'var{i} = {i}' for i in range(variables)]
+
+    for i in range(handlers):
+        v = [f'var{(i + j) % variables}' for j in range(3)]
+        out += [
+            '', f'[h{i}]',
+            f'text = Handler {i}: ${v[0]} / ${{{v[1]}}} / ${v[2]} for $first_name at $time',
+            f'inc = {v[0]}',
+            f'set = {v[1]} = ${v[2]}',
+            f'if = ${v[0]} >= 0',
+            'else_text = Nope',
+        ]
+        out += [f'button{b} = Button {b} | h{(i + b + 1) % handlers}' for b in range(4)]
+        if i % 10 == 0:
+            out.append('python {')
+            out += [f'    {line}' for line in python_block(python_lines)]
+            out.append('}')
+    return '\n'.join(out) + '\n'
+
+
+def clear_compile_caches():
+    for cache in (compile_template, compile_condition, compile_python, coerce_literal):
+        cache.cache_clear()
+
+
+def measure(func, setup=None, repeat: int = 5, number: int = None) -> dict:
+    """Время одного вызова: лучшее и медиана по repeat сериям из number вызовов"""
+    def run_series(count: int) -> float:
+        total = 0.0
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for _ in range(count):
+                if setup is not None:
+                    setup()
+                start = time.perf_counter()
+                func()
+                total += time.perf_counter() - start
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return total
+
+    if number is None:
+        # Подбираем число вызовов так, чтобы серия длилась ~0.2 с
+        number = 1
+        while number < 1_000_000:
+            if run_series(number) >= 0.2:
+                break
+            number *= 10
+
+    timings = [run_series(number) / number for _ in range(repeat)]
+    return {
+        'min_us': round(min(timings) * 1e6, 3),
+        'median_us': round(statistics.median(timings) * 1e6, 3),
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    """Подавление вывода интерпретатора во время замеров"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def bench_config(fmt: str, handlers: int, variables: int, python_lines: int, repeat: int, workdir: Path) -> dict:
+    """Замеры всех фаз для одной синтетической конфигурации"""
+    content = (generate_simple if fmt == 'simple' else generate_yaml)(handlers, variables, python_lines)
+    config_file = workdir / f"bench-{handlers}-{variables}.{fmt}"
+    config_file.write_text(content, encoding='utf-8')
+    cache_dir = workdir / 'cache'
+
+    results = {}
+    context = {'user_id': 1, 'chat_id': 1, 'first_name': 'Bench', 'username': '@bench', 'text': ''}
+
+    with quiet():
+        # Разбор текста конфигурации
+        state = {}
+
+        def fresh():
+            state['interpreter'] = UnifiedBotInterpreter(cache_dir=False)
+
+        loader = '_load_simple_config' if fmt == 'simple' else '_load_yaml_config'
+        results['parse'] = measure(lambda: getattr(state['interpreter'], loader)(content), fresh, repeat, number=1)
+
+        # Компиляция шаблонов, условий и Python блоков (без LRU кэшей)
+        interpreter = UnifiedBotInterpreter(cache_dir=False)
+        interpreter.load_config(str(config_file))
+        results['compile'] = measure(interpreter.compile_handlers, clear_compile_caches, repeat, number=1)
+
+        # Полная загрузка без кэша и из кэша на диске
+        results['load_config'] = measure(
+            lambda: UnifiedBotInterpreter(cache_dir=False).load_config(str(config_file)),
+            clear_compile_caches, repeat, number=1
+        )
+        UnifiedBotInterpreter(cache_dir=cache_dir).load_config(str(config_file))
+        results['load_config_cached'] = measure(
+            lambda: UnifiedBotInterpreter(cache_dir=cache_dir).load_config(str(config_file)),
+            None, repeat, number=1
+        )
+
+        # Построение всех клавиатур
+        def reset_keyboards():
+            interpreter.keyboards = {}
+
+        results['build_keyboards'] = measure(interpreter.build_keyboards, reset_keyboards, repeat, number=1)
+
+        # Горячие пути обработки обновления
+        handler = interpreter.handlers_config['h0']
+        effect = next(e for e in handler['effects'] if 'send' in e or 'edit' in e)
+        text = (effect.get('send') or effect.get('edit'))['text']
+
+        results['replace_variables'] = measure(lambda: interpreter.replace_variables(text, context), None, repeat)
+        steps = interpreter.pipelines['h0'].effects
+        results['process_effects'] = measure(lambda: interpreter.run_steps(steps, context), None, repeat)
+        results['check_condition'] = measure(lambda: interpreter.check_condition(handler['condition'], context), None, repeat)
+        results['execute_python'] = measure(lambda: interpreter.execute_python(handler['python'], context), None, repeat)
+
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> int:
+    """Сравнение с базовыми результатами; возвращает число регрессий"""
+    regressions = 0
+    print(f"\n{'конфигурация':<28} {'фаза':<20} {'было, мкс':>12} {'стало, мкс':>12} {'x':>7}")
+    for config_name, phases in results['results'].items():
+        base_phases = baseline.get('results', {}).get(config_name, {})
+        for phase, current in phases.items():
+            base = base_phases.get(phase)
+            if not base or not base.get('min_us'):
+                continue
+            ratio = current['min_us'] / base['min_us']
+            mark = ''
+            if ratio > 1 + threshold:
+                mark = ' ⚠️'
+                regressions += 1
+            print(f"{config_name:<28} {phase:<20} {base['min_us']:>12.1f} {current['min_us']:>12.1f} {ratio:>7.2f}{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки интерпретатора ESYBOT (без сети и токена)")
+    parser.add_argument('--full', action='store_true', help="Все размеры, до 10k обработчиков и 5k переменных")
+    parser.add_argument('--format', choices=FORMATS, help="Только один формат конфигурации")
+    parser.add_argument('--repeat', type=int, default=5, help="Число серий замеров (по умолчанию 5)")
+    parser.add_argument('--output', default='bench_results.json', help="Файл для результатов JSON")
+    parser.add_argument('--baseline', help="JSON с базовыми результатами для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.10, help="Допустимое замедление (по умолчанию 10%%)")
+    args = parser.parse_args()
+
+    sizes = FULL_SIZES if args.full else QUICK_SIZES
+    formats = (args.format,) if args.format else FORMATS
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'repeat': args.repeat,
+        },
+        'results': {},
+    }
+
+    with tempfile.TemporaryDirectory(prefix='esybot-bench-') as workdir:
+        for fmt in formats:
+            for handlers, variables, python_lines in sizes:
+                name = f"{fmt}-{handlers}h-{variables}v-{python_lines}py"
+                print(f"⏱️  {name}...", flush=True)
+                phases = bench_config(fmt, handlers, variables, python_lines, args.repeat, Path(workdir))
+                results['results'][name] = phases
+                for phase, timing in phases.items():
+                    print(f"   {phase:<20} {timing['min_us']:>12.1f} мкс (медиана {timing['median_us']:.1f})")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Результаты сохранены: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n❌ Регрессий: {regressions}")
+            sys.exit(1)
+        print("\n✅ Регрессий нет")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,620 @@
+#!/usr/bin/env python3
+# loadtest.py - Нагрузочный прогон бота через локальную заглушку Telegram Bot API
+
+import re
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import itertools
+from collections import Counter, OrderedDict
+
+import aiohttp
+from aiohttp import web
+from aiogram.types import Update
+
+from main import UnifiedBotInterpreter
+
+# Токен-заглушка: все вызовы уходят на локальный сервер, Telegram не трогаем
+FAKE_TOKEN = '123456:LOADTEST'
+FAKE_BOT = {'id': 123456, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+
+UPDATE_KINDS = ('start', 'callback', 'text', 'photo')
+DEFAULT_MIX = 'start=1,callback=6,text=2,photo=1'
+
+# Исходящие вызовы, которые попадают в протокол для сравнения
+RECORDED_METHODS = ('sendMessage', 'editMessageText', 'answerCallbackQuery')
+
+# $date, $time и $datetime отличаются между прогонами - маскируются перед сравнением
+DEFAULT_MASKS = (r'\d{4}-\d{2}-\d{2}', r'\d{2}:\d{2}:\d{2}')
+
+# Лимиты отправки снимаются, чтобы мерить обработчики, а не очередь (см. --keep-limits)
+UNLIMITED_SEND = {'send_rate_global': 1e9, 'send_rate_chat': 1e9, 'send_burst_chat': 1e9}
+
+FIRST_USER_ID = 1000
+
+# Содержимое файлов, которые отдаёт заглушка (getFile и /file/bot...)
+FAKE_FILE_SIZE = 64 * 1024
+
+# Режим --webhook: адрес и секрет webhook сервера бота
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_SECRET = 'loadtest-secret'
+# Чат запроса с неверным секретом: его обновление не должно обработаться
+FOREIGN_CHAT_ID = 1
+# Пауза перед повтором запроса, на который бот ответил 503 (очереди заполнены)
+WEBHOOK_RETRY_DELAY = 0.05
+
+
+class FakeBotAPI:
+    """Локальная заглушка Bot API: отвечает на вызовы и записывает исходящие сообщения по чатам"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.calls = {}           # chat_id -> [[метод, текст, клавиатура], ...]
+        self.counts = Counter()
+        self.callback_chats = {}  # callback_query_id -> chat_id
+        self._message_ids = itertools.count(1)
+        self._runner = None
+
+    async def start(self) -> str:
+        """Запуск сервера, возвращает адрес для api_server"""
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_get('/file/bot{token}/{path:.+}', self.handle_file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        return f"http://{self.host}:{self.port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def record(self, method: str, chat_id, data: dict):
+        markup = data.get('reply_markup')
+        self.calls.setdefault(str(chat_id), []).append([
+            method,
+            data.get('text', ''),
+            json.loads(markup) if markup else None,
+        ])
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        data = dict(await request.post())
+        self.counts[method] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == 'getMe':
+            return web.json_response({'ok': True, 'result': FAKE_BOT})
+
+        if method == 'answerCallbackQuery':
+            self.record(method, self.callback_chats.get(data.get('callback_query_id')), data)
+            return web.json_response({'ok': True, 'result': True})
+
+        if method == 'getFile':
+            file_id = data['file_id']
+            return web.json_response({'ok': True, 'result': {
+                'file_id': file_id,
+                'file_unique_id': f"u-{file_id}",
+                'file_size': FAKE_FILE_SIZE,
+                'file_path': f"photos/{file_id}.jpg",
+            }})
+
+        if method in ('sendMessage', 'editMessageText'):
+            chat_id = int(data['chat_id'])
+            self.record(method, chat_id, data)
+            message_id = int(data['message_id']) if 'message_id' in data else next(self._message_ids)
+            return web.json_response({'ok': True, 'result': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': FAKE_BOT,
+                'text': data.get('text', ''),
+            }})
+
+        return web.json_response({'ok': True, 'result': True})
+
+    async def handle_file(self, request):
+        """Загрузка файла по file_path из getFile"""
+        self.counts['file'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.Response(body=bytes(FAKE_FILE_SIZE), content_type='application/octet-stream')
+
+
+def user_json(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"}
+
+
+def chat_json(chat_id: int) -> dict:
+    return {'id': chat_id, 'type': 'private', 'first_name': f"User{chat_id}"}
+
+
+def make_message(update_id: int, user_id: int, text: str = None, photo: bool = False) -> dict:
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': chat_json(user_id),
+        'from': user_json(user_id),
+    }
+    if photo:
+        message['photo'] = [{
+            'file_id': f"photo-{update_id}",
+            'file_unique_id': f"u{update_id}",
+            'file_size': FAKE_FILE_SIZE,
+            'width': 640,
+            'height': 480,
+        }]
+    else:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def make_callback(update_id: int, user_id: int, data: str) -> dict:
+    return {'update_id': update_id, 'callback_query': {
+        'id': f"cq-{update_id}",
+        'from': user_json(user_id),
+        'chat_instance': str(user_id),
+        'data': data,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': chat_json(user_id),
+            'from': FAKE_BOT,
+            'text': 'menu',
+        },
+    }}
+
+
+def update_kind(update: dict) -> str:
+    if 'callback_query' in update:
+        return 'callback'
+    message = update.get('message') or {}
+    if message.get('photo'):
+        return 'photo'
+    text = message.get('text') or ''
+    if text.startswith('/start'):
+        return 'start'
+    if text.startswith('/'):
+        return 'command'
+    return 'text' if text else 'other'
+
+
+def update_chat(update: dict):
+    if 'callback_query' in update:
+        query = update['callback_query']
+        message = query.get('message') or {}
+        return (message.get('chat') or {}).get('id', query['from']['id'])
+    message = update.get('message') or {}
+    return (message.get('chat') or {}).get('id')
+
+
+def parse_mix(mix: str) -> dict:
+    """"start=1,callback=6" -> {'start': 1.0, 'callback': 6.0}"""
+    weights = {}
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in UPDATE_KINDS:
+            raise Exception(f"Неизвестный тип обновления в --mix: {kind}")
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def synthetic_updates(interpreter: UnifiedBotInterpreter, count: int, users: int, mix: dict, seed: int) -> list:
+    """Синтетический поток обновлений по обработчикам и клавиатурам конфигурации"""
+    handlers = interpreter.handlers_config
+    # Нажатия: callback_data статических кнопок и имена обработчиков
+    callbacks = sorted(set(interpreter.callback_routes) | {
+        str(button['callback_data'])
+        for kb_config in interpreter.keyboards_config.values() if kb_config.get('type') == 'inline'
+        for button in kb_config.get('buttons', [])
+        if 'callback_data' in button and '$' not in str(button['callback_data'])
+    })
+    texts = sorted({
+        str(button.get('text', ''))
+        for kb_config in interpreter.keyboards_config.values() if kb_config.get('type') == 'reply'
+        for button in kb_config.get('buttons', [])
+    } - {''}) or ['hello']
+
+    available = {
+        'start': 'START' in handlers or 'start' in handlers,
+        'callback': bool(callbacks),
+        'text': 'MESSAGE' in handlers,
+        'photo': 'PHOTO' in handlers,
+    }
+    kinds = [kind for kind in mix if available[kind] and mix[kind] > 0]
+    if not kinds:
+        raise Exception("В конфигурации нет обработчиков для выбранных типов обновлений")
+    weights = [mix[kind] for kind in kinds]
+
+    rng = random.Random(seed)
+    updates = []
+    started = set()
+    for update_id in range(1, count + 1):
+        user_id = FIRST_USER_ID + rng.randrange(users)
+        kind = rng.choices(kinds, weights)[0]
+        # Первое обновление пользователя - /start, как в реальном диалоге
+        if available['start'] and user_id not in started:
+            kind = 'start'
+        started.add(user_id)
+
+        if kind == 'start':
+            updates.append(make_message(update_id, user_id, '/start'))
+        elif kind == 'callback':
+            updates.append(make_callback(update_id, user_id, rng.choice(callbacks)))
+        elif kind == 'text':
+            updates.append(make_message(update_id, user_id, rng.choice(texts)))
+        else:
+            updates.append(make_message(update_id, user_id, photo=True))
+    return updates
+
+
+def load_updates(path: str) -> list:
+    """Записанные обновления: JSON массив или JSON Lines в формате Telegram Update"""
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read().strip()
+    if content.startswith('['):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def percentile(values: list, q: float) -> float:
+    """Перцентиль по ближайшему рангу (values отсортированы)"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(q / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def latency_summary(samples: list) -> dict:
+    values = sorted(samples)
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+def group_by_chat(updates: list, api: FakeBotAPI) -> OrderedDict:
+    """Обновления по чатам в порядке поступления; заглушка узнаёт чаты нажатий"""
+    chats = OrderedDict()
+    for update in updates:
+        chats.setdefault(update_chat(update), []).append(update)
+        if 'callback_query' in update:
+            api.callback_chats[update['callback_query']['id']] = update_chat(update)
+    return chats
+
+
+def make_report(interpreter: UnifiedBotInterpreter, updates: list, chats: dict, api: FakeBotAPI,
+                duration: float, latencies: dict, errors: Counter, error_samples: list) -> dict:
+    all_samples = [sample for samples in latencies.values() for sample in samples]
+    return {
+        'updates': len(updates),
+        'chats': len(chats),
+        'duration_s': round(duration, 3),
+        'throughput_ups': round(len(updates) / duration, 1) if duration else 0.0,
+        'latency': {
+            'all': latency_summary(all_samples),
+            **{kind: latency_summary(samples) for kind, samples in sorted(latencies.items())},
+        },
+        'api_calls': dict(sorted(api.counts.items())),
+        'outbox': interpreter.outbox.metrics(),
+        'errors': dict(errors),
+        'error_samples': error_samples,
+        # Ошибки Python блоков и условий (обработчики их не пробрасывают)
+        'handler_errors': {
+            f"{name}/{source}": count for (name, source), count in sorted(interpreter.metrics.errors.items())
+        },
+    }
+
+
+async def replay(interpreter: UnifiedBotInterpreter, updates: list, api: FakeBotAPI, concurrency: int) -> dict:
+    """Прогон обновлений через настоящие обработчики: порядок внутри чата сохраняется, чаты параллельно"""
+    bot = interpreter.create_bot()
+    dp = interpreter.build_dispatcher()
+    interpreter.start_outbox()
+
+    chats = group_by_chat(updates, api)
+    latencies = {}
+    errors = Counter()
+    error_samples = []
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run_chat(chat_updates: list):
+        for raw in chat_updates:
+            update = Update.model_validate(raw, context={'bot': bot})
+            async with slots:
+                start = time.perf_counter()
+                try:
+                    await dp.feed_update(bot, update)
+                except Exception as e:
+                    errors[type(e).__name__] += 1
+                    if len(error_samples) < 10:
+                        error_samples.append({'update_id': raw.get('update_id'), 'error': f"{type(e).__name__}: {e}"})
+                latencies.setdefault(update_kind(raw), []).append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(run_chat(chat_updates) for chat_updates in chats.values()))
+        duration = time.perf_counter() - started
+    finally:
+        await interpreter.stop_outbox()
+        await bot.session.close()
+
+    return make_report(interpreter, updates, chats, api, duration, latencies, errors, error_samples)
+
+
+def free_port(host: str) -> int:
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+async def replay_webhook(interpreter: UnifiedBotInterpreter, updates: list, api: FakeBotAPI, concurrency: int) -> dict:
+    """Прогон через webhook сервер бота (run_webhook): обновления отправляются POST запросами с секретом
+    
+    Проверяются отказ запросу с неверным секретом, обработка в фоне после ответа
+    и завершение всех принятых обновлений при остановке: остановка запрашивается
+    сразу после последнего ответа сервера. Задержки - время ответа webhook.
+    """
+    host = '127.0.0.1'
+    port = free_port(host)
+    interpreter.bot_config.update(webhook_host=host, webhook_port=port, webhook_path=WEBHOOK_PATH,
+                                  webhook_secret=WEBHOOK_SECRET, webhook_url='')
+    url = f"http://{host}:{port}{WEBHOOK_PATH}"
+
+    bot = interpreter.create_bot()
+    dp = interpreter.build_dispatcher()
+    interpreter.start_outbox()
+    chats = group_by_chat(updates, api)
+
+    latencies = {}
+    errors = Counter()
+    error_samples = []
+    checks = {'rejected_503': 0}
+    slots = asyncio.Semaphore(concurrency)
+
+    async def post(http, raw: dict, secret: str) -> int:
+        async with http.post(url, json=raw, headers={'X-Telegram-Bot-Api-Secret-Token': secret}) as response:
+            await response.read()
+            return response.status
+
+    async def run_chat(http, chat_updates: list):
+        # Следующее обновление чата - после ответа на предыдущее, как у Telegram
+        for raw in chat_updates:
+            async with slots:
+                start = time.perf_counter()
+                while True:
+                    try:
+                        status = await post(http, raw, WEBHOOK_SECRET)
+                    except aiohttp.ClientError as e:
+                        status = f"{type(e).__name__}: {e}"
+                    if status != 503:
+                        break
+                    checks['rejected_503'] += 1
+                    await asyncio.sleep(WEBHOOK_RETRY_DELAY)
+                if status != 200:
+                    errors['webhook_status'] += 1
+                    if len(error_samples) < 10:
+                        error_samples.append({'update_id': raw.get('update_id'), 'error': f"webhook: {status}"})
+                latencies.setdefault(update_kind(raw), []).append(time.perf_counter() - start)
+
+    server = asyncio.create_task(interpreter.run_webhook(bot, dp))
+    try:
+        # Ожидание запуска сервера
+        while True:
+            if server.done():
+                server.result()
+                raise Exception("webhook сервер остановился при запуске")
+            try:
+                _, writer = await asyncio.open_connection(host, port)
+            except OSError:
+                await asyncio.sleep(0.01)
+            else:
+                writer.close()
+                break
+
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as http:
+            checks['wrong_secret_status'] = await post(http, make_message(0, FOREIGN_CHAT_ID, '/start'), 'wrong')
+            started = time.perf_counter()
+            await asyncio.gather(*(run_chat(http, chat_updates) for chat_updates in chats.values()))
+        # Принятые обновления ещё обрабатываются в фоне - остановка должна их дождаться
+        checks['inflight_at_stop'] = interpreter.inflight_updates
+        interpreter.stop()
+        await server
+        duration = time.perf_counter() - started
+        checks['inflight_after_stop'] = interpreter.inflight_updates
+    finally:
+        if not server.done():
+            server.cancel()
+        await interpreter.stop_outbox()
+        await bot.session.close()
+
+    if checks['wrong_secret_status'] != 401:
+        errors['wrong_secret_accepted'] += 1
+    if str(FOREIGN_CHAT_ID) in api.calls:
+        errors['wrong_secret_processed'] += 1
+    if checks['inflight_after_stop']:
+        errors['inflight_lost'] += checks['inflight_after_stop']
+
+    report = make_report(interpreter, updates, chats, api, duration, latencies, errors, error_samples)
+    report['webhook'] = checks
+    return report
+
+
+def normalize_transcript(transcript: dict, masks: list) -> dict:
+    def mask(text: str) -> str:
+        for pattern in masks:
+            text = pattern.sub('*', text)
+        return text
+
+    # Ответы на нажатия идут вне очереди чата: их порядок относительно сообщений
+    # зависит от времени, поэтому они сравниваются отдельно, в конце протокола чата
+    return {
+        chat_id: [[method, mask(text), markup] for method, text, markup in calls if method != 'answerCallbackQuery']
+        + [[method, mask(text), markup] for method, text, markup in calls if method == 'answerCallbackQuery']
+        for chat_id, calls in transcript.items()
+    }
+
+
+def diff_transcripts(expected: dict, actual: dict, masks: list, limit: int) -> dict:
+    """Сравнение протоколов по чатам: первое расхождение в каждом чате"""
+    expected = normalize_transcript(expected, masks)
+    actual = normalize_transcript(actual, masks)
+
+    samples = []
+    differing = 0
+    for chat_id in sorted(set(expected) | set(actual), key=str):
+        want = expected.get(chat_id, [])
+        got = actual.get(chat_id, [])
+        if want == got:
+            continue
+        differing += 1
+        if len(samples) >= limit:
+            continue
+        index = next((i for i, (a, b) in enumerate(zip(want, got)) if a != b), min(len(want), len(got)))
+        samples.append({
+            'chat_id': chat_id,
+            'index': index,
+            'expected': want[index] if index < len(want) else None,
+            'actual': got[index] if index < len(got) else None,
+            'expected_calls': len(want),
+            'actual_calls': len(got),
+        })
+
+    return {'chats': len(set(expected) | set(actual)), 'differing_chats': differing, 'samples': samples}
+
+
+def print_report(report: dict):
+    print(f"\n📊 Обновлений: {report['updates']} в {report['chats']} чатах за {report['duration_s']} с")
+    print(f"⚡ Пропускная способность: {report['throughput_ups']} обновлений/с")
+    print(f"\n{'тип':<10} {'кол-во':>8} {'p50, мс':>10} {'p95, мс':>10} {'p99, мс':>10} {'max, мс':>10}")
+    for kind, stats in report['latency'].items():
+        print(f"{kind:<10} {stats['count']:>8} {stats['p50_ms']:>10.2f} {stats['p95_ms']:>10.2f} "
+              f"{stats['p99_ms']:>10.2f} {stats['max_ms']:>10.2f}")
+    print(f"\n📨 Вызовы Bot API: {report['api_calls']}")
+    webhook = report.get('webhook')
+    if webhook is not None:
+        print(f"🌐 Webhook: неверный секрет - {webhook['wrong_secret_status']}, повторов после 503 - {webhook['rejected_503']}, "
+              f"в обработке при остановке - {webhook['inflight_at_stop']}, после остановки - {webhook['inflight_after_stop']}")
+    if report['errors']:
+        print(f"❌ Ошибки обработчиков: {report['errors']}")
+        for sample in report['error_samples']:
+            print(f"   update {sample['update_id']}: {sample['error']}")
+    if report['handler_errors']:
+        print(f"❌ Ошибки Python блоков и условий: {report['handler_errors']}")
+
+    diff = report.get('diff')
+    if diff is not None:
+        if not diff['differing_chats']:
+            print(f"✅ Ответы совпадают с эталоном ({diff['chats']} чатов)")
+        else:
+            print(f"❌ Расхождения с эталоном: {diff['differing_chats']} из {diff['chats']} чатов")
+            for sample in diff['samples']:
+                print(f"   чат {sample['chat_id']}, вызов #{sample['index']}:")
+                print(f"      ожидалось: {sample['expected']}")
+                print(f"      получено:  {sample['actual']}")
+
+
+async def run_loadtest(args) -> int:
+    interpreter = UnifiedBotInterpreter(cache_dir=False if args.no_cache else None)
+    if not interpreter.load_config(args.config_file):
+        print("❌ Не удалось загрузить конфигурацию")
+        return 1
+
+    if args.updates:
+        updates = load_updates(args.updates)
+    else:
+        updates = synthetic_updates(interpreter, args.count, args.users, parse_mix(args.mix), args.seed)
+    if args.save_updates:
+        with open(args.save_updates, 'w', encoding='utf-8') as f:
+            for update in updates:
+                f.write(json.dumps(update, ensure_ascii=False) + '\n')
+        print(f"💾 Поток обновлений сохранён: {args.save_updates}")
+
+    api = FakeBotAPI(latency=args.api_latency / 1000)
+    interpreter.bot_config.update(token=FAKE_TOKEN, api_server=await api.start(), hot_reload=False)
+    if not args.keep_limits:
+        interpreter.bot_config.update(UNLIMITED_SEND)
+
+    print(f"🚀 Прогон {len(updates)} обновлений{' через webhook' if args.webhook else ''}, "
+          f"параллельно до {args.concurrency}, Bot API: {interpreter.bot_config['api_server']}")
+    interpreter.start_python_executor()
+    try:
+        report = await (replay_webhook if args.webhook else replay)(interpreter, updates, api, args.concurrency)
+    finally:
+        interpreter.stop_python_executor()
+        await api.stop()
+
+    report['meta'] = {
+        'config': args.config_file,
+        'source': args.updates or f"synthetic (seed {args.seed}, users {args.users}, mix {args.mix})",
+        'concurrency': args.concurrency,
+        'webhook': args.webhook,
+        'api_latency_ms': args.api_latency,
+        'keep_limits': args.keep_limits,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+    if args.record:
+        with open(args.record, 'w', encoding='utf-8') as f:
+            json.dump(api.calls, f, ensure_ascii=False, indent=1)
+        print(f"💾 Протокол ответов сохранён: {args.record}")
+
+    if args.expect:
+        with open(args.expect, 'r', encoding='utf-8') as f:
+            expected = json.load(f)
+        masks = [re.compile(pattern) for pattern in DEFAULT_MASKS + tuple(args.mask)]
+        report['diff'] = diff_transcripts(expected, api.calls, masks, args.show_diffs)
+
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Отчёт сохранён: {args.output}")
+
+    failed = bool(report['errors']) or bool(report['handler_errors']) or bool(report.get('diff', {}).get('differing_chats'))
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон ESYBOT на локальной заглушке Bot API (без Telegram)")
+    parser.add_argument('config_file', help="Файл конфигурации бота")
+    parser.add_argument('--updates', help="Записанные обновления (JSON или JSON Lines); по умолчанию синтетические")
+    parser.add_argument('--count', type=int, default=1000, help="Число синтетических обновлений (по умолчанию 1000)")
+    parser.add_argument('--users', type=int, default=100, help="Число синтетических пользователей (по умолчанию 100)")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"Доли типов обновлений (по умолчанию {DEFAULT_MIX})")
+    parser.add_argument('--seed', type=int, default=1, help="Зерно генератора (одинаковый поток между прогонами)")
+    parser.add_argument('--save-updates', help="Сохранить поток обновлений в JSON Lines")
+    parser.add_argument('--concurrency', type=int, default=64, help="Обновлений в обработке одновременно (по умолчанию 64)")
+    parser.add_argument('--api-latency', type=float, default=0, help="Задержка ответа заглушки Bot API, мс")
+    parser.add_argument('--keep-limits', action='store_true', help="Не снимать лимиты отправки из конфигурации")
+    parser.add_argument('--webhook', action='store_true', help="Отправлять обновления POST запросами в webhook сервер бота")
+    parser.add_argument('--record', help="Сохранить протокол ответов бота (эталон для --expect)")
+    parser.add_argument('--expect', help="Сравнить ответы с сохранённым протоколом")
+    parser.add_argument('--mask', action='append', default=[], help="Регулярное выражение, маскируемое перед сравнением")
+    parser.add_argument('--show-diffs', type=int, default=5, help="Сколько расхождений показать (по умолчанию 5)")
+    parser.add_argument('--output', help="Файл для отчёта JSON")
+    parser.add_argument('--no-cache', action='store_true', help="Не использовать кэш конфигурации")
+    args = parser.parse_args()
+
+    sys.exit(asyncio.run(run_loadtest(args)))
+
+
+if __name__ == "__main__":
+    main()
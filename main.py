@@ -6,15 +6,51 @@ import sys
 import os
 import datetime
 import re
+import ast
+import json
+import copy
+import time
+import types
+import heapq
+import signal
+import threading
+import io
+import argparse
+import hashlib
+import marshal
+import pickle
+import textwrap
+import functools
+import bisect
+import queue
+import atexit
+import logging
+import logging.handlers
+import contextlib
+import zlib
+import struct
+import multiprocessing
+import multiprocessing.managers
+import concurrent.futures
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping, MutableSequence, MutableSet
 from typing import Dict, Any, Union
 from pathlib import Path
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
 # Импорты для Telegram
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, CallbackQuery, ContentType
+from aiogram.types import Message, CallbackQuery, ContentType, Update
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest, TelegramForbiddenError
 
 # Опциональный импорт YAML
 try:
@@ -24,21 +60,2080 @@ except ImportError:
     YAML_AVAILABLE = False
     print("⚠️  YAML не установлен. Установите: pip install pyyaml")
 
+# Системные переменные из контекста обновления и их значения по умолчанию
+CONTEXT_VARIABLES = {
+    'user_id': 0,
+    'chat_id': 0,
+    'first_name': '',
+    'username': '',
+    'text': '',
+    'data': '',
+    'callback_args': '',
+    'match': '',
+    'match_args': '',
+    'file_id': '',
+    'file_unique_id': '',
+    'file_name': '',
+    'file_size': 0,
+    'mime_type': '',
+    'file_path': '',
+    'file_cached': False,
+}
+
+# Системные переменные даты, вычисляются только если встречаются в шаблоне
+DATE_VARIABLES = {
+    'date': '%Y-%m-%d',
+    'time': '%H:%M:%S',
+    'datetime': '%Y-%m-%d %H:%M:%S',
+}
+
+# Плейсхолдеры ${name} и $name
+TEMPLATE_PATTERN = re.compile(r'\$\{([^{}]+)\}|\$([A-Za-z_][A-Za-z0-9_]*)')
+
+# Зарезервированные имена обработчиков (не callback кнопки)
+RESERVED_HANDLERS = frozenset(['START', 'start', 'MESSAGE', 'PHOTO', 'DOCUMENT', 'VOICE'])
+
+# Разделитель параметров в callback_data: "item:42" -> обработчик "item"
+CALLBACK_SEPARATOR = ':'
+
+# Виды текстовых триггеров обработчиков (поле triggers)
+TRIGGER_KINDS = ('exact', 'keyword', 'regex')
+
+# Регулярные выражения триггеров, которые нельзя обернуть в именованную группу:
+# с нумерованной обратной ссылкой (\1..\9 - обёртка сдвинула бы номера) и с
+# глобальными флагами в начале ((?i)^hi - флаги допускаются только в начале выражения)
+UNWRAPPED_REGEX = re.compile(r'\\[1-9]|^\(\?[aiLmsux]+\)')
+
+# Поля кнопок, в которых допускаются переменные
+KEYBOARD_TEMPLATE_FIELDS = ('text', 'callback_data', 'url')
+
+# Медиа обработчики по типу сообщения и расширения сохраняемых файлов без имени
+MEDIA_HANDLERS = {ContentType.PHOTO: 'PHOTO', ContentType.DOCUMENT: 'DOCUMENT', ContentType.VOICE: 'VOICE'}
+MEDIA_SUFFIXES = {ContentType.PHOTO: '.jpg', ContentType.VOICE: '.ogg'}
+
+# Сколько загруженных файлов помнить для повторного использования (media_dedup)
+MEDIA_CACHE_SIZE = 10000
+
+# Пакетов обновлений в очереди на рабочий процесс (workers): дальше приём обновлений ждёт
+SHARD_QUEUE_SIZE = 64
+
+# Опрос блокировки переменных в общем состоянии (workers), секунды
+SHARED_LOCK_POLL = 0.005
+
+# Рассылки: одновременных отправок, получателей между сохранениями прогресса,
+# попыток отправки при сбоях сети или сервера
+BROADCAST_CONCURRENCY = 8
+BROADCAST_CHECKPOINT_EVERY = 100
+BROADCAST_RETRIES = 3
+
+# Bad Request из-за самого сообщения, а не получателя: такая рассылка прерывается
+BROADCAST_MESSAGE_ERRORS = ("can't parse", 'message is too long', 'message text is empty', 'button_')
+
+# Сколько отрисованных динамических клавиатур хранить
+KEYBOARD_CACHE_SIZE = 4096
+
+# Сколько ответов чистых обработчиков хранить по умолчанию (config.memo_size, 0 - выключено)
+MEMO_SIZE = 10000
+
+# Маркер отсутствующей переменной
+MISSING = object()
+
+# Типы, которые Python блок может изменить на месте (isinstance: Counter, defaultdict и
+# другие подклассы тоже - их изменения на месте должны записываться)
+MUTABLE_TYPES = (list, dict, set, bytearray, deque, MutableMapping, MutableSequence, MutableSet)
+
+
+class Template:
+    """Скомпилированный шаблон: список литералов и плейсхолдеров"""
+
+    __slots__ = ('source', 'segments', 'names')
+
+    def __init__(self, source: str):
+        self.source = source
+        segments = []
+        position = 0
+        for match in TEMPLATE_PATTERN.finditer(source):
+            if match.start() > position:
+                segments.append(source[position:match.start()])
+            segments.append((match.group(1) or match.group(2), match.group(0)))
+            position = match.end()
+        if position < len(source):
+            segments.append(source[position:])
+
+        self.segments = tuple(segments)
+        self.names = frozenset(segment[0] for segment in segments if isinstance(segment, tuple))
+
+    def render(self, lookup) -> str:
+        """Однопроходная подстановка: lookup(name) возвращает значение или MISSING"""
+        if not self.names:
+            return self.source
+
+        parts = []
+        for segment in self.segments:
+            if isinstance(segment, str):
+                parts.append(segment)
+            else:
+                value = lookup(segment[0])
+                parts.append(segment[1] if value is MISSING else str(value))
+        return ''.join(parts)
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_template(text: str) -> Template:
+    """Компиляция шаблона (с кэшем для текстов, не известных при загрузке)"""
+    return Template(text)
+
+
+# Строковые литералы и плейсхолдеры в условиях
+CONDITION_TOKEN_PATTERN = re.compile(
+    r"""('(?:[^'\\\n]|\\.)*'|"(?:[^"\\\n]|\\.)*")"""
+    r'|\$\{([^{}]+)\}|\$([A-Za-z_][A-Za-z0-9_]*)'
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def coerce_literal(value: str) -> Any:
+    """Строка как Python литерал (совместимость со старой подстановкой текста)"""
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+        return value
+
+
+class Condition:
+    """Скомпилированное условие: плейсхолдеры становятся именами в пространстве имён"""
+
+    __slots__ = ('source', 'code', 'bindings', 'names')
+
+    def __init__(self, source: str):
+        self.source = source
+        bindings = []
+
+        def bind(name: str, raw: str, quoted: bool) -> str:
+            identifier = f"_{'s' if quoted else 'v'}{len(bindings)}"
+            bindings.append((identifier, name, raw, quoted))
+            return identifier
+
+        def replace(match) -> str:
+            literal = match.group(1)
+            if literal is None:
+                return bind(match.group(2) or match.group(3), match.group(0), False)
+            if '$' not in literal:
+                return literal
+
+            # Плейсхолдеры внутри кавычек подставляются как строки
+            quote, body = literal[0], literal[1:-1]
+            pieces = []
+            position = 0
+            for placeholder in TEMPLATE_PATTERN.finditer(body):
+                if placeholder.start() > position:
+                    pieces.append(quote + body[position:placeholder.start()] + quote)
+                pieces.append(bind(placeholder.group(1) or placeholder.group(2), placeholder.group(0), True))
+                position = placeholder.end()
+            if position < len(body):
+                pieces.append(quote + body[position:] + quote)
+            return '(' + ' + '.join(pieces) + ')' if pieces else literal
+
+        expression = CONDITION_TOKEN_PATTERN.sub(replace, source.strip())
+        self.code = compile(expression, '<condition>', 'eval')
+        self.bindings = tuple(bindings)
+        self.names = frozenset(binding[1] for binding in bindings)
+
+    def namespace(self, lookup) -> dict:
+        """Пространство имён для вычисления условия"""
+        namespace = {}
+        for identifier, name, raw, quoted in self.bindings:
+            value = lookup(name)
+            if quoted:
+                namespace[identifier] = raw if value is MISSING else str(value)
+            elif value is not MISSING:
+                namespace[identifier] = coerce_literal(value) if isinstance(value, str) else value
+        return namespace
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_condition(source: str) -> Condition:
+    """Компиляция условия (с кэшем для динамических условий)"""
+    return Condition(source)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_python(source: str):
+    """Компиляция Python блока (с кэшем для динамического кода)"""
+    return compile(source, '<python>', 'exec')
+
+
+@functools.lru_cache(maxsize=1024)
+def python_writes(source: str) -> tuple:
+    """Имена, которые Python блок присваивает или меняет на месте (x = ..., x += ..., x.append(), x[k] = ...)"""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return ()
+    
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.Attribute, ast.Subscript)) and isinstance(node.value, ast.Name):
+            names.add(node.value.id)
+    return tuple(sorted(name for name in names if not name.startswith('_') and name not in CONTEXT_VARIABLES))
+
+
+def build_keyboard_markup(kb_config: dict, lookup=None):
+    """Построение одной клавиатуры (lookup - подстановка переменных в кнопки)"""
+    def field(button: dict, key: str, default: str = '') -> str:
+        value = str(button.get(key, default))
+        return compile_template(value).render(lookup) if lookup is not None else value
+    
+    if kb_config.get('type') == 'inline':
+        builder = InlineKeyboardBuilder()
+        for button in kb_config.get('buttons', []):
+            if 'url' in button:
+                builder.button(text=field(button, 'text'), url=field(button, 'url'))
+            else:
+                builder.button(text=field(button, 'text'), callback_data=field(button, 'callback_data', 'unknown'))
+        return builder.as_markup()
+    
+    elif kb_config.get('type') == 'reply':
+        builder = ReplyKeyboardBuilder()
+        for button in kb_config.get('buttons', []):
+            builder.button(text=field(button, 'text'))
+        return builder.as_markup(
+            resize_keyboard=kb_config.get('resize', True),
+            one_time_keyboard=kb_config.get('one_time', False)
+        )
+    
+    return None
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_static_keyboard(kb_key: str):
+    """Статическая клавиатура по каноническому JSON конфигурации - одна на все боты процесса"""
+    return build_keyboard_markup(json.loads(kb_key))
+
+
+def collect_text_triggers(handlers_config: dict) -> tuple:
+    """Текстовые триггеры обработчиков в порядке конфигурации: ((обработчик, вид, шаблон), ...)
+
+    triggers: ["Привет", {keyword: [погода, прогноз]}, {regex: "^курс (\\w+)$"}]
+    Строка без вида - точное совпадение; значение вида - строка или список.
+    """
+    triggers = []
+    for handler_name, handler_config in handlers_config.items():
+        if handler_name in RESERVED_HANDLERS:
+            continue
+        for trigger in handler_config.get('triggers') or ():
+            if not isinstance(trigger, dict):
+                trigger = {'exact': trigger}
+            for kind, patterns in trigger.items():
+                if kind not in TRIGGER_KINDS:
+                    print(f"⚠️  Неизвестный вид триггера '{kind}' в обработчике {handler_name}")
+                    continue
+                for pattern in patterns if isinstance(patterns, list) else [patterns]:
+                    if str(pattern).strip():
+                        triggers.append((handler_name, kind, str(pattern)))
+    return tuple(triggers)
+
+
+def keyword_trie_pattern(words) -> str:
+    """Регулярное выражение по префиксному дереву слов: "cat", "cats", "car" -> ca(?:ts?|r)
+
+    В каждой позиции текста проверяются только ветки по следующему символу,
+    поэтому время поиска почти не зависит от числа слов.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def emit(node: dict) -> str:
+        branches = [re.escape(char) + emit(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        if '' in node:
+            # Слово может закончиться здесь: сначала пробуем более длинное
+            return f"(?:{body})?" if len(branches) > 1 or len(body) > 1 else f"{body}?"
+        return body
+
+    return emit(trie)
+
+
+class TextMatcher:
+    """Все текстовые триггеры бота в трёх структурах
+
+    exact - словарь текст -> обработчик, keywords - одно регулярное выражение по
+    префиксному дереву ключевых слов, regexes - регулярные выражения триггеров,
+    объединённые в одну альтернативу (обработчик определяется по группе).
+    Сравнение без учёта регистра; при нескольких совпадениях побеждает точное,
+    затем ключевое слово, затем регулярное выражение, а внутри вида - то, что
+    раньше в тексте (для одинаковой позиции - раньше в конфигурации).
+    """
+    __slots__ = ('exact', 'keywords', 'keyword_pattern', 'regexes', 'size')
+
+    def __init__(self, triggers: tuple):
+        self.exact = {}
+        self.keywords = {}
+        self.keyword_pattern = None
+        self.regexes = []
+        self.size = len(triggers)
+
+        regex_parts = []
+        for handler_name, kind, pattern in triggers:
+            if kind == 'regex':
+                # Проверяем в том виде, в каком выражение попадёт в матчер:
+                # выражения без обратных ссылок и глобальных флагов оборачиваются в именованную группу
+                try:
+                    groups = re.compile(pattern, re.IGNORECASE).groups
+                    if not UNWRAPPED_REGEX.search(pattern):
+                        re.compile(f"(?P<_t0>{pattern})", re.IGNORECASE)
+                except re.error as e:
+                    print(f"❌ Ошибка в регулярном выражении триггера {handler_name}: {e}")
+                    continue
+                regex_parts.append((handler_name, pattern, groups))
+                continue
+            table = self.exact if kind == 'exact' else self.keywords
+            key = pattern.strip().casefold()
+            owner = table.setdefault(key, handler_name)
+            if owner != handler_name:
+                print(f"⚠️  Триггер '{pattern}' обработчика {handler_name} уже занят обработчиком {owner}")
+
+        if self.keywords:
+            self.keyword_pattern = re.compile(rf"(?<!\w)(?:{keyword_trie_pattern(self.keywords)})(?!\w)")
+        if regex_parts:
+            self.regexes = self._combine_regexes(regex_parts)
+
+    @staticmethod
+    def _combine_regexes(parts: list) -> list:
+        """Одна альтернатива (?P<_t0>...)|(?P<_t1>...) -> [(шаблон, {группа: (обработчик, число групп)})]
+
+        Выражения с нумерованными обратными ссылками и глобальными флагами не
+        оборачиваются (см. UNWRAPPED_REGEX) и проверяются отдельно: маршрут такого шаблона
+        хранится под ключом None. Если объединить выражения не удалось
+        (например, повторяются имена групп), каждое проверяется отдельно.
+        """
+        def chunk(items):
+            routes = {f"_t{i}": (handler_name, groups) for i, (handler_name, _, groups) in enumerate(items)}
+            source = '|'.join(f"(?P<_t{i}>{pattern})" for i, (_, pattern, _) in enumerate(items))
+            return re.compile(source, re.IGNORECASE), routes
+
+        combined = [part for part in parts if not UNWRAPPED_REGEX.search(part[1])]
+        chunks = [(re.compile(pattern, re.IGNORECASE), {None: (handler_name, groups)})
+                  for handler_name, pattern, groups in parts if UNWRAPPED_REGEX.search(pattern)]
+        try:
+            return ([chunk(combined)] if combined else []) + chunks
+        except re.error:
+            return [chunk([part]) for part in combined] + chunks
+
+    def match(self, text: str):
+        """(обработчик, совпавший фрагмент, параметры) или None
+
+        Параметры: для точного совпадения и ключевого слова - текст после
+        фрагмента, для регулярного выражения - группы через ':'.
+        """
+        folded = text.casefold()
+        handler_name = self.exact.get(folded.strip())
+        if handler_name is not None:
+            return handler_name, text.strip(), ''
+
+        if self.keyword_pattern is not None:
+            found = self.keyword_pattern.search(folded)
+            if found is not None:
+                # casefold может менять длину строки ("ß" -> "ss"): тогда фрагмент из свёрнутого текста
+                source = text if len(folded) == len(text) else folded
+                return self.keywords[found.group()], source[found.start():found.end()], source[found.end():].strip()
+
+        best = None
+        for pattern, routes in self.regexes:
+            found = pattern.search(text)
+            if found is not None and (best is None or found.start() < best[0].start()):
+                best = (found, routes)
+        if best is not None:
+            found, routes = best
+            if None in routes:
+                handler_name, groups = routes[None]
+                start = 0
+            else:
+                handler_name, groups = routes[found.lastgroup]
+                # Группы выражения идут сразу за группой-обёрткой
+                start = found.re.groupindex[found.lastgroup]
+            args = found.groups()[start:start + groups]
+            return handler_name, found.group(), CALLBACK_SEPARATOR.join(arg or '' for arg in args)
+        return None
+
+
+@functools.lru_cache(maxsize=64)
+def compile_text_matcher(triggers: tuple):
+    """Матчер по набору триггеров - общий для перезагрузок и ботов процесса с теми же триггерами"""
+    return TextMatcher(triggers) if triggers else None
+
+
+class HandlerPipeline:
+    """Скомпилированный обработчик: Python блок -> условие -> шаги эффектов
+    
+    effects и else_effects - кортежи функций step(context, result) с заранее
+    привязанными шаблонами, именами переменных и клавиатур; writes - переменные,
+    которые меняют эффекты (для блокировок планировщика). Для чистого обработчика
+    (без Python блока и изменения переменных) reads - имена, которые читают его
+    шаблоны и условие, keyboards - используемые клавиатуры; иначе reads = None.
+    """
+    __slots__ = ('name', 'python', 'condition', 'effects', 'else_effects', 'writes', 'reads', 'keyboards', 'debug')
+    
+    def __init__(self, name: str, python: str, condition, effects: tuple, else_effects: tuple,
+                 writes: tuple, reads, keyboards: tuple, debug: bool):
+        self.name = name
+        self.python = python
+        self.condition = condition
+        self.effects = effects
+        self.else_effects = else_effects
+        self.writes = writes
+        self.reads = reads
+        self.keyboards = keyboards
+        self.debug = debug
+
+
+# Режимы выполнения Python блоков
+PYTHON_EXECUTORS = ('inline', 'thread', 'process')
+
+# Значения, которые не возвращаются из рабочих процессов/потоков
+UNMERGEABLE_TYPES = (types.ModuleType, types.FunctionType, types.BuiltinFunctionType, type)
+
+
+class PythonLimitExceeded(Exception):
+    """Превышен лимит времени или CPU при выполнении Python блока"""
+
+
+def _raise_python_limit(signum, frame):
+    raise PythonLimitExceeded("превышен лимит времени выполнения")
+
+
+def init_python_worker(memory_limit_mb: int = 0):
+    """Инициализация рабочего процесса: ограничение памяти"""
+    if memory_limit_mb and resource is not None:
+        limit = int(memory_limit_mb) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def run_python_snippet(source: str, namespace: dict, timeout: float = 0, cpu_limit: float = 0) -> dict:
+    """Выполнение Python блока в рабочем потоке/процессе
+
+    Возвращает только изменённые переменные (изменяемые контейнеры - всегда).
+    Лимиты времени и CPU через сигналы работают только в главном потоке,
+    то есть в режиме process. В режиме thread поток остановить нельзя: по
+    таймауту результат блока просто не применяется.
+    """
+    use_timers = bool(timeout or cpu_limit) and hasattr(signal, 'setitimer') and \
+        threading.current_thread() is threading.main_thread()
+    if use_timers:
+        signal.signal(signal.SIGALRM, _raise_python_limit)
+        signal.signal(signal.SIGVTALRM, _raise_python_limit)
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        if cpu_limit:
+            signal.setitimer(signal.ITIMER_VIRTUAL, cpu_limit)
+
+    before = dict(namespace)
+    try:
+        exec(compile_python(source), {}, namespace)
+    finally:
+        if use_timers:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+
+    return {
+        key: value for key, value in namespace.items()
+        if not isinstance(value, UNMERGEABLE_TYPES)
+        and (key not in before or value is not before[key] or isinstance(value, (list, dict, set)))
+    }
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько ждать до появления токена"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundJob:
+    """Отложенный вызов Bot API и ожидающие его результата"""
+
+    __slots__ = ('chat_id', 'call', 'futures', 'coalesce_key', 'priority', 'background')
+
+    def __init__(self, chat_id, call, future, coalesce_key=None, priority=False, background=False):
+        self.chat_id = chat_id
+        self.call = call
+        self.futures = [future]
+        self.coalesce_key = coalesce_key
+        self.priority = priority
+        self.background = background
+
+
+class OutboundChat:
+    """Очередь исходящих вызовов одного чата"""
+
+    __slots__ = ('bucket', 'jobs', 'busy', 'scheduled', 'blocked_until')
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.jobs = deque()
+        self.busy = False
+        self.scheduled = False
+        self.blocked_until = 0.0
+
+
+class OutboundQueue:
+    """Планировщик исходящих вызовов Bot API с учётом flood-лимитов Telegram
+
+    - глобальное ведро токенов и ведро на каждый чат;
+    - вызовы одного чата выполняются строго по очереди;
+    - ответы на callback (priority) идут вне очереди и без лимита чата;
+    - фоновые вызовы (background, рассылки) - только когда нет готовых обычных;
+    - несколько ожидающих edit_text одного сообщения схлопываются в последний;
+    - при 429 (TelegramRetryAfter) чат приостанавливается на retry_after,
+      для фонового вызова - все фоновые вызовы.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 concurrency: int = 16, max_idle_chats: int = 10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.max_idle_chats = max_idle_chats
+
+        self._chats = {}            # chat_id -> OutboundChat
+        self._ready = []            # куча (время готовности, порядковый номер, chat_id)
+        self._priority = deque()    # ответы на callback
+        self._background = deque()  # фоновые вызовы (рассылки)
+        self._pending_edits = {}    # (chat_id, message_id) -> OutboundJob
+        self._background_blocked_until = 0.0
+        self._sequence = 0
+        self._wakeup = None
+        self._slots = None
+        self._worker = None
+        self._tasks = set()
+        self._closing = False
+
+        # Метрики
+        self.depth = 0
+        self.max_depth = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.retries = 0
+
+    def start(self):
+        if self._worker is None:
+            self._closing = False
+            self._wakeup = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10):
+        """Остановка: дожидаемся отправки очереди не дольше timeout"""
+        if self._worker is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._worker), timeout)
+            if self._tasks:
+                await asyncio.wait(set(self._tasks), timeout=timeout)
+        except asyncio.TimeoutError:
+            self._worker.cancel()
+        self._worker = None
+
+    def metrics(self) -> dict:
+        """Метрики очереди"""
+        return {
+            'queue_depth': self.depth,
+            'queue_max_depth': self.max_depth,
+            'priority_depth': len(self._priority),
+            'background_depth': len(self._background),
+            'chats_waiting': len(self._ready),
+            'in_flight': self.in_flight,
+            'sent': self.sent,
+            'failed': self.failed,
+            'coalesced': self.coalesced,
+            'retry_after': self.retries,
+        }
+
+    def submit(self, chat_id, call, coalesce_key=None, priority: bool = False,
+               background: bool = False) -> asyncio.Future:
+        """Постановка вызова в очередь; call - функция без аргументов, возвращающая корутину"""
+        future = asyncio.get_running_loop().create_future()
+
+        if priority:
+            self._priority.append(OutboundJob(chat_id, call, future, priority=True))
+            self._added()
+            return future
+
+        if background:
+            self._background.append(OutboundJob(chat_id, call, future, background=True))
+            self._added()
+            return future
+
+        # Схлопывание: ещё не начатое редактирование того же сообщения получает новый текст
+        if coalesce_key is not None:
+            pending = self._pending_edits.get(coalesce_key)
+            if pending is not None:
+                pending.call = call
+                pending.futures.append(future)
+                self.coalesced += 1
+                return future
+
+        job = OutboundJob(chat_id, call, future, coalesce_key)
+        if coalesce_key is not None:
+            self._pending_edits[coalesce_key] = job
+
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) >= self.max_idle_chats:
+                self._prune_chats()
+            chat = self._chats[chat_id] = OutboundChat(TokenBucket(self.chat_rate, self.chat_burst))
+        chat.jobs.append(job)
+        self._schedule(chat_id, chat)
+        self._added()
+        return future
+
+    def _added(self):
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _prune_chats(self):
+        """Удаление простаивающих чатов с полным ведром"""
+        now = time.monotonic()
+        idle = [
+            chat_id for chat_id, chat in self._chats.items()
+            if not chat.jobs and not chat.busy and chat.blocked_until <= now and chat.bucket.is_full(now)
+        ]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+    def _schedule(self, chat_id, chat: OutboundChat):
+        if chat.scheduled or chat.busy or not chat.jobs:
+            return
+        now = time.monotonic()
+        ready_at = max(now + chat.bucket.delay(now), chat.blocked_until)
+        self._sequence += 1
+        heapq.heappush(self._ready, (ready_at, self._sequence, chat_id))
+        chat.scheduled = True
+
+    def _next_job(self):
+        """Следующий готовый вызов или (None, сколько ждать)"""
+        if self._priority:
+            return self._priority.popleft(), None
+
+        now = time.monotonic()
+        wait = None
+        while self._ready:
+            ready_at, _, chat_id = self._ready[0]
+            if ready_at > now:
+                wait = ready_at - now
+                break
+            heapq.heappop(self._ready)
+
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                continue
+            chat.scheduled = False
+            if chat.busy or not chat.jobs:
+                continue
+            if chat.bucket.delay(now) > 0 or chat.blocked_until > now:
+                self._schedule(chat_id, chat)
+                continue
+
+            job = chat.jobs.popleft()
+            chat.busy = True
+            chat.bucket.consume(now)
+            if job.coalesce_key is not None and self._pending_edits.get(job.coalesce_key) is job:
+                del self._pending_edits[job.coalesce_key]
+            return job, None
+
+        # Фоновые вызовы занимают только свободную от обычных ответов пропускную способность
+        if self._background:
+            if self._background_blocked_until > now:
+                delay = self._background_blocked_until - now
+                return None, delay if wait is None else min(wait, delay)
+            return self._background.popleft(), None
+        return None, wait
+
+    async def _run(self):
+        while True:
+            await self._slots.acquire()
+
+            job, wait = self._next_job()
+            while job is None:
+                if self._closing and wait is None:
+                    self._slots.release()
+                    return
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                job, wait = self._next_job()
+
+            self.depth -= 1
+            now = time.monotonic()
+            delay = self.global_bucket.delay(now)
+            if delay:
+                await asyncio.sleep(delay)
+                now = time.monotonic()
+            self.global_bucket.consume(now)
+
+            self.in_flight += 1
+            task = asyncio.create_task(self._execute(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _requeue_priority(self, job: OutboundJob):
+        self._priority.append(job)
+        self._wakeup.set()
+
+    async def _execute(self, job: OutboundJob):
+        retry_after = None
+        try:
+            result = await job.call()
+        except TelegramRetryAfter as e:
+            retry_after = e.retry_after
+        except Exception as e:
+            self.failed += 1
+            for future in job.futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            self.sent += 1
+            for future in job.futures:
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+        if retry_after is not None:
+            # Flood-лимит: возвращаем вызов в начало очереди и ждём retry_after
+            self.retries += 1
+            self.depth += 1
+            if job.priority:
+                asyncio.get_running_loop().call_later(retry_after, self._requeue_priority, job)
+            elif job.background:
+                # Лимит общий для всех фоновых вызовов - приостанавливается вся фоновая очередь
+                self._background.appendleft(job)
+                self._background_blocked_until = max(self._background_blocked_until, time.monotonic() + retry_after)
+            else:
+                chat = self._chats[job.chat_id]
+                if job.coalesce_key is not None:
+                    # Редактирование снова ждёт в очереди - следующие правки схлопываются с ним;
+                    # правка, поставленная за время попытки, переносится на его место
+                    pending = self._pending_edits.get(job.coalesce_key)
+                    if pending is not None:
+                        chat.jobs.remove(pending)
+                        job.call = pending.call
+                        job.futures.extend(pending.futures)
+                        self.depth -= 1
+                        self.coalesced += 1
+                    self._pending_edits[job.coalesce_key] = job
+                chat.jobs.appendleft(job)
+                chat.blocked_until = time.monotonic() + retry_after
+
+        if not job.priority and not job.background:
+            chat = self._chats.get(job.chat_id)
+            if chat is not None:
+                chat.busy = False
+                self._schedule(job.chat_id, chat)
+        self._wakeup.set()
+
+
+class BroadcastJob:
+    """Фоновая рассылка одного сообщения списку чатов
+    
+    Получатели записываются один раз в <id>.chats, прогресс - в <id>.json:
+    позиция, до которой все отправки завершены, завершённые отправки после
+    неё (done) и счётчики. Прогресс сохраняется атомарно каждые
+    checkpoint_every отправок и при остановке, после перезапуска рассылка
+    продолжается с сохранённого места (сообщение могут получить повторно не
+    больше checkpoint_every + concurrency чатов).
+    Отправки идут фоновыми вызовами OutboundQueue: после обычных ответов и в
+    пределах её глобального лимита.
+    """
+    
+    def __init__(self, directory: Path, state: dict, chats: list):
+        self.directory = directory
+        self.state = state
+        self.chats = chats
+        self.id = state['id']
+        self.name = state['name']
+        self.completed = set(state.pop('done', ()))  # завершённые отправки после позиции
+        self.error = None  # ошибка сообщения, прервавшая рассылку
+        self._unsaved = 0
+    
+    @classmethod
+    def create(cls, directory: Path, name: str, chats: list, text: str, keyboard, report_chat) -> 'BroadcastJob':
+        # pid и случайный суффикс: рассылки с одним именем в одну секунду (в том числе
+        # из разных рабочих процессов) не перезаписывают файлы друг друга
+        job_id = f"{re.sub(r'[^A-Za-z0-9_-]', '_', name)}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{os.urandom(3).hex()}"
+        state = {
+            'id': job_id, 'name': name, 'text': text, 'keyboard': keyboard, 'report_chat': report_chat,
+            'total': len(chats), 'position': 0, 'sent': 0, 'failed': 0,
+            'state': 'running', 'started': time.time(),
+        }
+        return cls(directory, state, chats)
+    
+    @classmethod
+    def load(cls, state_path: Path) -> 'BroadcastJob':
+        """Рассылка из файла прогресса (получатели читаются только для незавершённой)"""
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        chats = []
+        if state['state'] == 'running':
+            with open(state_path.with_suffix('.chats'), 'r', encoding='utf-8') as f:
+                chats = json.load(f)
+        return cls(state_path.parent, state, chats)
+    
+    @property
+    def remaining(self) -> int:
+        return self.state['total'] - self.state['position'] - len(self.completed)
+    
+    def _write_json(self, path: Path, data):
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    
+    def save(self, state: dict, chats: bool = False):
+        """Запись прогресса (и списка получателей при создании); файлы получателей готовой рассылки удаляются"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if chats:
+            self._write_json(self.directory / f"{self.id}.chats", self.chats)
+        self._write_json(self.directory / f"{self.id}.json", state)
+        if state['state'] != 'running':
+            with contextlib.suppress(OSError):
+                os.unlink(self.directory / f"{self.id}.chats")
+    
+    async def run(self, bot: Bot, outbox: 'OutboundQueue', concurrency: int, checkpoint_every: int):
+        """Отправка оставшимся получателям; отмена сохраняет прогресс
+        
+        Ошибка самого сообщения (BROADCAST_MESSAGE_ERRORS) прерывает рассылку:
+        состояние 'failed', текст ошибки - в error.
+        """
+        state = self.state
+        completed = self.completed
+        slots = asyncio.Semaphore(concurrency)
+        tasks = set()
+        
+        async def send(index: int):
+            try:
+                await self._send(bot, outbox, index)
+            except TelegramBadRequest as e:
+                self.error = self.error or e
+                return
+            finally:
+                slots.release()
+            self._unsaved += 1
+            completed.add(index)
+            while state['position'] in completed:
+                completed.discard(state['position'])
+                state['position'] += 1
+        
+        next_index = state['position']
+        try:
+            while next_index < state['total'] and self.error is None:
+                if next_index in completed:
+                    next_index += 1
+                    continue
+                await slots.acquire()
+                task = asyncio.create_task(send(next_index))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                next_index += 1
+                if self._unsaved >= checkpoint_every:
+                    await self.checkpoint()
+            if tasks:
+                await asyncio.wait(set(tasks))
+            if self.error is not None:
+                state['state'], state['error'] = 'failed', self.error.message
+            else:
+                state['state'] = 'done'
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.shield(self.checkpoint())
+    
+    async def checkpoint(self):
+        self._unsaved = 0
+        await asyncio.to_thread(self.save, {**self.state, 'done': sorted(self.completed)})
+        log.info("📣 Рассылка %s: %s/%s, ошибок %s", self.name, self.state['position'], self.state['total'], self.state['failed'])
+    
+    async def _send(self, bot: Bot, outbox: 'OutboundQueue', index: int):
+        chat_id = self.chats[index]
+        call = functools.partial(bot.send_message, chat_id, self.state['text'], reply_markup=self.state['keyboard'])
+        for attempt in range(BROADCAST_RETRIES):
+            try:
+                await outbox.submit(chat_id, call, background=True)
+                self.state['sent'] += 1
+                return
+            except TelegramForbiddenError:
+                # Бот заблокирован - повтор не поможет
+                break
+            except TelegramBadRequest as e:
+                # Ошибка сообщения повторится у всех получателей, чат не найден - только у этого
+                if any(marker in e.message.lower() for marker in BROADCAST_MESSAGE_ERRORS):
+                    raise
+                break
+            except Exception as e:
+                log.warning("⚠️  Рассылка %s, чат %s: %s", self.name, chat_id, e)
+                if attempt + 1 < BROADCAST_RETRIES:
+                    await asyncio.sleep(2 ** attempt)
+        self.state['failed'] += 1
+
+
+def update_event_chat_id(update: Update):
+    """chat_id обновления aiogram, для пользовательских событий без чата - id пользователя"""
+    event = update.event
+    chat = getattr(event, 'chat', None)
+    if chat is None:
+        # CallbackQuery: чат сообщения с кнопкой
+        chat = getattr(getattr(event, 'message', None), 'chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, 'from_user', None) or getattr(event, 'user', None)
+    return user.id if user is not None else 0
+
+
+def message_media(message: Message) -> dict:
+    """Файл медиа сообщения (фото - самый большой размер) как переменные контекста"""
+    content_type = message.content_type
+    media = message.photo[-1] if content_type == ContentType.PHOTO else getattr(message, content_type)
+    file_name = getattr(media, 'file_name', None) or ''
+    return {
+        'file_id': media.file_id,
+        'file_unique_id': media.file_unique_id,
+        'file_name': file_name,
+        'file_size': media.file_size or 0,
+        'mime_type': getattr(media, 'mime_type', None) or '',
+        'file_path': '',
+        'file_cached': False,
+    }
+
+
+async def read_file_chunks(path: str, chunk_size: int):
+    """Чтение локального файла частями в отдельном потоке (локальный сервер Bot API)"""
+    f = await asyncio.to_thread(open, path, 'rb')
+    try:
+        while chunk := await asyncio.to_thread(f.read, chunk_size):
+            yield chunk
+    finally:
+        f.close()
+
+
+class UpdateScheduler:
+    """Планировщик входящих обновлений
+    
+    - обновления одного чата выполняются строго по очереди (FIFO);
+    - разные чаты - параллельно, одновременно не больше concurrency обновлений;
+    - в очередях не больше max_pending обновлений: следующие ждут места в порядке
+      поступления (backpressure), webhook в это время отвечает 503;
+    - locked(names) - блокировки переменных для атомарного чтения-изменения-записи.
+    """
+    
+    def __init__(self, concurrency: int = 64, max_pending: int = 1000):
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        
+        self._slots = asyncio.Semaphore(concurrency)
+        self._queues = {}           # chat_id -> deque[(job, future)]
+        self._space = deque()       # ожидающие места в очереди (futures)
+        self._tasks = set()
+        self._locks = {}            # ключ переменной -> [asyncio.Lock, число использующих]
+        
+        # Метрики
+        self.pending = 0
+        self.running = 0
+        self.held_locks = 0
+        self.waits = 0
+    
+    @property
+    def full(self) -> bool:
+        return self.pending >= self.max_pending
+    
+    def metrics(self) -> dict:
+        return {
+            'pending': self.pending,
+            'running': self.running,
+            'chats': len(self._queues),
+            'waiting': len(self._space),
+            'locks_held': self.held_locks,
+            'waits': self.waits,
+        }
+    
+    async def run(self, chat_id, job):
+        """Выполнение job (функция без аргументов, возвращающая корутину) в очереди чата"""
+        if self.pending >= self.max_pending or self._space:
+            # Места нет - ждём по очереди; место резервирует тот, кто его освободил
+            self.waits += 1
+            waiter = asyncio.get_running_loop().create_future()
+            self._space.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._release()
+                raise
+        else:
+            self.pending += 1
+        
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            task = asyncio.create_task(self._drain(chat_id, queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        queue.append((job, future))
+        return await future
+    
+    def _release(self):
+        self.pending -= 1
+        while self._space and self.pending < self.max_pending:
+            waiter = self._space.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.pending += 1
+    
+    async def _drain(self, chat_id, queue: deque):
+        """Выполнение очереди одного чата; очередь удаляется, когда опустеет"""
+        try:
+            while queue:
+                job, future = queue[0]
+                try:
+                    async with self._slots:
+                        self.running += 1
+                        try:
+                            result = await job()
+                        except Exception as e:
+                            if not future.done():
+                                future.set_exception(e)
+                        else:
+                            if not future.done():
+                                future.set_result(result)
+                        finally:
+                            self.running -= 1
+                finally:
+                    queue.popleft()
+                    self._release()
+                    if not future.done():
+                        future.cancel()
+        finally:
+            # Прерванная очередь (отмена задачи) не остаётся без выполняющего:
+            # ожидающие обновления отменяются, следующее обновление чата создаст новую
+            if self._queues.get(chat_id) is queue:
+                del self._queues[chat_id]
+            while queue:
+                _, future = queue.popleft()
+                future.cancel()
+                self._release()
+    
+    @contextlib.asynccontextmanager
+    async def released(self):
+        """Временный возврат слота выполнения на время долгого ввода-вывода (загрузка файла)
+        
+        Очередь чата стоит на текущем обновлении, а другие чаты в это время
+        выполняются: медленные загрузки не занимают слоты текстовых обновлений.
+        """
+        self._slots.release()
+        self.running -= 1
+        try:
+            yield
+        finally:
+            self.running += 1
+            try:
+                await self._slots.acquire()
+            except asyncio.CancelledError:
+                # Выход из _drain всё равно вернёт слот - забираем его обратно в фоне
+                task = asyncio.ensure_future(self._slots.acquire())
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                raise
+    
+    @contextlib.asynccontextmanager
+    async def locked(self, keys: list):
+        """Блокировки переменных по ключам (отсортированы - без взаимных блокировок)
+        
+        Неиспользуемые блокировки удаляются, поэтому ключи могут содержать id
+        пользователя или чата.
+        """
+        entries = []
+        acquired = 0
+        try:
+            for key in keys:
+                entry = self._locks.get(key)
+                if entry is None:
+                    entry = self._locks[key] = [asyncio.Lock(), 0]
+                entry[1] += 1
+                entries.append((key, entry))
+                await entry[0].acquire()
+                acquired += 1
+                self.held_locks += 1
+            yield
+        finally:
+            for index in range(len(entries) - 1, -1, -1):
+                key, entry = entries[index]
+                if index < acquired:
+                    entry[0].release()
+                    self.held_locks -= 1
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+# Неблокирующий лог горячего пути: записи уходят в очередь, в stdout их пишет отдельный поток
+log = logging.getLogger('esybot')
+LOG_QUEUE_SIZE = 10000
+_log_handler = None
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Запись в очередь без ожидания: при переполнении запись отбрасывается"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Сообщение форматируется в потоке записи, а не в обработчике обновления
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging() -> DroppingQueueHandler:
+    """Подключение очереди логов (один раз на процесс)"""
+    global _log_handler
+    if _log_handler is None:
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(logging.Formatter('%(message)s'))
+        listener = logging.handlers.QueueListener(log_queue, stream)
+        listener.start()
+        atexit.register(listener.stop)
+        
+        _log_handler = DroppingQueueHandler(log_queue)
+        log.addHandler(_log_handler)
+        log.setLevel(logging.DEBUG)
+        log.propagate = False
+    return _log_handler
+
+
+class CodeListing:
+    """Python блок с номерами строк (текст собирается только при записи в лог)"""
+    __slots__ = ('code',)
+
+    def __init__(self, code: str):
+        self.code = code
+
+    def __str__(self) -> str:
+        return '\n'.join(f"   {i}: {line}" for i, line in enumerate(self.code.split('\n'), 1) if line.strip())
+
+
+# Границы корзин гистограмм задержек, секунды
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Фазы обработки обновления
+HANDLER_PHASES = ('download', 'condition', 'python', 'effects', 'send')
+
+# Счётчики очереди исходящих вызовов (остальные её метрики - текущие значения)
+OUTBOX_COUNTERS = frozenset(['sent', 'failed', 'coalesced', 'retry_after'])
+
+
+def metric_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class HandlerMetrics:
+    """Счётчики вызовов и ошибок и гистограммы задержек по обработчикам"""
+
+    def __init__(self, buckets: tuple = METRICS_BUCKETS):
+        self.buckets = buckets
+        self.calls = {}       # обработчик -> число обновлений
+        self.errors = {}      # (обработчик, источник) -> число ошибок
+        self.histograms = {}  # (обработчик, фаза) -> [счётчики корзин..., сумма, количество]
+
+    def call(self, handler_name: str):
+        self.calls[handler_name] = self.calls.get(handler_name, 0) + 1
+
+    def error(self, handler_name: str, source: str):
+        key = (handler_name or '', source)
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def observe(self, handler_name: str, phase: str, seconds: float):
+        histogram = self.histograms.get((handler_name, phase))
+        if histogram is None:
+            histogram = self.histograms[(handler_name, phase)] = [0] * (len(self.buckets) + 3)
+        histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def phase(self, handler_name: str, phase: str):
+        """Замер фазы; исключение внутри фазы считается ошибкой этой фазы"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.error(handler_name, phase)
+            raise
+        finally:
+            self.observe(handler_name, phase, time.perf_counter() - start)
+
+    def render(self, handler_names=(), gauges: dict = None, counters: dict = None) -> str:
+        """Текстовый формат Prometheus"""
+        lines = [
+            '# HELP esybot_handler_calls_total Обновления, переданные обработчику',
+            '# TYPE esybot_handler_calls_total counter',
+        ]
+        for name in sorted(set(handler_names) | set(self.calls)):
+            lines.append(f'esybot_handler_calls_total{{handler="{metric_label(name)}"}} {self.calls.get(name, 0)}')
+        
+        lines += [
+            '# HELP esybot_handler_errors_total Ошибки обработчиков по источникам',
+            '# TYPE esybot_handler_errors_total counter',
+        ]
+        for (name, source), count in sorted(self.errors.items()):
+            lines.append(f'esybot_handler_errors_total{{handler="{metric_label(name)}",source="{source}"}} {count}')
+        
+        lines += [
+            '# HELP esybot_handler_phase_seconds Задержка фаз обработки обновления',
+            '# TYPE esybot_handler_phase_seconds histogram',
+        ]
+        for (name, phase), histogram in sorted(self.histograms.items()):
+            labels = f'handler="{metric_label(name)}",phase="{phase}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram):
+                cumulative += count
+                lines.append(f'esybot_handler_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'esybot_handler_phase_seconds_bucket{{{labels},le="+Inf"}} {histogram[-1]}')
+            lines.append(f'esybot_handler_phase_seconds_sum{{{labels}}} {histogram[-2]}')
+            lines.append(f'esybot_handler_phase_seconds_count{{{labels}}} {histogram[-1]}')
+        
+        for kind, values in (('counter', counters or {}), ('gauge', gauges or {})):
+            for metric, value in values.items():
+                lines.append(f'# TYPE {metric} {kind}')
+                lines.append(f'{metric} {value}')
+        
+        return '\n'.join(lines) + '\n'
+
+
+# Дополнительные параметры секции [BOT] в SIMPLE формате
+SIMPLE_BOT_OPTIONS = (
+    'variables_max_entries', 'variables_ttl',
+    'python_executor', 'python_workers', 'python_timeout', 'python_cpu_limit', 'python_memory_limit',
+    'mode', 'api_server', 'webhook_url', 'webhook_path', 'webhook_host', 'webhook_port', 'webhook_secret',
+    'send_rate_global', 'send_rate_chat', 'send_burst_chat', 'send_concurrency',
+    'hot_reload', 'reload_interval',
+    'metrics_port', 'metrics_host', 'workers', 'update_concurrency', 'update_queue_size', 'memo_size',
+    'state_file', 'state_flush_interval', 'state_snapshot_every',
+    'media_dir', 'media_chunk_size', 'media_concurrency', 'media_max_size', 'media_timeout', 'media_dedup',
+    'broadcast_dir', 'broadcast_concurrency', 'broadcast_checkpoint_every',
+)
+
+# Параметры, которые применяются только при перезапуске
+RESTART_OPTIONS = frozenset([
+    'token', 'mode', 'api_server', 'webhook_url', 'webhook_path', 'webhook_host', 'webhook_port', 'webhook_secret',
+    'metrics_port', 'metrics_host', 'workers', 'update_concurrency', 'update_queue_size', 'memo_size',
+    'state_file', 'state_flush_interval', 'state_snapshot_every', 'media_concurrency', 'broadcast_dir',
+    'python_executor', 'python_workers', 'python_memory_limit',
+    'send_rate_global', 'send_rate_chat', 'send_burst_chat', 'send_concurrency',
+    'variables_max_entries', 'variables_ttl',
+])
+
+# Режимы получения обновлений
+RUN_MODES = ('polling', 'webhook')
+
+# Начало Python блока в SIMPLE формате: python { ... }
+SIMPLE_PYTHON_BLOCK = re.compile(r'python\s*\{')
+
+# Ключи YAML верхнего уровня (для определения формата)
+YAML_KEY_PATTERN = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*:')
+
+# Версия формата кэша скомпилированной конфигурации
+CONFIG_CACHE_VERSION = 3
+CONFIG_CACHE_DIR = '.esybot_cache'
+
+# Секреты не попадают в кэш конфигурации и при загрузке из кэша читаются из файла
+CONFIG_SECRETS = ('token', 'webhook_secret')
+
+
+class ConfigCachePickler(pickle.Pickler):
+    """Pickler для кэша конфигурации: объекты кода сохраняются через marshal"""
+
+    def reducer_override(self, obj):
+        if type(obj) is types.CodeType:
+            return marshal.loads, (marshal.dumps(obj),)
+        return NotImplemented
+
+
+def scan_braces(text: str, depth: int):
+    """Подсчёт фигурных скобок: (новая глубина, позиция закрытия блока или -1)"""
+    if '{' not in text and '}' not in text:
+        return depth, -1
+    for index, char in enumerate(text):
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return depth, index
+    return depth, -1
+
+
+# Области видимости переменных
+VARIABLE_SCOPES = ('global', 'chat', 'user')
+
+
+class MemoryVariableBackend:
+    """Хранилище переменных в памяти с LRU и TTL вытеснением"""
+
+    def __init__(self, max_entries: int = 100000, ttl: float = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # ключ -> [значения, время последнего доступа]
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        now = time.monotonic()
+        if self.ttl and now - entry[1] > self.ttl:
+            del self._entries[key]
+            return None
+
+        entry[1] = now
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key, values: dict):
+        entry = self._entries.get(key)
+        if entry is None:
+            self._entries[key] = [values, time.monotonic()]
+            self._evict()
+        else:
+            entry[0] = values
+            entry[1] = time.monotonic()
+            self._entries.move_to_end(key)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def update(self, key, name: str, value: Any):
+        """Запись одной переменной владельца"""
+        values = self.get(key)
+        values = {} if values is None else values
+        values[name] = value
+        self.set(key, values)
+
+    def increment(self, key, name: str, delta, default: Any):
+        """Изменение числовой переменной владельца, возвращает новое значение"""
+        values = self.get(key)
+        values = {} if values is None else values
+        value = values.get(name, default) + delta
+        values[name] = value
+        self.set(key, values)
+        return value
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def items(self) -> list:
+        """Все владельцы и их переменные (для снимка состояния)"""
+        return [(key, entry[0]) for key, entry in self._entries.items()]
+
+    def _evict(self):
+        """Вытеснение самых старых записей по размеру и TTL"""
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        if self.ttl:
+            deadline = time.monotonic() - self.ttl
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest[1] >= deadline:
+                    break
+                self._entries.popitem(last=False)
+
+
+class ScopedVariables:
+    """Переменные пользователя и чата поверх подключаемого хранилища
+
+    Хранилище (backend) - любой объект с методами get(key), set(key, values)
+    и delete(key), где key = (область, id), а values - словарь переменных.
+    Необязательные update(key, name, value) и increment(key, name, delta, default)
+    изменяют одну переменную за один вызов (атомарно для общего хранилища).
+    В хранилище попадают только изменённые значения, остальные берутся
+    из значений по умолчанию.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else MemoryVariableBackend()
+        self.scopes = {}    # имя -> 'chat' | 'user'
+        self.defaults = {}  # имя -> значение по умолчанию
+
+    def declare(self, name: str, scope: str, default: Any):
+        self.scopes[name] = scope
+        self.defaults[name] = default
+
+    def undeclare(self, name: str):
+        """Переменная убрана из конфигурации (сохранённые значения владельцев остаются в хранилище)"""
+        self.scopes.pop(name, None)
+        self.defaults.pop(name, None)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.scopes
+
+    def __len__(self) -> int:
+        return len(self.scopes)
+
+    def key(self, name: str, context: dict) -> tuple:
+        """Ключ владельца переменной для текущего контекста"""
+        scope = self.scopes[name]
+        return scope, context.get(f'{scope}_id', 0)
+
+    def default(self, name: str) -> Any:
+        value = self.defaults[name]
+        if isinstance(value, (list, dict, set)):
+            return copy.deepcopy(value)
+        return value
+
+    def get(self, name: str, context: dict) -> Any:
+        values = self.backend.get(self.key(name, context))
+        if values is not None and name in values:
+            return values[name]
+        return self.default(name)
+
+    def set(self, name: str, value: Any, context: dict):
+        key = self.key(name, context)
+        update = getattr(self.backend, 'update', None)
+        if update is not None:
+            update(key, name, value)
+            return
+        values = self.backend.get(key)
+        values = {} if values is None else values
+        values[name] = value
+        self.backend.set(key, values)
+
+    def increment(self, name: str, delta, context: dict):
+        """Изменение числовой переменной, возвращает новое значение"""
+        key = self.key(name, context)
+        increment = getattr(self.backend, 'increment', None)
+        if increment is not None:
+            return increment(key, name, delta, self.defaults[name])
+        value = self.get(name, context) + delta
+        self.set(name, value, context)
+        return value
+
+    def values(self, context: dict) -> dict:
+        """Все переменные пользователя и чата для контекста"""
+        result = {}
+        loaded = {}
+        for name, scope in self.scopes.items():
+            if scope not in loaded:
+                loaded[scope] = self.backend.get((scope, context.get(f'{scope}_id', 0))) or {}
+            values = loaded[scope]
+            result[name] = values[name] if name in values else self.default(name)
+        return result
+
+
+# Запись журнала состояния: длина и crc32 данных, затем pickle кортежа (вид, ключ, имя, значение)
+JOURNAL_FRAME = struct.Struct('<II')
+
+# Виды записей: переменная, переменная Python блоков, переменная пользователя/чата,
+# все переменные владельца (в снимке), заголовок файла с номером журнала
+JOURNAL_VARIABLE = 'v'
+JOURNAL_PYTHON = 'p'
+JOURNAL_SCOPED = 's'
+JOURNAL_OWNER = 'o'
+JOURNAL_HEADER = 'h'
+
+# Записей снимка, сериализуемых в event loop без переключения на другие задачи
+SNAPSHOT_CHUNK = 1000
+
+
+def journal_frame(record: tuple) -> bytes:
+    payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+    return JOURNAL_FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_journal_frames(path: Path):
+    """Записи файла до первой неполной или повреждённой; возвращает (записи, длина корректной части)"""
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return [], 0
+    
+    records = []
+    position = 0
+    while position + JOURNAL_FRAME.size <= len(data):
+        length, crc = JOURNAL_FRAME.unpack_from(data, position)
+        start = position + JOURNAL_FRAME.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        try:
+            records.append(pickle.loads(payload))
+        except Exception:
+            break
+        position = start + length
+    return records, position
+
+
+class StateJournal:
+    """Долговременное хранение переменных: журнал изменений и снимки
+    
+    На пути обработки обновления изменение только запоминается (последнее
+    значение на переменную). Раз в flush_interval накопленное дописывается
+    в журнал одной записью с fsync в отдельном потоке. Когда в журнале
+    snapshot_every записей, состояние целиком пишется в снимок (временный
+    файл + os.replace), и журнал начинается заново с новым номером - старый
+    журнал, оставшийся после сбоя, при восстановлении пропускается.
+    """
+    
+    def __init__(self, path, flush_interval: float = 1.0, snapshot_every: int = 10000):
+        self.path = Path(path)
+        self.journal_path = self.path.with_name(self.path.name + '.journal')
+        self.snapshot_path = self.path.with_name(self.path.name + '.snapshot')
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        
+        self.journal_id = 0
+        self._pending = {}          # (вид, ключ, имя) -> значение
+        self._journal_records = 0
+        self._file = None
+        self._task = None
+        self._stopping = None
+        self._dump_state = None
+        self._skipped = set()       # имена непиклуемых значений (сообщение один раз)
+        
+        # Метрики
+        self.written = 0
+        self.snapshots = 0
+    
+    def record(self, kind: str, key, name: str, value: Any):
+        self._pending[(kind, key, name)] = value
+    
+    def load(self) -> list:
+        """Записи снимка и журнала в порядке применения"""
+        snapshot, _ = read_journal_frames(self.snapshot_path)
+        records = []
+        if snapshot and snapshot[0][0] == JOURNAL_HEADER:
+            self.journal_id = snapshot[0][3]
+            records = snapshot[1:]
+        
+        journal, valid_length = read_journal_frames(self.journal_path)
+        if journal and journal[0][0] == JOURNAL_HEADER and journal[0][3] == self.journal_id:
+            records += journal[1:]
+            self._journal_records = len(journal) - 1
+            # Хвост, недописанный при сбое, отрезается - новые записи идут за корректными
+            if self.journal_path.stat().st_size > valid_length:
+                with open(self.journal_path, 'r+b') as f:
+                    f.truncate(valid_length)
+        elif self.journal_path.exists():
+            # Журнал уже вошёл в снимок (сбой между снимком и очисткой журнала) или повреждён
+            self._reset_journal()
+        return records
+    
+    def start(self, dump_state):
+        """dump_state() -> список записей всего состояния для снимка"""
+        self._dump_state = dump_state
+        if self._file is None:
+            if not self.journal_path.exists() or not self.journal_path.stat().st_size:
+                self._reset_journal()
+            self._file = open(self.journal_path, 'ab')
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Остановка: всё накопленное сохраняется снимком"""
+        if self._task is not None:
+            # Не отмена: идущая дозапись в журнал должна закончиться до снимка и очистки журнала
+            self._stopping.set()
+            await self._task
+            self._task = None
+        if self._file is not None:
+            await self.snapshot()
+            self._file.close()
+            self._file = None
+    
+    def metrics(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'journal_records': self._journal_records,
+            'written': self.written,
+            'snapshots': self.snapshots,
+        }
+    
+    async def _run(self):
+        while not self._stopping.is_set():
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            if self._stopping.is_set():
+                return
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error("❌ Ошибка записи журнала состояния: %s", e)
+    
+    def _frames(self, records) -> bytes:
+        frames = []
+        for record in records:
+            try:
+                frames.append(journal_frame(record))
+            except Exception as e:
+                # Модули, функции и другие непиклуемые значения не сохраняются
+                if record[2] not in self._skipped:
+                    self._skipped.add(record[2])
+                    if not isinstance(record[3], types.ModuleType):
+                        log.error("❌ Переменная %s не сохраняется: %s", record[2], e)
+        return b''.join(frames)
+    
+    async def flush(self):
+        """Дозапись накопленных изменений в журнал (pickle - в event loop, запись и fsync - в потоке)"""
+        if self._pending:
+            pending, self._pending = self._pending, {}
+            try:
+                data = self._frames(key + (value,) for key, value in pending.items())
+                await asyncio.to_thread(self._append, data)
+            except BaseException:
+                # Не записано - изменения остаются для следующей попытки (более новые важнее)
+                self._pending = {**pending, **self._pending}
+                raise
+            self._journal_records += len(pending)
+            self.written += len(pending)
+        if self._journal_records >= self.snapshot_every:
+            await self.snapshot()
+    
+    async def snapshot(self):
+        """Снимок всего состояния и новый журнал
+        
+        Состояние сериализуется в event loop частями по SNAPSHOT_CHUNK записей
+        (значения не меняются во время pickle), запись файла - в потоке.
+        Накопленные до снимка изменения уже в состоянии; изменения во время
+        снимка остаются в _pending и попадут в новый журнал (повтор значения
+        при восстановлении безвреден). Если снимок не записан, накопленные
+        изменения возвращаются в _pending.
+        """
+        pending, self._pending = self._pending, {}
+        journal_id = self.journal_id + 1
+        try:
+            records = self._dump_state()
+            chunks = [journal_frame((JOURNAL_HEADER, None, None, journal_id))]
+            for start in range(0, len(records), SNAPSHOT_CHUNK):
+                chunks.append(self._frames(records[start:start + SNAPSHOT_CHUNK]))
+                await asyncio.sleep(0)
+            await asyncio.to_thread(self._write_snapshot, b''.join(chunks))
+        except BaseException:
+            self._pending = {**pending, **self._pending}
+            raise
+        self.journal_id = journal_id
+        await asyncio.to_thread(self._reset_journal)
+        self._journal_records = 0
+        self.snapshots += 1
+    
+    def _append(self, data: bytes):
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+    
+    def _write_snapshot(self, data: bytes):
+        temp_path = self.snapshot_path.with_name(self.snapshot_path.name + '.tmp')
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+    
+    def _reset_journal(self):
+        """Пустой журнал с заголовком текущего номера"""
+        header = journal_frame((JOURNAL_HEADER, None, None, self.journal_id))
+        if self._file is not None:
+            self._file.truncate(0)
+            self._append(header)
+            return
+        self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.journal_path, 'wb') as f:
+            f.write(header)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class SharedState:
+    """Общее состояние рабочих процессов: глобальные переменные и переменные пользователей/чатов
+
+    Живёт в процессе SharedStateManager, рабочие процессы обращаются к нему
+    через прокси. Каждый метод - один вызов, изменения атомарны.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._namespaces = {'variables': {}, 'python_globals': {}}
+        self._scoped = MemoryVariableBackend()
+        self._locks = {}  # ключ блокировки -> (владелец, срок действия)
+
+    def configure(self, max_entries: int, ttl: float):
+        with self._lock:
+            self._scoped.max_entries = max_entries
+            self._scoped.ttl = ttl
+
+    # Глобальные переменные (namespace: variables или python_globals)
+    def lookup(self, namespace: str, name: str) -> tuple:
+        values = self._namespaces[namespace]
+        with self._lock:
+            if name in values:
+                return True, values[name]
+        return False, None
+
+    def snapshot(self, namespace: str) -> dict:
+        with self._lock:
+            return dict(self._namespaces[namespace])
+
+    def globals_view(self) -> dict:
+        """Переменные и переменные Python блоков одним вызовом (вторые важнее - как в шаблонах)"""
+        with self._lock:
+            return {**self._namespaces['variables'], **self._namespaces['python_globals']}
+
+    def size(self, namespace: str) -> int:
+        return len(self._namespaces[namespace])
+
+    def assign(self, namespace: str, name: str, value: Any):
+        with self._lock:
+            self._namespaces[namespace][name] = value
+
+    def remove(self, namespace: str, name: str) -> bool:
+        with self._lock:
+            return self._namespaces[namespace].pop(name, MISSING) is not MISSING
+
+    def setdefault(self, namespace: str, name: str, value: Any) -> Any:
+        with self._lock:
+            return self._namespaces[namespace].setdefault(name, value)
+
+    # Блокировки переменных на время снимок -> Python блок -> запись (ключи - variable_lock_keys)
+    def try_lock(self, keys: list, owner: str, lease: float) -> bool:
+        """Все ключи сразу или ни одного; lease - срок, после которого блокировка упавшего процесса снимается"""
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                held = self._locks.get(key)
+                if held is not None and held[0] != owner and held[1] > now:
+                    return False
+            for key in keys:
+                self._locks[key] = (owner, now + lease)
+            return True
+
+    def unlock(self, keys: list, owner: str):
+        with self._lock:
+            for key in keys:
+                held = self._locks.get(key)
+                if held is not None and held[0] == owner:
+                    del self._locks[key]
+
+    def seed(self, variables: dict, python_globals: dict, scoped: list):
+        """Начальное состояние одним вызовом: переменные, восстановленные супервизором"""
+        with self._lock:
+            self._namespaces['variables'].update(variables)
+            self._namespaces['python_globals'].update(python_globals)
+            for key, values in scoped:
+                self._scoped.set(key, values)
+
+    def increment(self, namespace: str, name: str, delta, default: Any):
+        with self._lock:
+            values = self._namespaces[namespace]
+            value = values.get(name, default) + delta
+            values[name] = value
+            return value
+
+    # Переменные пользователей и чатов (протокол хранилища ScopedVariables)
+    def scoped_get(self, key):
+        with self._lock:
+            return self._scoped.get(key)
+
+    def scoped_set(self, key, values: dict):
+        with self._lock:
+            self._scoped.set(key, values)
+
+    def scoped_delete(self, key):
+        with self._lock:
+            self._scoped.delete(key)
+
+    def scoped_update(self, key, name: str, value: Any):
+        with self._lock:
+            self._scoped.update(key, name, value)
+
+    def scoped_increment(self, key, name: str, delta, default: Any):
+        with self._lock:
+            return self._scoped.increment(key, name, delta, default)
+
+    def scoped_size(self) -> int:
+        return len(self._scoped)
+
+
+_shared_state = None
+
+
+def get_shared_state() -> SharedState:
+    """Единственный экземпляр общего состояния в процессе менеджера"""
+    global _shared_state
+    if _shared_state is None:
+        _shared_state = SharedState()
+    return _shared_state
+
+
+class SharedStateManager(multiprocessing.managers.BaseManager):
+    """Локальный процесс с общим состоянием рабочих процессов"""
+
+
+SharedStateManager.register('state', callable=get_shared_state)
+
+
+def ignore_sigint():
+    """Ctrl+C обрабатывает супервизор, дочерние процессы завершаются по его команде"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class SharedVariables(MutableMapping):
+    """Глобальные переменные в общем состоянии (замена словаря self.variables)"""
+
+    def __init__(self, state, namespace: str):
+        self.state = state
+        self.namespace = namespace
+
+    def get(self, name: str, default: Any = None) -> Any:
+        found, value = self.state.lookup(self.namespace, name)
+        return value if found else default
+
+    def __getitem__(self, name: str) -> Any:
+        found, value = self.state.lookup(self.namespace, name)
+        if not found:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name: str, value: Any):
+        self.state.assign(self.namespace, name, value)
+
+    def __delitem__(self, name: str):
+        if not self.state.remove(self.namespace, name):
+            raise KeyError(name)
+
+    def __contains__(self, name) -> bool:
+        return self.state.lookup(self.namespace, name)[0]
+
+    def __iter__(self):
+        return iter(self.copy())
+
+    def __len__(self) -> int:
+        return self.state.size(self.namespace)
+
+    def copy(self) -> dict:
+        """Снимок всех переменных одним вызовом"""
+        return self.state.snapshot(self.namespace)
+
+    def items(self):
+        return self.copy().items()
+
+    def setdefault(self, name: str, default: Any = None) -> Any:
+        return self.state.setdefault(self.namespace, name, default)
+
+    def increment(self, name: str, delta, default: Any = 0):
+        return self.state.increment(self.namespace, name, delta, default)
+
+
+class SharedVariableBackend:
+    """Хранилище переменных пользователей и чатов в общем состоянии"""
+
+    def __init__(self, state):
+        self.state = state
+
+    def get(self, key):
+        return self.state.scoped_get(key)
+
+    def set(self, key, values: dict):
+        self.state.scoped_set(key, values)
+
+    def delete(self, key):
+        self.state.scoped_delete(key)
+
+    def update(self, key, name: str, value: Any):
+        self.state.scoped_update(key, name, value)
+
+    def increment(self, key, name: str, delta, default: Any):
+        return self.state.scoped_increment(key, name, delta, default)
+
+    def __len__(self) -> int:
+        return self.state.scoped_size()
+
+
+def connect_shared_state(address, authkey: bytes) -> SharedState:
+    manager = SharedStateManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.state()
+
+
+def update_chat_id(raw: dict):
+    """chat_id обновления Telegram (JSON), для пользовательских событий без чата - id пользователя"""
+    for key, value in raw.items():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        user = value.get('from') or value.get('user')
+        if user:
+            return user['id']
+    return 0
+
+
+def shard_index(chat_id, workers: int) -> int:
+    """Номер рабочего процесса для чата (стабилен между запусками)"""
+    return zlib.crc32(str(chat_id).encode()) % workers
+
+
+def run_shard_worker(index: int, config_file: str, cache_dir, bot_config: dict, state_address, state_authkey: bytes, conn):
+    """Точка входа рабочего процесса: свой event loop, общее состояние через менеджер"""
+    ignore_sigint()
+    state = connect_shared_state(state_address, state_authkey)
+    
+    interpreter = UnifiedBotInterpreter(variable_backend=SharedVariableBackend(state), cache_dir=cache_dir)
+    if not interpreter.load_config(config_file):
+        print(f"❌ Рабочий процесс {index}: не удалось загрузить конфигурацию")
+        return
+    interpreter.bot_config.update(bot_config)
+    interpreter.variables = SharedVariables(state, 'variables')
+    interpreter.python_globals = SharedVariables(state, 'python_globals')
+    
+    asyncio.run(interpreter.run_shard(conn, index))
+
+
 class UnifiedBotInterpreter:
     """Универсальный интерпретатор для SIMPLE и YAML форматов"""
     
-    def __init__(self):
+    def __init__(self, variable_backend=None, cache_dir=None):
         self.config_format = None  # 'simple' или 'yaml'
+        # Каталог кэша скомпилированной конфигурации: None - рядом с файлом, False - без кэша
+        self.cache_dir = cache_dir
         self.bot_config = {}
         self.variables = {}
+        self.scoped_variables = ScopedVariables(variable_backend)
+        self._custom_variable_backend = variable_backend is not None
+        # Параметры и глобальные переменные из файла конфигурации (удаляются при перезагрузке без них)
+        # и подпись файла при загрузке (mtime, размер) для слежения за изменениями
+        self.config_signature = None
+        self.config_keys = frozenset()
+        self.declared_variables = frozenset()
+        
         self.keyboards_config = {}
         self.handlers_config = {}
         self.python_globals = {}
         
-        # Готовые клавиатуры
-        self.keyboards = {}
+        # Готовые статические клавиатуры (строятся при первом использовании)
+        self.keyboards = {}
+        
+        # Переменные, от которых зависят клавиатуры, и кэш отрисованных динамических клавиатур
+        self.keyboard_variables = {}
+        self._keyboard_cache = OrderedDict()
+        
+        # Скомпилированные шаблоны текстов, условия и Python блоки
+        self.templates = {}
+        self.conditions = {}
+        self.code_objects = {}
+        
+        # Таблица маршрутизации callback_data -> обработчик
+        self.callback_routes = {}
+        # Текстовые триггеры обработчиков (TextMatcher или None)
+        self.text_matcher = None
+        
+        # Скомпилированные артефакты по обработчикам (для инкрементальной перезагрузки)
+        self._compiled_handlers = {}
+        # Обработчики, собранные в цепочки шагов (имя -> HandlerPipeline)
+        self.pipelines = {}
+        
+        # Кэш ответов чистых обработчиков и версии переменных (растут при каждой записи)
+        self.memo_size = MEMO_SIZE
+        self.variable_versions = {}
+        self._memo_plans = {}
+        self._memo = OrderedDict()
+        self.memo_hits = 0
+        self.memo_misses = 0
+        
+        # Файл конфигурации и хэш его содержимого (для горячей перезагрузки)
+        self.config_path = None
+        self.config_hash = None
+        
+        # Пул выполнения Python блоков (режимы thread/process)
+        self.python_executor = None
+        self._python_slots = None
+        
+        # Очередь исходящих вызовов Bot API
+        self.outbox = None
+        
+        # Количество обновлений в обработке и сигнал остановки webhook
+        self.inflight_updates = 0
+        self.scheduler = None
+        
+        # Журнал изменений переменных (config.state_file)
+        self.journal = None
+        
+        # Загрузка файлов медиа обработчиков: лимит одновременных загрузок,
+        # загруженные файлы ((обработчик, file_unique_id) -> путь) и загрузки в процессе
+        self._media_slots = None
+        self._media_cache = OrderedDict()
+        self._media_downloads = {}
+        
+        # Идущие рассылки: имя -> (BroadcastJob, задача); отправки завершённых рассылок
+        self.broadcasts = {}
+        self.broadcast_sent = 0
+        self.broadcast_failed = 0
+        self._stop_event = None
         
-    def detect_format(self, file_path: str) -> str:
+        # Метрики обработчиков и HTTP сервер для них (config.metrics_port)
+        self.metrics = HandlerMetrics()
+        self._metrics_runner = None
+        self.log_handler = setup_logging()
+        
+    def detect_format(self, file_path: str, content: str = None) -> str:
         """Автоматическое определение формата файла"""
         extension = Path(file_path).suffix.lower()
         
@@ -49,58 +2144,419 @@ class UnifiedBotInterpreter:
                 raise Exception("YAML формат недоступен. Установите: pip install pyyaml")
             return 'yaml'
         else:
-            # Пытаемся определить по содержимому
+            # Пытаемся определить по содержимому: достаточно первых значимых строк
             try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read().strip()
-                
-                # Если есть секции [NAME], то это SIMPLE
-                if re.search(r'^\[.+\]', content, re.MULTILINE):
-                    return 'simple'
-                # Если есть YAML структуры, то это YAML
-                elif re.search(r'^[a-zA-Z_][a-zA-Z0-9_]*:', content, re.MULTILINE):
-                    if YAML_AVAILABLE:
-                        return 'yaml'
-                    else:
-                        raise Exception("Файл похож на YAML, но библиотека недоступна")
-                else:
-                    raise Exception("Не удалось определить формат файла")
+                if content is None:
+                    with open(file_path, 'r', encoding='utf-8') as f:
+                        return self._detect_format_from_lines(f)
+                return self._detect_format_from_lines(io.StringIO(content))
                     
             except Exception as e:
                 raise Exception(f"Ошибка определения формата: {e}")
     
+    def _detect_format_from_lines(self, lines) -> str:
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            
+            # Если есть секции [NAME], то это SIMPLE
+            if line.startswith('[') and line.endswith(']'):
+                return 'simple'
+            # Если есть YAML структуры, то это YAML
+            elif YAML_KEY_PATTERN.match(line):
+                if YAML_AVAILABLE:
+                    return 'yaml'
+                else:
+                    raise Exception("Файл похож на YAML, но библиотека недоступна")
+        
+        raise Exception("Не удалось определить формат файла")
+    
     def load_config(self, file_path: str) -> bool:
         """Загрузка конфигурации в любом формате"""
         try:
-            self.config_format = self.detect_format(file_path)
+            with open(file_path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                data = f.read()
+            self.config_path = file_path
+            self.config_hash = hashlib.sha256(data).hexdigest()
+            self.config_signature = (stat.st_mtime_ns, stat.st_size)
+            
+            # Неизменённая конфигурация берётся из кэша без разбора и компиляции
+            if self.load_config_cache(file_path, data):
+                print(f"⚡ Конфигурация {self.config_format.upper()} загружена из кэша")
+                self.configure_variable_store()
+                self.build_callback_routes()
+                self.build_text_matcher()
+                self.remember_config_keys()
+                self.restore_state()
+                return True
+            
+            content = data.decode('utf-8')
+            self.config_format = self.detect_format(file_path, content)
             print(f"📝 Обнаружен формат: {self.config_format.upper()}")
             
             if self.config_format == 'simple':
-                return self._load_simple_config(file_path)
+                loaded = self._load_simple_config(content)
             elif self.config_format == 'yaml':
-                return self._load_yaml_config(file_path)
+                loaded = self._load_yaml_config(content)
             else:
                 print(f"❌ Неподдерживаемый формат: {self.config_format}")
                 return False
+            
+            if loaded:
+                self.configure_variable_store()
+                self.compile_handlers()
+                self.compile_keyboards()
+                self.build_callback_routes()
+                self.build_text_matcher()
+                self.save_config_cache(file_path)
+                self.remember_config_keys()
+                # После кэша конфигурации: в нём остаются значения по умолчанию
+                self.restore_state()
+            return loaded
                 
         except Exception as e:
             print(f"❌ Ошибка загрузки конфигурации: {e}")
             return False
     
-    def _load_simple_config(self, file_path: str) -> bool:
-        """Загрузка SIMPLE конфигурации"""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+    def remember_config_keys(self):
+        """Что объявлено в файле: параметры и глобальные переменные (до изменений во время работы)"""
+        self.config_keys = frozenset(self.bot_config)
+        self.declared_variables = frozenset(self.variables)
+    
+    def config_relative_path(self, path: str) -> Path:
+        """Путь из конфигурации: относительный - от каталога файла конфигурации"""
+        path = Path(path)
+        if not path.is_absolute() and self.config_path:
+            path = Path(self.config_path).resolve().parent / path
+        return path
+    
+    def restore_state(self):
+        """Восстановление переменных из снимка и журнала (config.state_file)
+        
+        Значения применяются только к объявленным переменным; переменные
+        Python блоков восстанавливаются все.
+        """
+        state_file = self.bot_config.get('state_file')
+        if not state_file or self._custom_variable_backend:
+            return
+        
+        path = self.config_relative_path(state_file)
+        self.journal = StateJournal(
+            path,
+            flush_interval=float(self.bot_config.get('state_flush_interval', 1)),
+            snapshot_every=int(self.bot_config.get('state_snapshot_every', 10000))
+        )
+        
+        start = time.perf_counter()
+        records = self.journal.load()
+        scoped = self.scoped_variables
+        backend = scoped.backend
+        for kind, key, name, value in records:
+            if kind == JOURNAL_VARIABLE:
+                if name in self.variables:
+                    self.variables[name] = value
+            elif kind == JOURNAL_PYTHON:
+                self.python_globals[name] = value
+            elif kind == JOURNAL_SCOPED:
+                if name in scoped:
+                    backend.update(key, name, value)
+            elif kind == JOURNAL_OWNER:
+                values = {name: value for name, value in value.items() if name in scoped}
+                if values:
+                    backend.set(key, values)
+        if records:
+            print(f"💾 Состояние восстановлено: {len(records)} записей за {time.perf_counter() - start:.3f} с ({path})")
+    
+    def dump_state(self) -> list:
+        """Всё состояние переменных записями журнала (для снимка)"""
+        records = [(JOURNAL_VARIABLE, None, name, value) for name, value in self.variables.items()]
+        records += [(JOURNAL_PYTHON, None, name, value) for name, value in self.python_globals.items()]
+        records += [(JOURNAL_OWNER, key, None, values) for key, values in self.scoped_variables.backend.items()]
+        return records
+    
+    def start_state_journal(self):
+        if self.journal is not None:
+            self.journal.start(self.dump_state)
+    
+    async def stop_state_journal(self):
+        if self.journal is not None:
+            await self.journal.stop()
+    
+    def config_cache_file(self, file_path: str):
+        """Путь к файлу кэша для текущего содержимого конфигурации"""
+        if self.cache_dir is False or not self.config_hash:
+            return None
+        
+        cache_dir = Path(self.cache_dir) if self.cache_dir else Path(file_path).resolve().parent / CONFIG_CACHE_DIR
+        tag = sys.implementation.cache_tag or 'python'
+        return cache_dir / f"{Path(file_path).name}-{self.config_hash[:32]}-{tag}.pickle"
+    
+    def load_config_cache(self, file_path: str, data: bytes) -> bool:
+        """Восстановление разобранной и скомпилированной конфигурации из кэша
+        
+        Кэш - pickle, поэтому читается только файл текущего пользователя, который
+        не могут менять другие. Секреты (CONFIG_SECRETS) берутся из data - текста
+        конфигурации.
+        """
+        cache_file = self.config_cache_file(file_path)
+        if cache_file is None or not cache_file.exists():
+            return False
+        
+        try:
+            stat = cache_file.stat()
+            if (hasattr(os, 'getuid') and stat.st_uid != os.getuid()) or stat.st_mode & 0o022:
+                print(f"⚠️  Кэш конфигурации {cache_file} принадлежит другому пользователю или доступен ему для записи, не используется")
+                return False
+            with open(cache_file, 'rb') as f:
+                state = pickle.load(f)
+            if state.get('version') != CONFIG_CACHE_VERSION or state.get('hash') != self.config_hash:
+                return False
+            secrets = self.read_config_secrets(data.decode('utf-8'), state['config_format'])
+            if secrets is None:
+                return False
+        except Exception as e:
+            if self.bot_config.get('debug'):
+                print(f"⚠️  Кэш конфигурации повреждён: {e}")
+            return False
+        
+        self.config_format = state['config_format']
+        self.bot_config = {**state['bot_config'], **secrets}
+        self.variables = state['variables']
+        for name, (scope, default) in state['scoped_variables'].items():
+            self.scoped_variables.declare(name, scope, default)
+        self.keyboards_config = state['keyboards_config']
+        self.handlers_config = state['handlers_config']
+        self.keyboard_variables = state['keyboard_variables']
+        self._compiled_handlers = state['compiled_handlers']
+        self.compile_handlers(changed=set())
+        return True
+    
+    def save_config_cache(self, file_path: str):
+        """Сохранение разобранной и скомпилированной конфигурации в кэш"""
+        cache_file = self.config_cache_file(file_path)
+        if cache_file is None:
+            return
+        
+        state = {
+            'version': CONFIG_CACHE_VERSION,
+            'hash': self.config_hash,
+            'config_format': self.config_format,
+            'bot_config': {key: value for key, value in self.bot_config.items() if key not in CONFIG_SECRETS},
+            'variables': self.variables,
+            'scoped_variables': {
+                name: (scope, self.scoped_variables.defaults[name])
+                for name, scope in self.scoped_variables.scopes.items()
+            },
+            'keyboards_config': self.keyboards_config,
+            'handlers_config': self.handlers_config,
+            'keyboard_variables': self.keyboard_variables,
+            'compiled_handlers': self._compiled_handlers,
+        }
+        
+        try:
+            cache_file.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            temp_file = cache_file.with_suffix('.tmp')
+            temp_file.unlink(missing_ok=True)
+            with open(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+                ConfigCachePickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(state)
+            os.replace(temp_file, cache_file)
+            
+            # Старые версии кэша этого файла больше не нужны
+            for old_file in cache_file.parent.glob(f"{Path(file_path).name}-*.pickle"):
+                if old_file != cache_file:
+                    old_file.unlink(missing_ok=True)
+        except Exception as e:
+            if self.bot_config.get('debug'):
+                print(f"⚠️  Не удалось сохранить кэш конфигурации: {e}")
+    
+    def read_config_secrets(self, content: str, config_format: str):
+        """Значения CONFIG_SECRETS из текста конфигурации без полного разбора
+        
+        SIMPLE - секция BOT, YAML - только блок config. None - прочитать не
+        удалось (тогда кэш не используется и конфигурация разбирается заново).
+        """
+        if config_format == 'simple':
+            sections = self._parse_simple_sections(content)
+            bot_config = self._simple_bot_config(sections['BOT']) if 'BOT' in sections else {}
+        else:
+            lines = content.splitlines()
+            start = next((i for i, line in enumerate(lines) if line.startswith('config:')), None)
+            if start is None:
+                return {}
+            end = next((i for i in range(start + 1, len(lines))
+                        if lines[i][:1] not in ('', ' ', '\t', '#')), len(lines))
+            try:
+                bot_config = (yaml.safe_load('\n'.join(lines[start:end])) or {}).get('config')
+            except yaml.YAMLError:
+                return None
+            if not isinstance(bot_config, dict):
+                return None
+        return {key: bot_config[key] for key in CONFIG_SECRETS if key in bot_config}
+    
+    def reload_config(self, file_path: str = None) -> bool:
+        """Горячая перезагрузка конфигурации без остановки бота"""
+        staging = self.parse_config(file_path or self.config_path)
+        if staging is None:
+            return False
+        self.apply_config(staging)
+        return True
+    
+    def parse_config(self, file_path: str):
+        """Разбор конфигурации в отдельный интерпретатор (без компиляции)"""
+        staging = UnifiedBotInterpreter()
+        try:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            content = data.decode('utf-8')
+            staging.config_format = staging.detect_format(file_path, content)
+            staging.config_hash = hashlib.sha256(data).hexdigest()
+            if staging.config_format == 'simple':
+                staging._load_simple_config(content)
+            else:
+                staging._load_yaml_config(content)
+        except Exception as e:
+            print(f"❌ Ошибка перезагрузки конфигурации: {e}")
+            return None
+        return staging
+    
+    def apply_config(self, staging: 'UnifiedBotInterpreter'):
+        """Применение новой конфигурации
+        
+        Пересобираются только изменённые обработчики и клавиатуры, затем таблицы
+        заменяются разом (без await между присваиваниями). Текущие значения
+        переменных сохраняются, новые переменные получают значения по умолчанию.
+        Переменные и параметры, удалённые из файла, удаляются (параметры - снова
+        по умолчанию); переменные, созданные во время работы, не трогаются.
+        """
+        changed_handlers = {
+            name for name, config in staging.handlers_config.items()
+            if self.handlers_config.get(name) != config
+        }
+        removed_handlers = self.handlers_config.keys() - staging.handlers_config.keys()
+        # Режим отладки - из нового файла (нет ключа - выключен); сменился - пересобираются все шаги
+        debug = bool(staging.bot_config.get('debug'))
+        if debug != bool(self.bot_config.get('debug')):
+            changed_handlers = set(staging.handlers_config)
+        changed_keyboards = {
+            name for name, config in staging.keyboards_config.items()
+            if self.keyboards_config.get(name) != config
+        }
+        removed_keyboards = self.keyboards_config.keys() - staging.keyboards_config.keys()
         
-        # Парсим Python блоки
-        content = self._parse_simple_python_blocks(content)
+        compiled = self.compile_handlers(
+            staging.handlers_config, changed_handlers, apply=False, debug=debug
+        )
+        # Изменённые клавиатуры построятся заново при первом использовании
+        keyboards = {
+            name: markup for name, markup in self.keyboards.items()
+            if name in staging.keyboards_config and name not in changed_keyboards
+        }
+        keyboard_variables = self.compile_keyboards(staging.keyboards_config, apply=False)
+        callback_routes = self.build_callback_routes(staging.handlers_config, apply=False)
+        text_matcher = self.build_text_matcher(staging.handlers_config, apply=False)
+        
+        # Атомарная замена таблиц
+        self.handlers_config = staging.handlers_config
+        self.keyboards_config = staging.keyboards_config
+        self.keyboards = keyboards
+        self.keyboard_variables = keyboard_variables
+        if changed_keyboards or removed_keyboards:
+            self._keyboard_cache = OrderedDict()
+        self._apply_compiled(compiled)
+        self.callback_routes = callback_routes
+        self.text_matcher = text_matcher
+        self.config_hash = staging.config_hash
+        
+        for name, value in staging.variables.items():
+            self.variables.setdefault(name, value)
+        for name in self.declared_variables - staging.variables.keys():
+            self.variables.pop(name, None)
+            self.bump_variable(name)
+        for name, scope in staging.scoped_variables.scopes.items():
+            self.scoped_variables.declare(name, scope, staging.scoped_variables.defaults[name])
+        for name in self.scoped_variables.scopes.keys() - staging.scoped_variables.scopes.keys():
+            self.scoped_variables.undeclare(name)
+            self.bump_variable(name)
+        
+        for key, value in staging.bot_config.items():
+            if key in RESTART_OPTIONS:
+                if self.bot_config.get(key) != value:
+                    print(f"⚠️  Параметр {key} применится только после перезапуска")
+            else:
+                self.bot_config[key] = value
+        for key in self.config_keys - staging.bot_config.keys():
+            if key in RESTART_OPTIONS:
+                print(f"⚠️  Параметр {key} применится только после перезапуска")
+            else:
+                self.bot_config.pop(key, None)
+        staging.remember_config_keys()
+        self.config_keys, self.declared_variables = staging.config_keys, staging.declared_variables
+        
+        print(f"🔄 Конфигурация перезагружена: обработчиков изменено {len(changed_handlers)}, "
+              f"удалено {len(removed_handlers)}; клавиатур изменено {len(changed_keyboards)}, "
+              f"удалено {len(removed_keyboards)}")
+    
+    async def watch_config(self):
+        """Слежение за файлом конфигурации и перезагрузка при изменении содержимого"""
+        interval = float(self.bot_config.get('reload_interval', 1))
+        # Подпись файла на момент загрузки: изменение до первой проверки тоже перезагружает конфигурацию
+        last_stat = self.config_signature
         
-        lines = content.split('\n')
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                stat = os.stat(self.config_path)
+            except OSError:
+                continue
+            
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if signature == last_stat:
+                continue
+            last_stat = signature
+            
+            # Разбор в отдельном потоке, применение - в event loop
+            staging = await asyncio.to_thread(self.parse_config, self.config_path)
+            if staging is not None and staging.config_hash != self.config_hash:
+                try:
+                    self.apply_config(staging)
+                except Exception as e:
+                    # Ошибка одной перезагрузки не останавливает слежение за файлом
+                    print(f"❌ Ошибка перезагрузки конфигурации: {e}")
+    
+    def _load_simple_config(self, content: str) -> bool:
+        """Загрузка SIMPLE конфигурации"""
+        # Конвертируем в унифицированный формат
+        self._convert_simple_to_unified(self._parse_simple_sections(content))
+        return True
+    
+    def _parse_simple_sections(self, content: str) -> dict:
+        """Секции SIMPLE конфигурации: {секция: {ключ: значение}} (один проход по строкам)"""
         current_section = None
         raw_config = {}
         
-        for line in lines:
-            line = line.strip()
+        # Состояние Python блока: python { ... }
+        python_head = None
+        python_lines = []
+        depth = 0
+        
+        for raw_line in io.StringIO(content):
+            raw_line = raw_line.rstrip('\r\n')
+            
+            if python_head is not None:
+                depth, end = scan_braces(raw_line, depth)
+                if end < 0:
+                    python_lines.append(raw_line)
+                    continue
+                
+                python_lines.append(raw_line[:end])
+                if current_section is not None:
+                    raw_config[current_section]['python'] = self._join_python_block(python_head, python_lines)
+                python_head = None
+                continue
+            
+            line = raw_line.strip()
             if not line or line.startswith('#'):
                 continue
                 
@@ -108,54 +2564,68 @@ class UnifiedBotInterpreter:
                 current_section = line[1:-1]
                 if current_section not in raw_config:
                     raw_config[current_section] = {}
+                continue
+            
+            block = SIMPLE_PYTHON_BLOCK.match(line)
+            if block:
+                rest = line[block.end():]
+                depth, end = scan_braces(rest, 1)
+                if end >= 0:
+                    # Однострочный блок: python { code }
+                    if current_section is not None:
+                        raw_config[current_section]['python'] = rest[:end].strip()
+                else:
+                    python_head = rest.strip()
+                    python_lines = []
             elif '=' in line and current_section:
                 key, value = line.split('=', 1)
                 raw_config[current_section][key.strip()] = value.strip()
         
-        # Конвертируем в унифицированный формат
-        self._convert_simple_to_unified(raw_config)
-        return True
+        return raw_config
     
-    def _load_yaml_config(self, file_path: str) -> bool:
+    def _join_python_block(self, head: str, lines: list) -> str:
+        """Код Python блока с нормализованными отступами"""
+        body = textwrap.dedent('\n'.join(lines)).strip('\n').rstrip()
+        if head:
+            return f"{head}\n{body}" if body else head
+        return body
+    
+    def _load_yaml_config(self, content: str) -> bool:
         """Загрузка YAML конфигурации"""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            raw_config = yaml.safe_load(f)
+        raw_config = yaml.safe_load(content)
         
         # Конвертируем в унифицированный формат
         self._convert_yaml_to_unified(raw_config)
         return True
     
-    def _parse_simple_python_blocks(self, content: str) -> str:
-        """Парсинг Python блоков в SIMPLE формате"""
-        def replace_python_block(match):
-            python_code = match.group(1)
-            lines = python_code.strip().split('\n')
-            cleaned_lines = [line.strip() for line in lines]
-            return f"python = {repr('\\n'.join(cleaned_lines))}"
-        
-        pattern = r'python\s*\{([^}]*)\}'
-        content = re.sub(pattern, replace_python_block, content, flags=re.DOTALL)
-        return content
+    def _simple_bot_config(self, section: dict) -> dict:
+        """Конфигурация бота из секции BOT"""
+        bot_config = {
+            'token': section.get('token', ''),
+            'name': section.get('name', 'ESYBOT Bot'),
+            'debug': section.get('debug', 'false').lower() == 'true'
+        }
+        for key in SIMPLE_BOT_OPTIONS:
+            if key in section:
+                bot_config[key] = self._parse_value(section[key])
+        return bot_config
     
     def _convert_simple_to_unified(self, raw_config: dict):
         """Конвертация SIMPLE конфигурации в унифицированный формат"""
         # Конфигурация бота
         if 'BOT' in raw_config:
-            self.bot_config = {
-                'token': raw_config['BOT'].get('token', ''),
-                'name': raw_config['BOT'].get('name', 'ESYBOT Bot'),
-                'debug': raw_config['BOT'].get('debug', 'false').lower() == 'true'
-            }
+            self.bot_config = self._simple_bot_config(raw_config['BOT'])
         
-        # Переменные
+        # Переменные (user.name / chat.name - переменные пользователя / чата)
         if 'VARS' in raw_config:
             for key, value in raw_config['VARS'].items():
-                self.variables[key] = self._parse_value(value)
+                scope, _, name = key.rpartition('.')
+                self.declare_variable(name, self._parse_value(value), scope or 'global')
         
         # Обработчики (включая START)
         for section_name, section_data in raw_config.items():
             if section_name not in ['BOT', 'VARS']:
-                self.handlers_config[section_name] = self._convert_simple_handler(section_data)
+                self.handlers_config[section_name] = self._convert_simple_handler(section_name, section_data)
                 
                 # Извлекаем клавиатуры из обработчиков
                 keyboard_config = self._extract_keyboard_from_simple_handler(section_data)
@@ -171,7 +2641,7 @@ class UnifiedBotInterpreter:
         # Переменные
         if 'variables' in raw_config:
             for var_config in raw_config['variables']:
-                self.variables[var_config['name']] = var_config.get('value', 0)
+                self.declare_variable(var_config['name'], var_config.get('value', 0), var_config.get('scope', 'global'))
         
         # Клавиатуры
         if 'keyboards' in raw_config:
@@ -183,7 +2653,73 @@ class UnifiedBotInterpreter:
             for handler_config in raw_config['handlers']:
                 self.handlers_config[handler_config['name']] = handler_config
     
-    def _convert_simple_handler(self, section_data: dict) -> dict:
+    def declare_variable(self, name: str, value: Any, scope: str = 'global'):
+        """Объявление переменной в нужной области видимости"""
+        if scope not in VARIABLE_SCOPES:
+            raise Exception(f"Неизвестная область видимости переменной {name}: {scope}")
+        
+        if scope == 'global':
+            self.variables[name] = value
+        else:
+            self.scoped_variables.declare(name, scope, value)
+    
+    def configure_variable_store(self):
+        """Настройка ограничений хранилища переменных пользователей и чатов"""
+        if self._custom_variable_backend:
+            return
+        
+        backend = self.scoped_variables.backend
+        backend.max_entries = int(self.bot_config.get('variables_max_entries', backend.max_entries))
+        backend.ttl = float(self.bot_config.get('variables_ttl', backend.ttl))
+    
+    def get_variable(self, name: str, context: dict, default: Any = None) -> Any:
+        """Значение переменной с учётом области видимости"""
+        if name in self.scoped_variables:
+            return self.scoped_variables.get(name, context)
+        return self.variables.get(name, default)
+    
+    def set_variable(self, name: str, value: Any, context: dict):
+        """Запись переменной с учётом области видимости"""
+        if name in self.scoped_variables:
+            self.scoped_variables.set(name, value, context)
+            if self.journal is not None:
+                self.journal.record(JOURNAL_SCOPED, self.scoped_variables.key(name, context), name, value)
+        else:
+            self.variables[name] = value
+            self.bump_variable(name)
+            if self.journal is not None:
+                self.journal.record(JOURNAL_VARIABLE, None, name, value)
+    
+    def bump_variable(self, name: str):
+        """Новая версия переменной: кэшированные ответы, которые её читают, устаревают"""
+        versions = self.variable_versions
+        versions[name] = versions.get(name, 0) + 1
+    
+    def variable_lock_keys(self, names: tuple, context: dict) -> list:
+        """Ключи блокировок: переменные пользователя/чата блокируются только для своего владельца"""
+        scoped = self.scoped_variables
+        return sorted(
+            (name,) + scoped.key(name, context) if name in scoped else (name,)
+            for name in names
+        )
+    
+    def increment_variable(self, name: str, delta, context: dict):
+        """Изменение числовой переменной одним шагом (атомарно и в общем состоянии)"""
+        if name in self.scoped_variables:
+            value = self.scoped_variables.increment(name, delta, context)
+            if self.journal is not None:
+                self.journal.record(JOURNAL_SCOPED, self.scoped_variables.key(name, context), name, value)
+            return value
+        if isinstance(self.variables, SharedVariables):
+            return self.variables.increment(name, delta, 0)
+        value = self.variables.get(name, 0) + delta
+        self.variables[name] = value
+        self.bump_variable(name)
+        if self.journal is not None:
+            self.journal.record(JOURNAL_VARIABLE, None, name, value)
+        return value
+    
+    def _convert_simple_handler(self, section_name: str, section_data: dict) -> dict:
         """Конвертация SIMPLE обработчика в унифицированный формат"""
         handler = {
             'effects': [],
@@ -197,7 +2733,7 @@ class UnifiedBotInterpreter:
             handler['effects'].append({
                 'send': {
                     'text': section_data['text'],
-                    'keyboard': f"{list(self.handlers_config.keys())[-1] if self.handlers_config else 'default'}_keyboard"
+                    'keyboard': f"{section_name}_keyboard"
                 }
             })
         
@@ -217,6 +2753,25 @@ class UnifiedBotInterpreter:
                     }
                 })
         
+        # Текстовые триггеры: exact/keyword - варианты через |, regex - одно выражение целиком
+        triggers = [
+            {kind: [part.strip() for part in section_data[kind].split('|')] if kind != 'regex' else section_data[kind]}
+            for kind in TRIGGER_KINDS if kind in section_data
+        ]
+        if triggers:
+            handler['triggers'] = triggers
+        
+        # Рассылка: broadcast = переменная со списком чатов | текст
+        if 'broadcast' in section_data:
+            audience, _, text = section_data['broadcast'].partition('|')
+            handler['effects'].append({'broadcast': {'audience': audience.strip(), 'text': text.strip()}})
+        
+        # Загрузка файла медиа обработчика: download = true или каталог
+        if 'download' in section_data:
+            download = section_data['download'].strip()
+            if download.lower() not in ('false', 'no', '0', ''):
+                handler['download'] = True if download.lower() in ('true', 'yes', '1') else {'dir': download}
+        
         # Else эффекты
         if 'else_text' in section_data:
             handler['else_effects'].append({
@@ -283,285 +2838,1897 @@ class UnifiedBotInterpreter:
         
         return value
     
+    def build_keyboard(self, kb_config: dict, lookup=None):
+        """Построение одной клавиатуры (lookup - подстановка переменных в кнопки)"""
+        return build_keyboard_markup(kb_config, lookup)
+    
+    def build_static_keyboard(self, kb_config: dict):
+        """Статическая клавиатура: одинаковые конфигурации разных ботов дают один объект"""
+        return compile_static_keyboard(json.dumps(kb_config, sort_keys=True, ensure_ascii=False, default=str))
+    
     def build_keyboards(self):
-        """Построение всех клавиатур"""
+        """Построение всех статических клавиатур заранее (обычно они строятся при первом использовании)"""
         for kb_name, kb_config in self.keyboards_config.items():
-            if kb_config.get('type') == 'inline':
-                builder = InlineKeyboardBuilder()
-                for button in kb_config.get('buttons', []):
-                    if 'url' in button:
-                        builder.button(text=button['text'], url=button['url'])
-                    else:
-                        builder.button(text=button['text'], callback_data=button.get('callback_data', 'unknown'))
-                self.keyboards[kb_name] = builder.as_markup()
+            if kb_name in self.keyboards or self.keyboard_variables.get(kb_name):
+                continue
+            markup = self.build_static_keyboard(kb_config)
+            if markup is not None:
+                self.keyboards[kb_name] = markup
+    
+    def compile_keyboards(self, keyboards_config: dict = None, apply: bool = True) -> dict:
+        """Переменные, от которых зависит каждая клавиатура (пусто - статическая)"""
+        keyboards_config = self.keyboards_config if keyboards_config is None else keyboards_config
+        keyboard_variables = {}
+        
+        for kb_name, kb_config in keyboards_config.items():
+            names = set()
+            for button in kb_config.get('buttons', []):
+                for key in KEYBOARD_TEMPLATE_FIELDS:
+                    if key in button:
+                        names.update(compile_template(str(button[key])).names)
+            keyboard_variables[kb_name] = frozenset(names)
+        
+        if apply:
+            self.keyboard_variables = keyboard_variables
+        return keyboard_variables
+    
+    def get_keyboard(self, kb_name: str, context: dict):
+        """Клавиатура по имени: статические строятся один раз, динамические - по значениям переменных"""
+        markup = self.keyboards.get(kb_name)
+        if markup is not None:
+            return markup
+        
+        kb_config = self.keyboards_config.get(kb_name)
+        if kb_config is None:
+            return None
+        
+        names = self.keyboard_variables.get(kb_name)
+        if names is None:
+            names = self.compile_keyboards({kb_name: kb_config}, apply=False)[kb_name]
+        
+        if not names:
+            markup = self.build_static_keyboard(kb_config)
+            if markup is not None:
+                self.keyboards[kb_name] = markup
+            return markup
+        
+        # Динамическая клавиатура: ключ кэша - значения переменных, которые она использует
+        lookup = self.make_lookup(context)
+        values = []
+        for name in sorted(names):
+            value = lookup(name)
+            values.append(None if value is MISSING else str(value))
+        key = (kb_name, tuple(values))
+        
+        markup = self._keyboard_cache.get(key)
+        if markup is not None:
+            self._keyboard_cache.move_to_end(key)
+            return markup
+        
+        markup = self.build_keyboard(kb_config, lookup)
+        self._keyboard_cache[key] = markup
+        if len(self._keyboard_cache) > KEYBOARD_CACHE_SIZE:
+            self._keyboard_cache.popitem(last=False)
+        return markup
+    
+    def compile_handler(self, handler_name: str, handler_config: dict) -> dict:
+        """Компиляция шаблонов, условия и Python блока одного обработчика"""
+        compiled = {'templates': {}, 'conditions': {}, 'code_objects': {}}
+        
+        for effect in (handler_config.get('effects') or []) + (handler_config.get('else_effects') or []):
+            if not isinstance(effect, dict):
+                continue
+            for key in ('send', 'edit', 'broadcast'):
+                if isinstance(effect.get(key), dict) and effect[key].get('text'):
+                    text = str(effect[key]['text'])
+                    compiled['templates'][text] = compile_template(text)
+            if isinstance(effect.get('set'), dict) and 'value' in effect['set']:
+                text = str(effect['set']['value'])
+                compiled['templates'][text] = compile_template(text)
+        
+        python_code = handler_config.get('python')
+        if python_code:
+            try:
+                compiled['code_objects'][python_code] = compile_python(python_code)
+            except SyntaxError as e:
+                print(f"❌ Python ошибка в обработчике {handler_name}: {e}")
+        
+        condition = handler_config.get('condition')
+        if condition:
+            try:
+                compiled['conditions'][condition] = compile_condition(str(condition))
+            except SyntaxError as e:
+                print(f"❌ Ошибка условия в обработчике {handler_name}: {e}")
+        
+        return compiled
+    
+    def compile_handlers(self, handlers_config: dict = None, changed: set = None, apply: bool = True,
+                         debug: bool = None) -> dict:
+        """Предварительная компиляция обработчиков
+        
+        changed - имена изменённых обработчиков, остальные берутся из прошлой компиляции
+        (None - компилировать все). debug - режим отладки для шагов эффектов
+        (по умолчанию из текущей конфигурации).
+        """
+        handlers_config = self.handlers_config if handlers_config is None else handlers_config
+        debug = bool(self.bot_config.get('debug') if debug is None else debug)
+        
+        handlers = {}
+        pipelines = {}
+        for handler_name, handler_config in handlers_config.items():
+            if changed is not None and handler_name not in changed and handler_name in self._compiled_handlers:
+                handlers[handler_name] = self._compiled_handlers[handler_name]
+                pipeline = self.pipelines.get(handler_name)
+                if pipeline is not None and pipeline.debug == debug:
+                    pipelines[handler_name] = pipeline
+                    continue
+            else:
+                handlers[handler_name] = self.compile_handler(handler_name, handler_config)
+            pipelines[handler_name] = self.build_pipeline(handler_name, handler_config, handlers[handler_name], debug)
+        
+        compiled = {'handlers': handlers, 'pipelines': pipelines, 'templates': {}, 'conditions': {}, 'code_objects': {}}
+        for handler in handlers.values():
+            compiled['templates'].update(handler['templates'])
+            compiled['conditions'].update(handler['conditions'])
+            compiled['code_objects'].update(handler['code_objects'])
+        
+        if apply:
+            self._apply_compiled(compiled)
+        return compiled
+    
+    def _apply_compiled(self, compiled: dict):
+        self._compiled_handlers = compiled['handlers']
+        self.pipelines = compiled['pipelines']
+        # Обработчики или клавиатуры изменились - зависимости и ответы вычисляются заново
+        self._memo_plans = {}
+        self._memo = OrderedDict()
+        self.templates = compiled['templates']
+        self.conditions = compiled['conditions']
+        self.code_objects = compiled['code_objects']
+    
+    def share_compiled(self, assets: dict):
+        """Замена скомпилированных шаблонов, условий и Python блоков общими экземплярами
+        
+        assets - общий словарь {вид: {исходный текст: объект}} нескольких ботов:
+        одинаковые тексты разных ботов после вызова ссылаются на один объект.
+        """
+        for handler in self._compiled_handlers.values():
+            for kind in ('templates', 'conditions', 'code_objects'):
+                shared = assets.setdefault(kind, {})
+                own = handler[kind]
+                for source, compiled in own.items():
+                    own[source] = shared.setdefault(source, compiled)
+        # Шаги эффектов пересобираются с общими шаблонами
+        self.pipelines = {}
+        self.compile_handlers(changed=set())
+    
+    def build_pipeline(self, handler_name: str, handler_config: dict, compiled: dict, debug: bool) -> HandlerPipeline:
+        """Сборка обработчика из скомпилированных частей"""
+        condition = handler_config.get('condition')
+        effects = handler_config.get('effects') or []
+        else_effects = handler_config.get('else_effects') or []
+        
+        writes = set()
+        reads = set()
+        keyboards = set()
+        actions = False
+        for effect in effects + else_effects:
+            if isinstance(effect, dict):
+                for key in ('increment', 'decrement'):
+                    if key in effect:
+                        writes.add(str(effect[key]))
+                if isinstance(effect.get('set'), dict) and 'variable' in effect['set']:
+                    writes.add(str(effect['set']['variable']))
+                if 'broadcast' in effect:
+                    # Рассылка - действие, а не только ответ: обработчик не кэшируется
+                    actions = True
+                for key in ('send', 'edit'):
+                    if isinstance(effect.get(key), dict):
+                        text = effect[key].get('text')
+                        if text:
+                            reads.update(compiled['templates'][str(text)].names)
+                        if effect[key].get('keyboard'):
+                            keyboards.add(effect[key]['keyboard'])
+        
+        # Ответ чистого обработчика зависит только от прочитанных переменных
+        pure = not handler_config.get('python') and not writes and not actions and (not condition or condition in compiled['conditions'])
+        if pure and condition:
+            reads.update(compiled['conditions'][condition].names)
+        
+        return HandlerPipeline(
+            handler_name,
+            handler_config.get('python') or '',
+            condition if condition else None,
+            self.compile_effects(effects, compiled['templates'], debug),
+            self.compile_effects(else_effects, compiled['templates'], debug),
+            tuple(sorted(writes)),
+            frozenset(reads) if pure else None,
+            tuple(sorted(keyboards)),
+            debug
+        )
+    
+    def memo_plan(self, pipeline: HandlerPipeline):
+        """Зависимости ответа чистого обработчика или None, если ответ не кэшируется
+        
+        Возвращает (переменные контекста, переменные пользователя/чата, остальные):
+        первые два вида входят в ключ кэша значениями, остальные - номерами версий,
+        которые растут при каждой записи. Переменные даты и общее состояние рабочих
+        процессов (изменения других процессов не видны) исключают кэширование.
+        """
+        plan = self._memo_plans.get(pipeline.name, MISSING)
+        if plan is not MISSING:
+            return plan
+        
+        plan = None
+        if pipeline.reads is not None and not pipeline.debug and not self._custom_variable_backend:
+            names = set(pipeline.reads)
+            for kb_name in pipeline.keyboards:
+                kb_names = self.keyboard_variables.get(kb_name)
+                if kb_names is None and kb_name in self.keyboards_config:
+                    kb_names = self.compile_keyboards({kb_name: self.keyboards_config[kb_name]}, apply=False)[kb_name]
+                names.update(kb_names or ())
+            
+            if not names & DATE_VARIABLES.keys():
+                context_names = sorted(name for name in names if name in CONTEXT_VARIABLES)
+                scoped_names = sorted(name for name in names if name not in CONTEXT_VARIABLES and name in self.scoped_variables)
+                other_names = sorted(names.difference(context_names, scoped_names))
+                plan = (tuple(context_names), tuple(scoped_names), tuple(other_names))
+        
+        self._memo_plans[pipeline.name] = plan
+        return plan
+    
+    def memo_key(self, pipeline: HandlerPipeline, plan: tuple, context: dict):
+        """Ключ кэша ответа; None, если значения переменных нехэшируемые"""
+        context_names, scoped_names, other_names = plan
+        key = [pipeline.name]
+        for name in context_names:
+            key.append(context.get(name, CONTEXT_VARIABLES[name]))
+        for name in scoped_names:
+            key.append(self.scoped_variables.get(name, context))
+        versions = self.variable_versions
+        for name in other_names:
+            key.append(versions.get(name, 0))
+        key = tuple(key)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+    
+    def compile_effects(self, effects: list, templates: dict = None, debug: bool = False) -> tuple:
+        """Список эффектов -> кортеж шагов step(context, result)
+        
+        Тип эффекта определяется один раз при компиляции, а не на каждом обновлении.
+        """
+        templates = self.templates if templates is None else templates
+        steps = []
+        for effect in effects:
+            if not isinstance(effect, dict):
+                continue
+            if 'send' in effect:
+                steps.append(self._compile_message_step(effect['send'], templates))
+            elif 'edit' in effect:
+                steps.append(self._compile_message_step(effect['edit'], templates))
+            elif 'increment' in effect:
+                steps.append(self._compile_increment_step(effect['increment'], 1, '📈', debug))
+            elif 'decrement' in effect:
+                steps.append(self._compile_increment_step(effect['decrement'], -1, '📉', debug))
+            elif 'set' in effect:
+                steps.append(self._compile_set_step(effect['set'], templates, debug))
+            elif 'broadcast' in effect:
+                steps.append(self._compile_broadcast_step(effect['broadcast'], templates))
+        return tuple(steps)
+    
+    @staticmethod
+    def _template_render(text: str, templates: dict):
+        """Метод render шаблона или None, если в тексте нет переменных"""
+        template = templates.get(text) or compile_template(text)
+        return template.render if template.names else None
+    
+    def _compile_message_step(self, config: dict, templates: dict):
+        text = config.get('text', '')
+        text = str(text) if text else ''
+        render = self._template_render(text, templates) if text else None
+        keyboard_name = config.get('keyboard')
+        make_lookup = self.make_lookup
+        get_keyboard = self.get_keyboard
+        
+        if not keyboard_name:
+            if render is None:
+                def text_step(context: dict, result: dict):
+                    result['text'] = text
+            else:
+                def text_step(context: dict, result: dict):
+                    result['text'] = render(make_lookup(context))
+            return text_step
+        
+        def message_step(context: dict, result: dict):
+            result['text'] = render(make_lookup(context)) if render is not None else text
+            keyboard = get_keyboard(keyboard_name, context)
+            if keyboard is not None:
+                result['keyboard'] = keyboard
+        
+        return message_step
+    
+    def _compile_increment_step(self, var_name: str, delta: int, icon: str, debug: bool):
+        increment_variable = self.increment_variable
+        
+        def increment_step(context: dict, result: dict):
+            value = increment_variable(var_name, delta, context)
+            if debug:
+                log.debug("%s %s = %r", icon, var_name, value)
+        
+        return increment_step
+    
+    def _compile_set_step(self, config: dict, templates: dict, debug: bool):
+        var_name = config['variable']
+        text = str(config['value'])
+        render = self._template_render(text, templates)
+        make_lookup = self.make_lookup
+        parse_value = self._parse_value
+        set_variable = self.set_variable
+        # Значение без переменных разбирается один раз (результат - неизменяемый скаляр)
+        constant = parse_value(text) if render is None else None
+        
+        def set_step(context: dict, result: dict):
+            value = parse_value(render(make_lookup(context))) if render is not None else constant
+            set_variable(var_name, value, context)
+            if debug:
+                log.debug("📝 %s = %r", var_name, value)
+        
+        return set_step
+    
+    def _compile_broadcast_step(self, config: dict, templates: dict):
+        """Рассылка: текст и клавиатура отрисовываются один раз, получатели - снимок переменной audience"""
+        message_step = self._compile_message_step(config, templates)
+        audience = config.get('audience', 'subscribers')
+        name = str(config.get('name') or audience)
+        report = config.get('report', True)
+        make_lookup = self.make_lookup
+        
+        def broadcast_step(context: dict, result: dict):
+            chats = audience if isinstance(audience, list) else make_lookup(context)(str(audience))
+            message = {'text': '', 'keyboard': None}
+            message_step(context, message)
+            result.setdefault('broadcasts', []).append({
+                'name': name,
+                'chats': chats,
+                'text': message['text'],
+                'keyboard': message['keyboard'],
+                'report_chat': context.get('chat_id') if report else None,
+            })
+        
+        return broadcast_step
+    
+    def get_template(self, text: str) -> Template:
+        """Скомпилированный шаблон для текста"""
+        template = self.templates.get(text)
+        if template is None:
+            template = compile_template(text)
+        return template
+    
+    def make_lookup(self, context: dict):
+        """Функция разрешения имён переменных для рендеринга шаблонов
+        
+        В рабочих процессах (общее состояние) переменные читаются не по одной,
+        а одним снимком на функцию - один вызов менеджера вместо вызова на имя.
+        """
+        now = None
+        shared = isinstance(self.variables, SharedVariables)
+        scoped_values = None
+        global_values = None
+        
+        def lookup(name: str) -> Any:
+            nonlocal now, scoped_values, global_values
+            # Системные переменные имеют приоритет
+            if name in CONTEXT_VARIABLES:
+                return context.get(name, CONTEXT_VARIABLES[name])
+            if name in DATE_VARIABLES:
+                if now is None:
+                    now = datetime.datetime.now()
+                return now.strftime(DATE_VARIABLES[name])
+            if name in self.scoped_variables:
+                if not shared:
+                    return self.scoped_variables.get(name, context)
+                if scoped_values is None:
+                    scoped_values = self.scoped_variables.values(context)
+                return scoped_values[name]
+            if shared:
+                if global_values is None:
+                    global_values = self.variables.state.globals_view()
+                return global_values.get(name, MISSING)
+            value = self.python_globals.get(name, MISSING)
+            if value is not MISSING:
+                return value
+            return self.variables.get(name, MISSING)
+        
+        return lookup
+    
+    def replace_variables(self, text: str, context: dict = {}) -> str:
+        """Замена переменных в тексте"""
+        if not text:
+            return text
+        
+        template = self.get_template(text)
+        if not template.names:
+            return text
+        
+        return template.render(self.make_lookup(context))
+    
+    def python_namespace(self, context: dict):
+        """Пространство имён для Python блока и снимок переменных до выполнения
+        
+        Снимок глобальных переменных берётся одним вызовом copy() - это важно
+        для общего состояния рабочих процессов (SharedVariables).
+        """
+        scoped_values = self.scoped_variables.values(context)
+        global_values = self.variables.copy()
+        python_values = self.python_globals.copy()
+        local_vars = {**global_values, **scoped_values, **context, **python_values}
+        return local_vars, (scoped_values, global_values, python_values)
+    
+    def merge_python_vars(self, local_vars: dict, context: dict, before: tuple):
+        """Сохранение изменённых переменных после выполнения Python блока"""
+        scoped_values, global_values, python_values = before
+        journal = self.journal
+        for key, value in local_vars.items():
+            # Изменяемые контейнеры могли измениться на месте - записываем всегда
+            if key in scoped_values:
+                if value is not scoped_values[key] or isinstance(value, MUTABLE_TYPES):
+                    self.scoped_variables.set(key, value, context)
+                    if journal is not None:
+                        journal.record(JOURNAL_SCOPED, self.scoped_variables.key(key, context), key, value)
+            elif key in global_values:
+                if value is not global_values[key] or isinstance(value, MUTABLE_TYPES):
+                    self.variables[key] = value
+                    self.bump_variable(key)
+                    if journal is not None:
+                        journal.record(JOURNAL_VARIABLE, None, key, value)
+            elif not key.startswith('_') and key not in context:
+                if value is not python_values.get(key, MISSING) or isinstance(value, MUTABLE_TYPES):
+                    self.python_globals[key] = value
+                    self.bump_variable(key)
+                    if journal is not None:
+                        journal.record(JOURNAL_PYTHON, None, key, value)
+                    if self.bot_config.get('debug'):
+                        log.debug("   ✅ Переменная: %s = %r", key, value)
+    
+    def execute_python(self, code: str, context: dict = {}, handler_name: str = None):
+        """Выполнение Python кода (handler_name - для счётчика ошибок)"""
+        if not code:
+            return
+        
+        try:
+            local_vars, before = self.python_namespace(context)
+            
+            if self.bot_config.get('debug'):
+                log.debug("🐍 Выполняется Python код:\n%s", CodeListing(code))
+            
+            code_object = self.code_objects.get(code)
+            if code_object is None:
+                code_object = compile_python(code)
+            
+            exec(code_object, {}, local_vars)
+            
+            # Сохраняем переменные
+            self.merge_python_vars(local_vars, context, before)
+        
+        except Exception as e:
+            self.metrics.error(handler_name, 'python')
+            log.error("❌ Python ошибка: %s", e)
+    
+    def start_python_executor(self):
+        """Создание пула для Python блоков согласно config.python_executor"""
+        mode = self.bot_config.get('python_executor', 'inline')
+        if mode not in PYTHON_EXECUTORS:
+            raise Exception(f"Неизвестный режим python_executor: {mode}")
+        if mode == 'inline' or self.python_executor is not None:
+            return
+        
+        workers = int(self.bot_config.get('python_workers', 4))
+        if mode == 'thread':
+            print("⚠️  python_executor: thread - по python_timeout блок не останавливается и занимает поток "
+                  "до завершения; для жёсткого лимита времени используйте process")
+            self.python_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='esybot-python'
+            )
+        else:
+            self.python_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_python_worker,
+                initargs=(int(self.bot_config.get('python_memory_limit', 0)),)
+            )
+        self._python_slots = asyncio.Semaphore(workers)
+    
+    def stop_python_executor(self):
+        """Остановка пула Python блоков"""
+        if self.python_executor is not None:
+            self.python_executor.shutdown(wait=False, cancel_futures=True)
+            self.python_executor = None
+            self._python_slots = None
+    
+    async def execute_python_async(self, code: str, context: dict = {}, handler_name: str = None):
+        """Выполнение Python кода без блокировки event loop
+        
+        В режимах thread/process код выполняется в пуле с таймаутом, а изменённые
+        переменные применяются в event loop одним шагом. Переменные, которые блок
+        изменяет, на это время блокируются планировщиком: параллельные блоки и
+        эффекты других чатов не теряют обновления.
+        """
+        if not code:
+            return
+        shared = isinstance(self.variables, SharedVariables)
+        if self.python_executor is None and not shared:
+            self.execute_python(code, context, handler_name)
+            return
+        
+        timeout = float(self.bot_config.get('python_timeout', 5))
+        cpu_limit = float(self.bot_config.get('python_cpu_limit', 0))
+        
+        # Снимок -> выполнение в пуле -> запись: изменяемые блоком переменные заблокированы
+        # (в режиме workers - ещё и в общем состоянии, от блоков других процессов)
+        keys = self.variable_lock_keys(python_writes(code), context)
+        if self.scheduler is not None:
+            locked = self.scheduler.locked(keys)
+        else:
+            locked = contextlib.nullcontext()
+        shared_locked = self.shared_locked(keys, timeout) if shared else contextlib.nullcontext()
+        async with locked, shared_locked:
+            if self.python_executor is None:
+                self.execute_python(code, context, handler_name)
+                return
+            await self._execute_python_pool(code, context, handler_name, timeout, cpu_limit)
+    
+    @contextlib.asynccontextmanager
+    async def shared_locked(self, keys: list, timeout: float):
+        """Блокировка переменных в общем состоянии рабочих процессов (ожидание - без блокировки event loop)"""
+        state = self.variables.state
+        owner = f"{os.getpid()}-{os.urandom(8).hex()}"
+        # Срок блокировки - с запасом на таймаут блока: блокировку упавшего процесса снимет время
+        lease = (timeout or 60) + 5
+        while keys and not state.try_lock(keys, owner, lease):
+            await asyncio.sleep(SHARED_LOCK_POLL)
+        try:
+            yield
+        finally:
+            if keys:
+                with contextlib.suppress(Exception):
+                    state.unlock(keys, owner)
+    
+    async def _execute_python_pool(self, code: str, context: dict, handler_name: str, timeout: float, cpu_limit: float):
+        """Python блок в пуле потоков/процессов, изменённые переменные - в event loop одним шагом
+        
+        Слот пула освобождается, когда блок действительно завершился, а не по
+        таймауту: в режиме thread блок, переживший таймаут, продолжает занимать
+        поток. Ожидание свободного слота тоже ограничено python_timeout.
+        """
+        slots = self._python_slots
+        try:
+            await asyncio.wait_for(slots.acquire(), timeout or None)
+        except asyncio.TimeoutError:
+            self.metrics.error(handler_name, 'python')
+            log.error("❌ Python ошибка: все %s потоков/процессов пула заняты дольше %s с",
+                      self.bot_config.get('python_workers', 4), timeout)
+            return
+        
+        released = False
+        try:
+            local_vars, before = self.python_namespace(context)
+            
+            if self.bot_config.get('debug'):
+                log.debug("🐍 Выполняется Python код:\n%s", CodeListing(code))
+            
+            # По таймауту результат не применяется; прервать блок может только
+            # режим process (сигнал в рабочем процессе), поток доработает сам
+            future = asyncio.get_running_loop().run_in_executor(
+                self.python_executor, run_python_snippet, code, local_vars, timeout, cpu_limit
+            )
+            future.add_done_callback(functools.partial(self._python_block_done, slots))
+            released = True
+            changed = await asyncio.wait_for(asyncio.shield(future), timeout or None)
             
-            elif kb_config.get('type') == 'reply':
-                builder = ReplyKeyboardBuilder()
-                for button in kb_config.get('buttons', []):
-                    builder.button(text=button['text'])
-                self.keyboards[kb_name] = builder.as_markup(
-                    resize_keyboard=kb_config.get('resize', True),
-                    one_time_keyboard=kb_config.get('one_time', False)
-                )
+            self.merge_python_vars(changed, context, before)
+        
+        except asyncio.TimeoutError:
+            self.metrics.error(handler_name, 'python')
+            log.error("❌ Python ошибка: превышен лимит времени %s с", timeout)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            # Рабочий процесс упал (например, по лимиту памяти) - пересоздаём пул
+            self.metrics.error(handler_name, 'python')
+            log.error("❌ Python ошибка: %s", e)
+            self.stop_python_executor()
+            self.start_python_executor()
+        except Exception as e:
+            self.metrics.error(handler_name, 'python')
+            log.error("❌ Python ошибка: %s", e)
+        finally:
+            if not released:
+                slots.release()
+    
+    @staticmethod
+    def _python_block_done(slots: asyncio.Semaphore, future: asyncio.Future):
+        """Блок в пуле завершился: слот свободен (ошибка брошенного по таймауту блока уже учтена)"""
+        slots.release()
+        if not future.cancelled():
+            future.exception()
+    
+    def process_effects(self, effects: list, context: dict = {}) -> dict:
+        """Обработка списка эффектов (для обработчиков используются заранее скомпилированные шаги)"""
+        return self.run_steps(self.compile_effects(effects, debug=self.bot_config.get('debug')), context)
+    
+    @staticmethod
+    def run_steps(steps: tuple, context: dict) -> dict:
+        """Выполнение скомпилированных шагов эффектов"""
+        result = {'text': '', 'keyboard': None, 'reply': 'OK'}
+        for step in steps:
+            step(context, result)
+        return result
+    
+    async def run_pipeline(self, pipeline: HandlerPipeline, context: dict):
+        """Python блок -> условие -> эффекты; None, если эффектов нет и отвечать нечего
+        
+        Ответ чистого обработчика берётся из кэша, пока не изменилась ни одна
+        из переменных, которые он читает.
+        """
+        self.metrics.call(pipeline.name)
+        if not self.memo_size or pipeline.reads is None:
+            return await self._run_pipeline(pipeline, context)
+        
+        plan = self.memo_plan(pipeline)
+        key = self.memo_key(pipeline, plan, context) if plan is not None else None
+        if key is None:
+            return await self._run_pipeline(pipeline, context)
+        
+        memo = self._memo
+        result = memo.get(key, MISSING)
+        if result is not MISSING:
+            memo.move_to_end(key)
+            self.memo_hits += 1
+            return result
+        
+        self.memo_misses += 1
+        result = await self._run_pipeline(pipeline, context)
+        memo[key] = result
+        if len(memo) > self.memo_size:
+            memo.popitem(last=False)
+        return result
     
-    def replace_variables(self, text: str, context: dict = {}) -> str:
-        """Замена переменных в тексте"""
-        if not text:
-            return text
+    async def _run_pipeline(self, pipeline: HandlerPipeline, context: dict):
+        metrics = self.metrics
+        handler_name = pipeline.name
         
-        # Системные переменные
-        now = datetime.datetime.now()
-        system_vars = {
-            'user_id': context.get('user_id', 0),
-            'chat_id': context.get('chat_id', 0),
-            'first_name': context.get('first_name', ''),
-            'username': context.get('username', ''),
-            'text': context.get('text', ''),
-            'date': now.strftime('%Y-%m-%d'),
-            'time': now.strftime('%H:%M:%S'),
-            'datetime': now.strftime('%Y-%m-%d %H:%M:%S'),
-        }
+        if pipeline.python:
+            with metrics.phase(handler_name, 'python'):
+                await self.execute_python_async(pipeline.python, context, handler_name)
         
-        # Все переменные
-        all_vars = {**self.variables, **self.python_globals, **system_vars}
+        steps = pipeline.effects
+        if pipeline.condition is not None:
+            with metrics.phase(handler_name, 'condition'):
+                passed = self.check_condition(pipeline.condition, context, handler_name)
+            if not passed:
+                steps = pipeline.else_effects
+        
+        if not steps:
+            return None
+        scheduler = self.scheduler
+        if scheduler is not None and scheduler.held_locks and pipeline.writes:
+            # Python блок в пуле держит блокировки - изменения переменных ждут его записи
+            async with scheduler.locked(self.variable_lock_keys(pipeline.writes, context)):
+                with metrics.phase(handler_name, 'effects'):
+                    return self.run_steps(steps, context)
+        with metrics.phase(handler_name, 'effects'):
+            return self.run_steps(steps, context)
+    
+    async def run_handler(self, handler_name: str, event, context: dict):
+        """Общий путь обработки для всех типов обновлений
         
-        for var_name, var_value in all_vars.items():
-            text = text.replace(f'${{{var_name}}}', str(var_value))
-            text = text.replace(f'${var_name}', str(var_value))
+        Сообщения получают ответ новым сообщением, нажатия кнопок - редактированием
+        сообщения с кнопкой и ответом на callback.
+        """
+        pipeline = self.pipelines.get(handler_name)
+        if pipeline is None:
+            return
+        result = await self.run_pipeline(pipeline, context)
+        if result is None:
+            return
+        for request in result.get('broadcasts', ()):
+            self.start_broadcast(event.bot, request)
         
-        return text
+        if isinstance(event, CallbackQuery):
+            with self.metrics.phase(handler_name, 'send'):
+                # Ответ ставится раньше редактирования и не ждёт очереди чата
+                answer = self.send_callback_answer(event, result['reply'])
+                if result['text']:
+                    await asyncio.gather(answer, self.send_edit(event, result))
+                else:
+                    await answer
+        elif result['text']:
+            with self.metrics.phase(handler_name, 'send'):
+                await self.send_message(event, result)
     
-    def execute_python(self, code: str, context: dict = {}):
-        """Выполнение Python кода"""
-        if not code:
+    async def fetch_media(self, bot: Bot, handler_name: str, content_type: str, download, context: dict):
+        """Потоковая загрузка файла медиа обработчика, путь - в $file_path
+        
+        download: true - в каталог config.media_dir, {dir: каталог} - в свой каталог,
+        {python: код} - части файла по очереди передаются в код (chunk, chunk_offset).
+        Память не зависит от размера файла: он читается частями media_chunk_size и
+        пишется во временный .part. Одновременно идёт не больше media_concurrency
+        загрузок, и на время загрузки слот планировщика отдаётся другим чатам.
+        Повторно присланный файл (тот же file_unique_id) не загружается ($file_cached),
+        если у загрузки нет кода download.python.
+        """
+        options = download if isinstance(download, dict) else {}
+        chunk_code = options.get('python')
+        target = None
+        if options.get('dir') or not chunk_code:
+            target = self.config_relative_path(options.get('dir') or self.bot_config.get('media_dir', 'downloads'))
+            suffix = Path(context['file_name']).suffix or MEDIA_SUFFIXES.get(content_type, '')
+            target = target / f"{context['file_unique_id']}{suffix}"
+        
+        max_size = int(self.bot_config.get('media_max_size', 0))
+        if max_size and context['file_size'] > max_size:
+            log.warning("⚠️  %s: файл %s (%s байт) больше media_max_size, не загружается",
+                        handler_name, context['file_id'], context['file_size'])
             return
         
-        try:
-            local_vars = {**self.variables, **context, **self.python_globals}
-            
-            if self.bot_config.get('debug'):
-                print(f"🐍 Выполняется Python код:")
-                for i, line in enumerate(code.split('\n'), 1):
-                    if line.strip():
-                        print(f"   {i}: {line}")
-            
-            exec(code, {}, local_vars)
+        # С кодом download.python результат загрузки - ещё и имена, которые создаёт код:
+        # такой файл обрабатывается каждый раз заново
+        dedup = self.bot_config.get('media_dedup', True) and not chunk_code
+        key = (handler_name, context['file_unique_id'])
+        if dedup:
+            path = self._media_cache.get(key)
+            if path is None and target.exists():
+                path = str(target)
+            if path is not None and os.path.exists(path):
+                self._remember_media(key, path)
+                context['file_path'], context['file_cached'] = path, True
+                return
+        
+        released = self.scheduler.released() if self.scheduler is not None else contextlib.nullcontext()
+        async with released:
+            pending = self._media_downloads.get(key) if dedup else None
+            if pending is not None:
+                # Тот же файл уже загружается по другому обновлению - ждём его
+                path = await asyncio.shield(pending)
+                if path is not None:
+                    context['file_path'], context['file_cached'] = path, True
+                return
             
-            # Сохраняем переменные
-            for key, value in local_vars.items():
-                if key in self.variables:
-                    self.variables[key] = value
-                elif not key.startswith('_') and key not in context:
-                    self.python_globals[key] = value
-                    if self.bot_config.get('debug'):
-                        print(f"   ✅ Переменная: {key} = {value}")
+            future = asyncio.get_running_loop().create_future()
+            if dedup:
+                self._media_downloads[key] = future
+            path = None
+            try:
+                async with self._media_slots or contextlib.nullcontext():
+                    path = await self._download_media(bot, context, target, chunk_code, max_size)
+            except Exception as e:
+                self.metrics.error(handler_name, 'download')
+                log.error("❌ Ошибка загрузки файла %s: %s", context['file_id'], e)
+            finally:
+                future.set_result(path)
+                if dedup:
+                    self._media_downloads.pop(key, None)
         
-        except Exception as e:
-            print(f"❌ Python ошибка: {e}")
+        if path is not None:
+            context['file_path'] = path
+            if dedup:
+                self._remember_media(key, path)
     
-    def process_effects(self, effects: list, context: dict = {}) -> dict:
-        """Обработка списка эффектов"""
-        result = {'text': '', 'keyboard': None, 'reply': 'OK'}
+    async def _download_media(self, bot: Bot, context: dict, target, chunk_code, max_size: int) -> str:
+        chunk_size = int(self.bot_config.get('media_chunk_size', 65536))
+        file = await bot.get_file(context['file_id'])
+        api = bot.session.api
+        if api.is_local:
+            stream = read_file_chunks(api.wrap_local_file.to_local(file.file_path), chunk_size)
+        else:
+            stream = bot.session.stream_content(
+                url=api.file_url(bot.token, file.file_path),
+                timeout=int(self.bot_config.get('media_timeout', 300)),
+                chunk_size=chunk_size,
+                raise_for_status=True
+            )
         
-        for effect in effects:
-            if 'send' in effect:
-                send_config = effect['send']
-                result['text'] = self.replace_variables(send_config.get('text', ''), context)
-                
-                keyboard_name = send_config.get('keyboard')
-                if keyboard_name and keyboard_name in self.keyboards:
-                    result['keyboard'] = self.keyboards[keyboard_name]
-            
-            elif 'edit' in effect:
-                edit_config = effect['edit']
-                result['text'] = self.replace_variables(edit_config.get('text', ''), context)
-                
-                keyboard_name = edit_config.get('keyboard')
-                if keyboard_name and keyboard_name in self.keyboards:
-                    result['keyboard'] = self.keyboards[keyboard_name]
-            
-            elif 'increment' in effect:
-                var_name = effect['increment']
-                self.variables[var_name] = self.variables.get(var_name, 0) + 1
-                if self.bot_config.get('debug'):
-                    print(f"📈 {var_name} = {self.variables[var_name]}")
-            
-            elif 'decrement' in effect:
-                var_name = effect['decrement']
-                self.variables[var_name] = self.variables.get(var_name, 0) - 1
-                if self.bot_config.get('debug'):
-                    print(f"📉 {var_name} = {self.variables[var_name]}")
-            
-            elif 'set' in effect:
-                set_config = effect['set']
-                var_name = set_config['variable']
-                var_value = self.replace_variables(str(set_config['value']), context)
-                self.variables[var_name] = self._parse_value(var_value)
-                if self.bot_config.get('debug'):
-                    print(f"📝 {var_name} = {self.variables[var_name]}")
+        # Код для частей выполняется в одном пространстве имён на всю загрузку
+        namespace = {**context} if chunk_code else None
+        code_object = compile_python(chunk_code) if chunk_code else None
+        output = part = None
+        if target is not None:
+            part = target.with_name(target.name + '.part')
+            await asyncio.to_thread(target.parent.mkdir, parents=True, exist_ok=True)
+            output = await asyncio.to_thread(open, part, 'wb')
         
-        return result
+        offset = 0
+        try:
+            async for chunk in stream:
+                if max_size and offset + len(chunk) > max_size:
+                    raise Exception(f"файл больше media_max_size ({max_size} байт)")
+                if output is not None:
+                    await asyncio.to_thread(output.write, chunk)
+                if namespace is not None:
+                    namespace['chunk'], namespace['chunk_offset'] = chunk, offset
+                    exec(code_object, {}, namespace)
+                offset += len(chunk)
+            if output is not None:
+                await asyncio.to_thread(output.close)
+                os.replace(part, target)
+        except BaseException:
+            if output is not None:
+                output.close()
+                with contextlib.suppress(OSError):
+                    os.unlink(part)
+            raise
+        finally:
+            await stream.aclose()
+        
+        if namespace is not None:
+            # Имена, созданные кодом для частей, видны Python блоку обработчика
+            for name, value in namespace.items():
+                if name not in context and name not in ('chunk', 'chunk_offset') and not name.startswith('_'):
+                    context[name] = value
+        return str(target) if target is not None else ''
+    
+    def _remember_media(self, key: tuple, path: str):
+        cache = self._media_cache
+        cache[key] = path
+        cache.move_to_end(key)
+        if len(cache) > MEDIA_CACHE_SIZE:
+            cache.popitem(last=False)
     
-    def check_condition(self, condition: str, context: dict = {}) -> bool:
-        """Проверка условий"""
+    def check_condition(self, condition: str, context: dict = {}, handler_name: str = None) -> bool:
+        """Проверка условий (handler_name - для счётчика ошибок)"""
         if not condition:
             return True
         
-        condition = self.replace_variables(condition, context)
-        
         try:
-            result = eval(condition, {}, {})
+            compiled = self.conditions.get(condition)
+            if compiled is None:
+                compiled = compile_condition(str(condition))
+            
+            result = eval(compiled.code, {}, compiled.namespace(self.make_lookup(context)))
             if self.bot_config.get('debug'):
-                print(f"🔍 Условие '{condition}' = {result}")
+                log.debug("🔍 Условие '%s' = %s", condition, result)
             return result
         except Exception as e:
+            self.metrics.error(handler_name, 'condition')
             if self.bot_config.get('debug'):
-                print(f"❌ Ошибка условия: {e}")
+                log.debug("❌ Ошибка условия: %s", e)
             return False
     
+    def build_callback_routes(self, handlers_config: dict = None, apply: bool = True) -> dict:
+        """Построение таблицы маршрутизации callback кнопок"""
+        handlers_config = self.handlers_config if handlers_config is None else handlers_config
+        callback_routes = {
+            handler_name: handler_config
+            for handler_name, handler_config in handlers_config.items()
+            if handler_name not in RESERVED_HANDLERS
+        }
+        if apply:
+            self.callback_routes = callback_routes
+        return callback_routes
+    
+    def resolve_callback(self, data: str):
+        """Поиск обработчика для callback_data: точное совпадение или самый длинный префикс
+        
+        Возвращает (имя обработчика, конфигурация, параметры после префикса).
+        """
+        handler_config = self.callback_routes.get(data)
+        if handler_config is not None:
+            return data, handler_config, ''
+        
+        # Параметризованные данные: "item:42" -> "item", "menu:page:2" -> "menu:page" или "menu"
+        prefix = data
+        while CALLBACK_SEPARATOR in prefix:
+            prefix = prefix.rsplit(CALLBACK_SEPARATOR, 1)[0]
+            handler_config = self.callback_routes.get(prefix)
+            if handler_config is not None:
+                return prefix, handler_config, data[len(prefix) + 1:]
+        
+        return None, None, ''
+    
+    def build_text_matcher(self, handlers_config: dict = None, apply: bool = True):
+        """Сборка текстовых триггеров всех обработчиков в один матчер"""
+        handlers_config = self.handlers_config if handlers_config is None else handlers_config
+        try:
+            text_matcher = compile_text_matcher(collect_text_triggers(handlers_config))
+        except Exception as e:
+            # Ошибка в триггерах не должна ломать загрузку конфигурации
+            print(f"❌ Ошибка сборки текстовых триггеров: {e}")
+            text_matcher = None
+        if apply:
+            self.text_matcher = text_matcher
+        return text_matcher
+    
     def get_context(self, update) -> dict:
         """Получение контекста из обновления"""
         if hasattr(update, 'from_user') and update.from_user:
+            chat = getattr(update, 'chat', None)
+            if chat is None and getattr(update, 'message', None) is not None:
+                # CallbackQuery: чат берём из сообщения с кнопкой
+                chat = update.message.chat
             return {
                 'user_id': update.from_user.id,
-                'chat_id': update.chat.id if hasattr(update, 'chat') and update.chat else update.from_user.id,
+                'chat_id': chat.id if chat else update.from_user.id,
                 'first_name': update.from_user.first_name or '',
                 'username': f"@{update.from_user.username}" if update.from_user.username else '',
                 'text': getattr(update, 'text', '') or ''
             }
         return {}
     
-    async def run(self):
-        """Запуск бота"""
+    def create_bot(self) -> Bot:
+        """Создание бота (config.api_server - свой адрес Bot API, например локальный)"""
+        session = None
+        if self.bot_config.get('api_server'):
+            session = AiohttpSession(api=TelegramAPIServer.from_base(self.bot_config['api_server']))
+        return Bot(self.bot_config['token'], session=session)
+    
+    async def _schedule_update(self, handler, event, data):
+        """Выполнение обновления через планировщик (по порядку внутри чата) и счётчик обновлений в обработке"""
+        self.inflight_updates += 1
+        try:
+            return await self.scheduler.run(update_event_chat_id(event), functools.partial(handler, event, data))
+        finally:
+            self.inflight_updates -= 1
+    
+    async def wait_inflight_updates(self, timeout: float):
+        """Ожидание завершения обработки текущих обновлений"""
+        deadline = time.monotonic() + timeout
+        while self.inflight_updates and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+    
+    def run_mode(self):
+        """Режим получения обновлений или None, если запускать нечего"""
         if not self.bot_config.get('token'):
             print("❌ Токен бота не указан")
+            return None
+        
+        mode = self.bot_config.get('mode', 'polling')
+        if mode not in RUN_MODES:
+            print(f"❌ Неизвестный режим запуска: {mode}")
+            return None
+        return mode
+    
+    async def run(self):
+        """Запуск бота"""
+        mode = self.run_mode()
+        if mode is None:
+            return
+        
+        # Пул для Python блоков
+        self.start_python_executor()
+        
+        bot = self.create_bot()
+        dp = self.build_dispatcher()
+        self.start_outbox()
+        self.start_state_journal()
+        self.resume_broadcasts(bot)
+        if self.bot_config.get('metrics_port'):
+            await self.start_metrics_server()
+        
+        print(f"🚀 {self.bot_config.get('name', 'ESYBOT')} запущен!")
+        print(f"📊 Формат: {self.config_format.upper()}")
+        print(f"📊 Переменных: {len(self.variables) + len(self.scoped_variables)}")
+        print(f"⌨️ Клавиатур: {len(self.keyboards_config)}")
+        print(f"🎯 Обработчиков: {len(self.handlers_config)}")
+        
+        # Горячая перезагрузка конфигурации
+        watcher = None
+        if self.bot_config.get('hot_reload') and self.config_path:
+            watcher = asyncio.create_task(self.watch_config())
+            print(f"🔄 Горячая перезагрузка: {self.config_path}")
+        
+        try:
+            if mode == 'webhook':
+                await self.run_webhook(bot, dp)
+            else:
+                # Очереди планировщика заполнены - новые обновления не запрашиваются
+                await dp.start_polling(bot, tasks_concurrency_limit=self.scheduler.max_pending)
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            await self.stop_broadcasts()
+            await self.stop_outbox()
+            await self.stop_state_journal()
+            await self.stop_metrics_server()
+            self.stop_python_executor()
+    
+    def start_outbox(self):
+        """Запуск очереди исходящих вызовов"""
+        if self.outbox is None:
+            self.outbox = OutboundQueue(
+                global_rate=float(self.bot_config.get('send_rate_global', 30)),
+                chat_rate=float(self.bot_config.get('send_rate_chat', 1)),
+                chat_burst=float(self.bot_config.get('send_burst_chat', 3)),
+                concurrency=int(self.bot_config.get('send_concurrency', 16))
+            )
+        self.outbox.start()
+    
+    async def stop_outbox(self):
+        if self.outbox is not None:
+            await self.outbox.stop(float(self.bot_config.get('shutdown_timeout', 10)))
+    
+    def metrics_text(self) -> str:
+        """Метрики обработчиков, очереди отправки и лога в формате Prometheus"""
+        counters = {'esybot_log_dropped_total': self.log_handler.dropped}
+        gauges = {'esybot_updates_inflight': self.inflight_updates}
+        if self.journal is not None:
+            journal = self.journal.metrics()
+            counters['esybot_state_written_total'] = journal['written']
+            counters['esybot_state_snapshots_total'] = journal['snapshots']
+            gauges['esybot_state_pending'] = journal['pending']
+            gauges['esybot_state_journal_records'] = journal['journal_records']
+        jobs = [job for job, _ in self.broadcasts.values()]
+        counters['esybot_broadcast_sent_total'] = self.broadcast_sent + sum(job.state['sent'] for job in jobs)
+        counters['esybot_broadcast_failed_total'] = self.broadcast_failed + sum(job.state['failed'] for job in jobs)
+        gauges['esybot_broadcasts_active'] = len(jobs)
+        gauges['esybot_broadcast_remaining'] = sum(job.remaining for job in jobs)
+        counters['esybot_memo_hits_total'] = self.memo_hits
+        counters['esybot_memo_misses_total'] = self.memo_misses
+        gauges['esybot_memo_entries'] = len(self._memo)
+        if self.scheduler is not None:
+            for key, value in self.scheduler.metrics().items():
+                if key == 'waits':
+                    counters['esybot_scheduler_waits_total'] = value
+                else:
+                    gauges[f"esybot_scheduler_{key}"] = value
+        if self.outbox is not None:
+            for key, value in self.outbox.metrics().items():
+                if key in OUTBOX_COUNTERS:
+                    counters[f"esybot_outbox_{key}_total"] = value
+                else:
+                    gauges[f"esybot_outbox_{key}"] = value
+        return self.metrics.render(self.handlers_config, gauges, counters)
+    
+    async def start_metrics_server(self):
+        """HTTP эндпоинт /metrics (по умолчанию только на localhost)"""
+        from aiohttp import web
+        
+        host = self.bot_config.get('metrics_host', '127.0.0.1')
+        port = int(self.bot_config['metrics_port'])
+        
+        async def handle_metrics(request):
+            return web.Response(
+                body=self.metrics_text().encode('utf-8'),
+                headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+            )
+        
+        app = web.Application()
+        app.router.add_get('/metrics', handle_metrics)
+        self._metrics_runner = web.AppRunner(app, access_log=None)
+        await self._metrics_runner.setup()
+        await web.TCPSite(self._metrics_runner, host, port).start()
+        print(f"📈 Метрики: http://{host}:{port}/metrics")
+    
+    async def stop_metrics_server(self):
+        if self._metrics_runner is not None:
+            await self._metrics_runner.cleanup()
+            self._metrics_runner = None
+    
+    async def send_message(self, message: Message, result: dict):
+        """Ответ новым сообщением через очередь"""
+        await self.outbox.submit(
+            message.chat.id,
+            functools.partial(message.answer, result['text'], reply_markup=result['keyboard'])
+        )
+    
+    async def send_edit(self, query: CallbackQuery, result: dict):
+        """Редактирование сообщения с кнопкой через очередь (со схлопыванием)"""
+        chat_id = query.message.chat.id
+        await self.outbox.submit(
+            chat_id,
+            functools.partial(query.message.edit_text, result['text'], reply_markup=result['keyboard']),
+            coalesce_key=(chat_id, query.message.message_id)
+        )
+    
+    def send_callback_answer(self, query: CallbackQuery, text: str) -> asyncio.Future:
+        """Ответ на нажатие кнопки (вне очереди), future завершается после отправки"""
+        return self.outbox.submit(query.from_user.id, functools.partial(query.answer, text), priority=True)
+    
+    def start_broadcast(self, bot: Bot, request: dict):
+        """Запуск рассылки в фоне (рассылка с тем же именем не запускается, пока идёт)"""
+        name = request['name']
+        if name in self.broadcasts:
+            log.warning("⚠️  Рассылка %s уже идёт", name)
+            return None
+        if not request['text']:
+            log.error("❌ Рассылка %s: не задан текст", name)
+            return None
+        try:
+            chats = list(dict.fromkeys(int(chat_id) for chat_id in request['chats']))
+        except (TypeError, ValueError) as e:
+            log.error("❌ Рассылка %s: получатели должны быть списком id чатов (%s)", name, e)
+            return None
+        
+        keyboard = request['keyboard']
+        if keyboard is not None:
+            # Клавиатура сохраняется вместе с прогрессом, поэтому - в виде JSON
+            keyboard = keyboard.model_dump(mode='json', exclude_none=True)
+        directory = self.config_relative_path(self.bot_config.get('broadcast_dir', 'broadcasts'))
+        job = BroadcastJob.create(directory, name, chats, request['text'], keyboard, request['report_chat'])
+        self._launch_broadcast(bot, job, new=True)
+        return job
+    
+    def resume_broadcasts(self, bot: Bot):
+        """Продолжение рассылок, прерванных остановкой или падением процесса"""
+        directory = self.config_relative_path(self.bot_config.get('broadcast_dir', 'broadcasts'))
+        if not directory.is_dir():
+            return
+        for state_path in sorted(directory.glob('*.json')):
+            try:
+                job = BroadcastJob.load(state_path)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"⚠️  Рассылка {state_path.name} не загружена: {e}")
+                continue
+            if job.state['state'] != 'running' or job.name in self.broadcasts:
+                continue
+            print(f"📣 Рассылка {job.name} продолжается: осталось {job.remaining} из {job.state['total']}")
+            self._launch_broadcast(bot, job)
+    
+    def _launch_broadcast(self, bot: Bot, job: BroadcastJob, new: bool = False):
+        task = asyncio.create_task(self._run_broadcast(bot, job, new))
+        self.broadcasts[job.name] = (job, task)
+    
+    async def _run_broadcast(self, bot: Bot, job: BroadcastJob, new: bool):
+        state = job.state
+        try:
+            if new:
+                await asyncio.to_thread(job.save, dict(state), True)
+            log.info("📣 Рассылка %s: %s получателей", job.name, job.remaining)
+            await job.run(
+                bot, self.outbox,
+                concurrency=int(self.bot_config.get('broadcast_concurrency', BROADCAST_CONCURRENCY)),
+                checkpoint_every=int(self.bot_config.get('broadcast_checkpoint_every', BROADCAST_CHECKPOINT_EVERY))
+            )
+        except Exception as e:
+            log.error("❌ Рассылка %s: %s", job.name, e)
+            return
+        finally:
+            self.broadcasts.pop(job.name, None)
+            self.broadcast_sent += state['sent']
+            self.broadcast_failed += state['failed']
+        
+        if state['state'] == 'failed':
+            log.error("❌ Рассылка %s прервана: %s", job.name, state['error'])
+            text = f"❌ Рассылка {job.name} прервана после {state['sent']} из {state['total']}: {state['error']}"
+        else:
+            log.info("📣 Рассылка %s завершена: отправлено %s, ошибок %s", job.name, state['sent'], state['failed'])
+            text = (f"📣 Рассылка {job.name} завершена: отправлено {state['sent']} из {state['total']}, "
+                    f"ошибок {state['failed']}, {time.time() - state['started']:.0f} с")
+        chat_id = state['report_chat']
+        if chat_id is not None:
+            with contextlib.suppress(Exception):
+                await self.outbox.submit(chat_id, functools.partial(bot.send_message, chat_id, text))
+    
+    async def stop_broadcasts(self):
+        """Остановка рассылок с сохранением прогресса"""
+        tasks = [task for _, task in self.broadcasts.values()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def run_webhook(self, bot: Bot, dp: Dispatcher):
+        """Приём обновлений через webhook (aiohttp сервер)"""
+        from aiohttp import web
+        from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+        
+        path = self.bot_config.get('webhook_path', '/webhook')
+        host = self.bot_config.get('webhook_host', '0.0.0.0')
+        port = int(self.bot_config.get('webhook_port', 8080))
+        secret = self.bot_config.get('webhook_secret') or None
+        url = self.bot_config.get('webhook_url', '')
+        
+        @web.middleware
+        async def backpressure(request, handler):
+            # Очереди заполнены - Telegram повторит доставку позже
+            if self.scheduler.full:
+                return web.Response(status=503)
+            return await handler(request)
+        
+        app = web.Application(middlewares=[backpressure])
+        # Ответ Telegram сразу, обновления обрабатываются параллельно в фоне
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret, handle_in_background=True).register(app, path=path)
+        setup_application(app, dp, bot=bot)
+        
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        
+        if url:
+            await bot.set_webhook(
+                url.rstrip('/') + path,
+                secret_token=secret,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+        print(f"🌐 Webhook: http://{host}:{port}{path}")
+        
+        self.install_stop_handlers()
+        try:
+            await self._stop_event.wait()
+        finally:
+            # Перестаём принимать запросы, дожидаемся текущих обновлений и закрываем сессию
+            print("🛑 Остановка webhook...")
+            await site.stop()
+            await self.wait_inflight_updates(float(self.bot_config.get('shutdown_timeout', 10)))
+            await runner.cleanup()
+    
+    def install_stop_handlers(self) -> asyncio.Event:
+        """Событие остановки по SIGINT/SIGTERM или вызову stop()"""
+        self._stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stop_event.set)
+            except (NotImplementedError, RuntimeError):  # Windows
+                pass
+        return self._stop_event
+    
+    def stop(self):
+        """Запрос корректной остановки webhook сервера или супервизора"""
+        if self._stop_event is not None:
+            self._stop_event.set()
+    
+    async def run_supervisor(self):
+        """Супервизор: config.workers рабочих процессов, обновления распределяются по хэшу chat_id
+        
+        Обновления одного чата всегда попадают в один процесс и обрабатываются
+        там по порядку. Глобальные переменные и переменные пользователей/чатов
+        хранятся в общем состоянии - отдельном процессе SharedStateManager.
+        """
+        mode = self.run_mode()
+        if mode is None:
             return
+        workers = int(self.bot_config.get('workers', 1))
+        if self.journal is not None:
+            print("⚠️  state_file: в режиме workers переменные только восстанавливаются при запуске, изменения не сохраняются")
+        
+        authkey = os.urandom(32)
+        manager = SharedStateManager(authkey=authkey)
+        manager.start(ignore_sigint)
+        state = manager.state()
+        state.configure(
+            int(self.bot_config.get('variables_max_entries', 100000)),
+            float(self.bot_config.get('variables_ttl', 0))
+        )
+        # Восстановленное из state_file (переменные Python блоков и пользователей/чатов тоже)
+        state.seed(
+            dict(self.variables),
+            dict(self.python_globals) if self.journal is not None else {},
+            self.scoped_variables.backend.items() if self.journal is not None else []
+        )
+        
+        # Общий лимит отправки делится между процессами, метрики - на соседних портах
+        worker_config = dict(self.bot_config)
+        worker_config['send_rate_global'] = float(self.bot_config.get('send_rate_global', 30)) / workers
         
-        # Построение клавиатур
-        self.build_keyboards()
+        context = multiprocessing.get_context()
+        processes = []
+        channels = []
+        for index in range(workers):
+            config = dict(worker_config)
+            if self.bot_config.get('metrics_port'):
+                config['metrics_port'] = int(self.bot_config['metrics_port']) + index
+            reader, writer = context.Pipe(duplex=False)
+            process = context.Process(
+                target=run_shard_worker,
+                name=f"esybot-shard-{index}",
+                args=(index, self.config_path, self.cache_dir, config, manager.address, authkey, reader)
+            )
+            process.start()
+            reader.close()
+            processes.append(process)
+            channels.append(writer)
         
-        bot = Bot(self.bot_config['token'])
+        loop = asyncio.get_running_loop()
+        queues = [asyncio.Queue(SHARD_QUEUE_SIZE) for _ in channels]
+        
+        async def write(channel, queue: asyncio.Queue):
+            # Запись в канал блокируется, пока процесс не прочитает данные, - поэтому в потоке
+            while True:
+                batch = await queue.get()
+                try:
+                    await loop.run_in_executor(None, channel.send, batch)
+                except OSError as e:
+                    log.error("❌ Рабочий процесс недоступен: %s", e)
+                    return
+                if batch is None:
+                    return
+        
+        writers = [asyncio.create_task(write(channel, queue)) for channel, queue in zip(channels, queues)]
+        
+        async def dispatch(updates: list):
+            # Пакет на процесс; если процесс не успевает, его очередь заполняется и приём обновлений ждёт
+            batches = {}
+            for raw in updates:
+                batches.setdefault(shard_index(update_chat_id(raw), workers), []).append(raw)
+            for index, batch in batches.items():
+                await queues[index].put(batch)
+        
+        bot = self.create_bot()
+        self.install_stop_handlers()
+        print(f"🚀 {self.bot_config.get('name', 'ESYBOT')} запущен: рабочих процессов {workers}")
+        
+        try:
+            if mode == 'webhook':
+                await self.supervise_webhook(bot, dispatch)
+            else:
+                await self.supervise_polling(bot, dispatch)
+        finally:
+            print("🛑 Остановка рабочих процессов...")
+            deadline = time.monotonic() + float(self.bot_config.get('shutdown_timeout', 10)) + 5
+            for queue, writer in zip(queues, writers):
+                if not writer.done():
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(queue.put(None), max(deadline - time.monotonic(), 0))
+            await asyncio.wait(writers, timeout=max(deadline - time.monotonic(), 0))
+            
+            for process in processes:
+                await loop.run_in_executor(None, process.join, max(deadline - time.monotonic(), 0))
+                if process.is_alive():
+                    process.terminate()
+            for writer in writers:
+                writer.cancel()
+            for channel in channels:
+                channel.close()
+            
+            await bot.session.close()
+            manager.shutdown()
+    
+    async def supervise_polling(self, bot: Bot, dispatch):
+        """Long polling в супервизоре: сырые обновления передаются рабочим процессам"""
+        allowed_updates = self.build_dispatcher().resolve_used_update_types()
+        offset = None
+        
+        async def poll():
+            nonlocal offset
+            while True:
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    log.error("❌ Ошибка получения обновлений: %s", e)
+                    await asyncio.sleep(1)
+                    continue
+                if updates:
+                    offset = updates[-1].update_id + 1
+                    await dispatch([update.model_dump(mode='json', by_alias=True, exclude_none=True) for update in updates])
+        
+        task = asyncio.create_task(poll())
+        try:
+            await self._stop_event.wait()
+        finally:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+            # Подтверждаем уже переданные обновления, чтобы не получить их повторно
+            if offset is not None:
+                with contextlib.suppress(Exception):
+                    await bot.get_updates(offset=offset, timeout=0, limit=1)
+    
+    async def supervise_webhook(self, bot: Bot, dispatch):
+        """Webhook в супервизоре: ответ Telegram сразу, обработка в рабочих процессах"""
+        from aiohttp import web
+        
+        path = self.bot_config.get('webhook_path', '/webhook')
+        host = self.bot_config.get('webhook_host', '0.0.0.0')
+        port = int(self.bot_config.get('webhook_port', 8080))
+        secret = self.bot_config.get('webhook_secret') or None
+        url = self.bot_config.get('webhook_url', '')
+        
+        async def handle_update(request):
+            if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+                return web.Response(status=401)
+            await dispatch([await request.json()])
+            return web.Response()
+        
+        app = web.Application()
+        app.router.add_post(path, handle_update)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        
+        if url:
+            await bot.set_webhook(
+                url.rstrip('/') + path,
+                secret_token=secret,
+                allowed_updates=self.build_dispatcher().resolve_used_update_types()
+            )
+        print(f"🌐 Webhook: http://{host}:{port}{path}")
+        
+        try:
+            await self._stop_event.wait()
+        finally:
+            await runner.cleanup()
+    
+    async def run_shard(self, conn, index: int):
+        """Рабочий процесс: обновления приходят от супервизора, внутри чата - строго по порядку"""
+        self.start_python_executor()
+        bot = self.create_bot()
+        dp = self.build_dispatcher()
+        self.start_outbox()
+        if index == 0:
+            # Прерванные рассылки продолжает один процесс
+            self.resume_broadcasts(bot)
+        if self.bot_config.get('metrics_port'):
+            await self.start_metrics_server()
+        
+        watcher = None
+        if self.bot_config.get('hot_reload') and self.config_path:
+            watcher = asyncio.create_task(self.watch_config())
+        
+        loop = asyncio.get_running_loop()
+        stopped = asyncio.Event()
+        tasks = set()
+        
+        def dispatch(batch):
+            if batch is None:
+                stopped.set()
+                return
+            # Порядок внутри чата обеспечивает планировщик: задачи доходят до него в порядке создания
+            for raw in batch:
+                task = asyncio.create_task(self._feed_shard_update(dp, bot, raw))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        
+        def receive():
+            # recv() блокирующий, поэтому канал читается в отдельном потоке
+            while True:
+                try:
+                    batch = conn.recv()
+                except (EOFError, OSError):
+                    batch = None
+                loop.call_soon_threadsafe(dispatch, batch)
+                if batch is None:
+                    return
+        
+        threading.Thread(target=receive, name=f"esybot-shard-{index}-reader", daemon=True).start()
+        print(f"🧩 Рабочий процесс {index} запущен (pid {os.getpid()})")
+        
+        try:
+            await stopped.wait()
+            if tasks:
+                await asyncio.wait(set(tasks), timeout=float(self.bot_config.get('shutdown_timeout', 10)))
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            await self.stop_broadcasts()
+            await self.stop_outbox()
+            await self.stop_metrics_server()
+            self.stop_python_executor()
+            await bot.session.close()
+    
+    async def _feed_shard_update(self, dp: Dispatcher, bot: Bot, raw: dict):
+        """Обработка обновления от супервизора"""
+        try:
+            await dp.feed_update(bot, Update.model_validate(raw, context={'bot': bot}))
+        except Exception as e:
+            log.error("❌ Ошибка обработки обновления %s: %s", raw.get('update_id'), e)
+    
+    def build_dispatcher(self) -> Dispatcher:
+        """Создание диспетчера со всеми обработчиками"""
         dp = Dispatcher(storage=MemoryStorage())
+        # Планировщик идёт после встроенных outer middleware aiogram (ошибки, контекст
+        # пользователя, FSM) - ни один из них не отдаёт управление (MemoryStorage читает
+        # состояние без ожидания), поэтому обновления ставятся в очереди чатов в порядке
+        # поступления. Хранилище FSM с настоящим вводом-выводом (Redis) этот порядок нарушит
+        self.scheduler = UpdateScheduler(
+            concurrency=int(self.bot_config.get('update_concurrency', 64)),
+            max_pending=int(self.bot_config.get('update_queue_size', 1000))
+        )
+        dp.update.outer_middleware(self._schedule_update)
+        self.memo_size = int(self.bot_config.get('memo_size', MEMO_SIZE))
         
         # Обработчик /start
         @dp.message(Command("start"))
         async def start_handler(message: Message):
-            context = self.get_context(message)
-            
             # Ищем обработчик START или start
-            handler_config = self.handlers_config.get('START') or self.handlers_config.get('start')
-            if not handler_config:
-                await message.answer("❌ Обработчик /start не найден")
+            handler_name = 'START' if 'START' in self.handlers_config else 'start'
+            if handler_name not in self.pipelines:
+                await self.send_message(message, {'text': "❌ Обработчик /start не найден", 'keyboard': None})
+                return
+            await self.run_handler(handler_name, message, self.get_context(message))
+        
+        # Обработчик callback кнопок: один на все, поиск по таблице маршрутизации
+        @dp.callback_query(F.data)
+        async def callback_handler(query: CallbackQuery):
+            handler_name, config, callback_args = self.resolve_callback(query.data)
+            if config is None:
                 return
             
-            # Выполняем Python если есть
-            if handler_config.get('python'):
-                self.execute_python(handler_config['python'], context)
-            
-            # Проверяем условие
-            if handler_config.get('condition'):
-                if not self.check_condition(handler_config['condition'], context):
-                    if handler_config.get('else_effects'):
-                        result = self.process_effects(handler_config['else_effects'], context)
-                        if result['text']:
-                            await message.answer(result['text'], reply_markup=result['keyboard'])
-                    return
+            context = self.get_context(query)
+            context['data'] = query.data
+            context['callback_args'] = callback_args
+            await self.run_handler(handler_name, query, context)
+        
+        # Обработка медиа (обработчик ищется при каждом обновлении - конфигурация может перезагрузиться)
+        self._media_slots = asyncio.Semaphore(int(self.bot_config.get('media_concurrency', 4)))
+        
+        @dp.message(F.content_type.in_(MEDIA_HANDLERS.keys()))
+        async def media_handler(message: Message):
+            handler_name = MEDIA_HANDLERS[message.content_type]
+            if handler_name not in self.pipelines:
+                return
+            context = self.get_context(message)
+            context.update(message_media(message))
+            download = self.handlers_config.get(handler_name, {}).get('download')
+            if download:
+                with self.metrics.phase(handler_name, 'download'):
+                    await self.fetch_media(message.bot, handler_name, message.content_type, download, context)
+            await self.run_handler(handler_name, message, context)
+        
+        # Обработка текстовых сообщений: сначала триггеры обработчиков, затем MESSAGE
+        @dp.message(F.text)
+        async def message_handler(message: Message):
+            if message.text.startswith('/'):
+                return
+            handler_name = 'MESSAGE'
+            found = self.text_matcher.match(message.text) if self.text_matcher is not None else None
+            if found is not None:
+                handler_name = found[0]
+            if handler_name not in self.pipelines:
+                return
+            context = self.get_context(message)
+            context['text'] = message.text
+            if found is not None:
+                context['match'], context['match_args'] = found[1], found[2]
+            await self.run_handler(handler_name, message, context)
+        
+        return dp
+
+
+# Файлы конфигураций в каталоге режима нескольких ботов и расширение файла-манифеста
+BOT_CONFIG_EXTENSIONS = ('.yaml', '.yml', '.simple')
+BOT_MANIFEST_EXTENSION = '.bots'
+
+# Повторный запуск бота, который не запустился по внешней причине (порт занят, сеть), секунды
+BOT_RETRY_INTERVAL = 30
+
+
+def list_bot_configs(source: str) -> list:
+    """Файлы конфигураций: все из каталога или пути из манифеста (по одному в строке, # - комментарий)"""
+    source_path = Path(source)
+    if source_path.is_dir():
+        return sorted(
+            str(path) for path in source_path.iterdir()
+            if path.suffix.lower() in BOT_CONFIG_EXTENSIONS and path.is_file()
+        )
+    
+    paths = []
+    with open(source_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                paths.append(str((source_path.parent / line).resolve()) if not os.path.isabs(line) else line)
+    return paths
+
+
+class BotHost:
+    """Несколько ботов в одном event loop
+    
+    Боты берутся из каталога или манифеста, который периодически
+    перечитывается: новые файлы запускаются, удалённые - останавливаются,
+    изменённые - перезагружаются. Все боты используют общие HTTP сессии
+    (одна на адрес Bot API) и общие скомпилированные шаблоны и клавиатуры.
+    """
+    
+    def __init__(self, source: str, cache_dir=None, host_config: dict = None):
+        self.source = source
+        self.cache_dir = cache_dir
+        self.config = host_config or {}
+        self.bots = {}      # путь -> {'interpreter', 'bot', 'dp', 'key', 'signature', 'task'}
+        self.sessions = {}  # адрес Bot API (None - Telegram) -> AiohttpSession
+        self.assets = {}    # общие скомпилированные шаблоны, условия и Python блоки
+        self._stop_event = None
+        self._webhook_tasks = set()
+    
+    @property
+    def mode(self) -> str:
+        return self.config.get('mode') or 'polling'
+    
+    def session_for(self, api_server: str = None) -> AiohttpSession:
+        session = self.sessions.get(api_server)
+        if session is None:
+            if api_server:
+                session = AiohttpSession(api=TelegramAPIServer.from_base(api_server))
+            else:
+                session = AiohttpSession()
+            self.sessions[api_server] = session
+        return session
+    
+    def rebuild_assets(self, changed: tuple = ()):
+        """Общие объекты только работающих ботов (после остановки или перезагрузки)
+        
+        Остальные боты уже ссылаются на общие экземпляры - они только собираются
+        в новый словарь, без пересборки обработчиков и сброса кэша ответов.
+        Объекты ботов из changed (перезагруженных) заменяются общими.
+        """
+        assets = {}
+        for entry in self.bots.values():
+            interpreter = entry['interpreter']
+            if interpreter is None or interpreter in changed:
+                continue
+            for handler in interpreter._compiled_handlers.values():
+                for kind in ('templates', 'conditions', 'code_objects'):
+                    shared = assets.setdefault(kind, {})
+                    for source, compiled in handler[kind].items():
+                        shared.setdefault(source, compiled)
+        self.assets = assets
+        for interpreter in changed:
+            interpreter.share_compiled(assets)
+    
+    @staticmethod
+    def file_signature(path: str):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+    
+    async def start_bot(self, path: str):
+        interpreter = UnifiedBotInterpreter(cache_dir=self.cache_dir)
+        signature = self.file_signature(path)
+        if not await asyncio.to_thread(interpreter.load_config, path):
+            print(f"❌ Бот {path}: не удалось загрузить конфигурацию")
+            self.bots[path] = {'interpreter': None, 'signature': signature}
+            return
+        if not interpreter.bot_config.get('token'):
+            print(f"❌ Бот {path}: токен не указан")
+            self.bots[path] = {'interpreter': None, 'signature': signature}
+            return
+        
+        key = Path(path).stem
+        if any(entry.get('key') == key for entry in self.bots.values()):
+            print(f"❌ Бот {path}: имя {key} уже занято другим файлом")
+            self.bots[path] = {'interpreter': None, 'signature': signature}
+            return
+        
+        interpreter.share_compiled(self.assets)
+        bot = Bot(interpreter.bot_config['token'], session=self.session_for(interpreter.bot_config.get('api_server')))
+        try:
+            interpreter.start_python_executor()
+            dp = interpreter.build_dispatcher()
+            interpreter.start_outbox()
+            interpreter.start_state_journal()
+            interpreter.resume_broadcasts(bot)
+            if interpreter.bot_config.get('metrics_port'):
+                await interpreter.start_metrics_server()
             
-            # Выполняем основные эффекты
-            if handler_config.get('effects'):
-                result = self.process_effects(handler_config['effects'], context)
-                if result['text']:
-                    await message.answer(result['text'], reply_markup=result['keyboard'])
-        
-        # Обработчики callback кнопок
-        for handler_name, handler_config in self.handlers_config.items():
-            if handler_name not in ['START', 'start', 'MESSAGE', 'PHOTO', 'DOCUMENT', 'VOICE']:
-                @dp.callback_query(F.data == handler_name)
-                async def callback_handler(query: CallbackQuery, config=handler_config):
-                    context = self.get_context(query)
-                    
-                    # Python код
-                    if config.get('python'):
-                        self.execute_python(config['python'], context)
-                    
-                    # Условие
-                    if config.get('condition'):
-                        if not self.check_condition(config['condition'], context):
-                            if config.get('else_effects'):
-                                result = self.process_effects(config['else_effects'], context)
-                                if result['text']:
-                                    await query.message.edit_text(result['text'], reply_markup=result['keyboard'])
-                                await query.answer(result['reply'])
-                            return
-                    
-                    # Основные эффекты
-                    if config.get('effects'):
-                        result = self.process_effects(config['effects'], context)
-                        if result['text']:
-                            await query.message.edit_text(result['text'], reply_markup=result['keyboard'])
-                        await query.answer(result['reply'])
-        
-        # Обработка медиа (если есть соответствующие обработчики)
-        if 'PHOTO' in self.handlers_config:
-            @dp.message(F.content_type == ContentType.PHOTO)
-            async def photo_handler(message: Message):
-                context = self.get_context(message)
-                handler_config = self.handlers_config['PHOTO']
-                
-                if handler_config.get('python'):
-                    self.execute_python(handler_config['python'], context)
-                
-                if handler_config.get('effects'):
-                    result = self.process_effects(handler_config['effects'], context)
-                    if result['text']:
-                        await message.answer(result['text'], reply_markup=result['keyboard'])
-        
-        # Обработка текстовых сообщений
-        if 'MESSAGE' in self.handlers_config:
-            @dp.message(F.text)
-            async def message_handler(message: Message):
-                if message.text.startswith('/'):
-                    return
-                
-                context = self.get_context(message)
-                context['text'] = message.text
-                handler_config = self.handlers_config['MESSAGE']
-                
-                if handler_config.get('python'):
-                    self.execute_python(handler_config['python'], context)
-                
-                if handler_config.get('effects'):
-                    result = self.process_effects(handler_config['effects'], context)
-                    if result['text']:
-                        await message.answer(result['text'], reply_markup=result['keyboard'])
+            if self.mode == 'webhook':
+                url = self.config.get('webhook_url', '')
+                if url:
+                    await bot.set_webhook(
+                        f"{url.rstrip('/')}{self.webhook_path}/{key}",
+                        secret_token=interpreter.bot_config.get('webhook_secret') or None,
+                        allowed_updates=dp.resolve_used_update_types()
+                    )
+        except Exception as e:
+            # Уже запущенное останавливается; бот запускается снова через BOT_RETRY_INTERVAL
+            # (или раньше, если изменится файл)
+            print(f"❌ Бот {path}: не удалось запустить: {e}")
+            await self.teardown(interpreter)
+            self.bots[path] = {'interpreter': None, 'signature': signature,
+                               'retry_at': time.monotonic() + BOT_RETRY_INTERVAL}
+            return
         
-        print(f"🚀 {self.bot_config.get('name', 'ESYBOT')} запущен!")
-        print(f"📊 Формат: {self.config_format.upper()}")
-        print(f"📊 Переменных: {len(self.variables)}")
-        print(f"⌨️ Клавиатур: {len(self.keyboards)}")
-        print(f"🎯 Обработчиков: {len(self.handlers_config)}")
+        entry = {'interpreter': interpreter, 'bot': bot, 'dp': dp, 'key': key, 'signature': signature, 'task': None}
+        self.bots[path] = entry
+        if self.mode != 'webhook':
+            entry['task'] = asyncio.create_task(dp.start_polling(
+                bot, handle_signals=False, close_bot_session=False,
+                tasks_concurrency_limit=interpreter.scheduler.max_pending
+            ))
+        print(f"🚀 {interpreter.bot_config.get('name', key)} запущен ({path})")
+    
+    async def stop_bot(self, path: str, forget: bool = True):
+        """Остановка бота; forget - бот убран из списка, его webhook снимается"""
+        entry = self.bots.pop(path, None)
+        if entry is None or entry['interpreter'] is None:
+            return
+        
+        interpreter = entry['interpreter']
+        if self.mode == 'webhook' and forget and self.config.get('webhook_url'):
+            with contextlib.suppress(Exception):
+                await entry['bot'].delete_webhook()
+        if entry['task'] is not None:
+            with contextlib.suppress(RuntimeError):
+                await entry['dp'].stop_polling()
+            with contextlib.suppress(Exception):
+                await entry['task']
+        await interpreter.wait_inflight_updates(float(interpreter.bot_config.get('shutdown_timeout', 10)))
+        await self.teardown(interpreter)
+        print(f"🛑 {interpreter.bot_config.get('name', entry['key'])} остановлен ({path})")
+    
+    @staticmethod
+    async def teardown(interpreter: 'UnifiedBotInterpreter'):
+        """Остановка рассылок, очереди, журнала, метрик и пула бота (то, что успело запуститься)"""
+        await interpreter.stop_broadcasts()
+        await interpreter.stop_outbox()
+        await interpreter.stop_state_journal()
+        await interpreter.stop_metrics_server()
+        interpreter.stop_python_executor()
+    
+    async def reload_bot(self, path: str):
+        entry = self.bots[path]
+        interpreter = entry['interpreter']
+        if interpreter is None:
+            # Прошлая загрузка не удалась - пробуем запустить заново
+            self.bots.pop(path)
+            await self.start_bot(path)
+            return
+        
+        entry['signature'] = self.file_signature(path)
+        staging = await asyncio.to_thread(interpreter.parse_config, path)
+        if staging is None or staging.config_hash == interpreter.config_hash:
+            return
+        
+        # Токен или адрес Bot API сменились - бот перезапускается целиком
+        if any(staging.bot_config.get(key) != interpreter.bot_config.get(key) for key in ('token', 'api_server')):
+            await self.stop_bot(path)
+            await self.start_bot(path)
+            self.rebuild_assets()
+        else:
+            interpreter.apply_config(staging)
+            self.rebuild_assets(changed=(interpreter,))
+    
+    async def sync(self):
+        """Сверка запущенных ботов с каталогом или манифестом"""
+        try:
+            paths = await asyncio.to_thread(list_bot_configs, self.source)
+        except OSError as e:
+            log.error("❌ Не удалось прочитать %s: %s", self.source, e)
+            return
+        
+        removed = [path for path in self.bots if path not in paths]
+        for path in removed:
+            await self.stop_bot(path)
+        if removed:
+            self.rebuild_assets()
+        
+        for path in paths:
+            try:
+                entry = self.bots.get(path)
+                if entry is None:
+                    await self.start_bot(path)
+                elif self.file_signature(path) != entry['signature'] or time.monotonic() >= entry.get('retry_at', float('inf')):
+                    await self.reload_bot(path)
+            except Exception as e:
+                # Ошибка одного бота не останавливает остальные
+                print(f"❌ Бот {path}: {e}")
+                self.bots.setdefault(path, {'interpreter': None, 'signature': self.file_signature(path)})
+    
+    @property
+    def webhook_path(self) -> str:
+        return self.config.get('webhook_path', '/webhook').rstrip('/')
+    
+    async def handle_webhook(self, request):
+        """Приём обновления для бота по имени файла: /webhook/<имя>"""
+        from aiohttp import web
+        
+        key = request.match_info['bot']
+        entry = next((entry for entry in self.bots.values() if entry.get('key') == key and entry['interpreter']), None)
+        if entry is None:
+            return web.Response(status=404)
+        secret = entry['interpreter'].bot_config.get('webhook_secret')
+        if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            return web.Response(status=401)
+        if entry['interpreter'].scheduler.full:
+            return web.Response(status=503)
+        
+        # Ответ Telegram сразу, обработка в фоне
+        task = asyncio.create_task(entry['dp'].feed_raw_update(entry['bot'], await request.json()))
+        self._webhook_tasks.add(task)
+        task.add_done_callback(self._webhook_tasks.discard)
+        return web.Response()
+    
+    async def run(self):
+        """Запуск всех ботов и слежение за каталогом/манифестом"""
+        if self.mode not in RUN_MODES:
+            print(f"❌ Неизвестный режим запуска: {self.mode}")
+            return
+        
+        self._stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stop_event.set)
+            except (NotImplementedError, RuntimeError):  # Windows
+                pass
+        
+        runner = None
+        if self.mode == 'webhook':
+            from aiohttp import web
+            
+            host = self.config.get('webhook_host', '0.0.0.0')
+            port = int(self.config.get('webhook_port', 8080))
+            app = web.Application()
+            app.router.add_post(self.webhook_path + '/{bot}', self.handle_webhook)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, host, port).start()
+            print(f"🌐 Webhook: http://{host}:{port}{self.webhook_path}/<бот>")
         
-        await dp.start_polling(bot)
+        interval = float(self.config.get('reload_interval', 1))
+        print(f"🤖 Боты: {self.source}")
+        try:
+            while not self._stop_event.is_set():
+                await self.sync()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._stop_event.wait(), interval)
+        finally:
+            for path in list(self.bots):
+                await self.stop_bot(path, forget=False)
+            if runner is not None:
+                await runner.cleanup()
+            for session in self.sessions.values():
+                await session.close()
+    
+    def stop(self):
+        if self._stop_event is not None:
+            self._stop_event.set()
+
 
 def main():
     if len(sys.argv) < 2:
-        print("Использование: python esybot_unified.py <config_file>")
+        print("Использование: python esybot_unified.py <config_file> [--mode polling|webhook]")
         print("\nПоддерживаемые форматы:")
         print("  • .simple - ESYBOT-SIMPLE формат")
         print("  • .yaml/.yml - ESYBOT-DEC формат")
+        print("  • каталог или манифест .bots - несколько ботов в одном процессе")
         return
     
-    config_file = sys.argv[1]
+    parser = argparse.ArgumentParser(description="ESYBOT - интерпретатор SIMPLE и YAML ботов")
+    parser.add_argument('config_file', help="Файл конфигурации, каталог или манифест .bots")
+    parser.add_argument('--mode', choices=RUN_MODES, help="Режим получения обновлений")
+    parser.add_argument('--webhook-url', help="Публичный URL для setWebhook")
+    parser.add_argument('--webhook-path', help="Путь webhook (по умолчанию /webhook)")
+    parser.add_argument('--webhook-host', help="Адрес сервера webhook")
+    parser.add_argument('--webhook-port', type=int, help="Порт сервера webhook")
+    parser.add_argument('--webhook-secret', help="Секретный токен webhook")
+    parser.add_argument('--api-server', help="Адрес Bot API (например, локальный)")
+    parser.add_argument('--reload', action='store_true', help="Горячая перезагрузка при изменении файла")
+    parser.add_argument('--metrics-port', type=int, help="Порт HTTP эндпоинта метрик /metrics")
+    parser.add_argument('--workers', type=int, help="Число рабочих процессов (обновления делятся по chat_id)")
+    parser.add_argument('--state-file', help="Файл для сохранения переменных между перезапусками")
+    parser.add_argument('--cache-dir', help=f"Каталог кэша конфигурации (по умолчанию {CONFIG_CACHE_DIR} рядом с файлом)")
+    parser.add_argument('--no-cache', action='store_true', help="Не использовать кэш конфигурации")
+    args = parser.parse_args()
+    
+    config_file = args.config_file
     
     if not os.path.exists(config_file):
         print(f"❌ Файл {config_file} не найден")
         return
     
+    # Несколько ботов: каталог конфигураций или манифест
+    if os.path.isdir(config_file) or config_file.endswith(BOT_MANIFEST_EXTENSION):
+        host_config = {
+            key: getattr(args, key)
+            for key in ('mode', 'webhook_url', 'webhook_path', 'webhook_host', 'webhook_port')
+            if getattr(args, key) is not None
+        }
+        host = BotHost(config_file, cache_dir=False if args.no_cache else args.cache_dir, host_config=host_config)
+        asyncio.run(host.run())
+        return
+    
     # Создаем и запускаем универсальный интерпретатор
-    interpreter = UnifiedBotInterpreter()
+    interpreter = UnifiedBotInterpreter(cache_dir=False if args.no_cache else args.cache_dir)
     
     if interpreter.load_config(config_file):
-        asyncio.run(interpreter.run())
+        # Параметры командной строки важнее конфигурации
+        for key in ('mode', 'webhook_url', 'webhook_path', 'webhook_host', 'webhook_port', 'webhook_secret', 'api_server', 'metrics_port', 'workers'):
+            if getattr(args, key) is not None:
+                interpreter.bot_config[key] = getattr(args, key)
+        if args.reload:
+            interpreter.bot_config['hot_reload'] = True
+        if args.state_file is not None:
+            interpreter.bot_config['state_file'] = os.path.abspath(args.state_file)
+            interpreter.restore_state()
+        
+        if int(interpreter.bot_config.get('workers', 1)) > 1:
+            asyncio.run(interpreter.run_supervisor())
+        else:
+            asyncio.run(interpreter.run())
     else:
         print("❌ Не удалось загрузить конфигурацию")
 
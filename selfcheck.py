@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# selfcheck.py - Проверки поведения интерпретатора ESYBOT, которые легко сломать оптимизацией
+
+import io
+import sys
+import asyncio
+import argparse
+import tempfile
+import traceback
+import contextlib
+import collections
+from pathlib import Path
+
+from main import (
+    UnifiedBotInterpreter, UpdateScheduler, TextMatcher, SharedStateManager, SharedVariableBackend,
+    SharedVariables, connect_shared_state, journal_frame,
+)
+
+# Токен-заглушка: бот не запускается, сеть не нужна
+FAKE_TOKEN = '123456:SELFCHECK'
+
+JOURNAL_CONFIG = f"""config:
+  token: "{FAKE_TOKEN}"
+  state_file: "state/bot.state"
+  state_flush_interval: 0.02
+  state_snapshot_every: 50
+variables:
+  - name: total
+    value: 0
+  - name: clicks
+    value: 0
+    scope: user
+handlers:
+  - name: plus
+    python: |
+      seen = (seen if 'seen' in dir() else 0) + 1
+    effects:
+      - increment: total
+      - increment: clicks
+"""
+
+USERS = (1, 2, 3)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Подавление вывода интерпретатора во время проверок"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def context(user_id: int) -> dict:
+    return {'user_id': user_id, 'chat_id': user_id, 'first_name': 'User', 'username': '', 'text': ''}
+
+
+def expect(actual, expected, what: str):
+    if actual != expected:
+        raise AssertionError(f"{what}: ожидалось {expected!r}, получено {actual!r}")
+
+
+# ---------------------------------------------------------------------------
+# Журнал состояния
+# ---------------------------------------------------------------------------
+
+def journal_bot(config_path: Path) -> UnifiedBotInterpreter:
+    interpreter = UnifiedBotInterpreter(cache_dir=False)
+    with quiet():
+        if not interpreter.load_config(str(config_path)):
+            raise AssertionError("не удалось загрузить конфигурацию")
+    return interpreter
+
+
+def journal_state(interpreter: UnifiedBotInterpreter) -> tuple:
+    return (
+        interpreter.variables['total'],
+        [interpreter.scoped_variables.get('clicks', context(user_id)) for user_id in USERS],
+        interpreter.python_globals.get('seen'),
+    )
+
+
+def expected_state(clicks: int) -> tuple:
+    return clicks, [len(range(user_index, clicks, len(USERS))) for user_index in range(len(USERS))], clicks
+
+
+async def click(interpreter: UnifiedBotInterpreter, start: int, count: int, stop: bool = True):
+    """count нажатий; без stop журнал не закрывается - как при падении процесса"""
+    with quiet():
+        interpreter.build_dispatcher()
+        interpreter.start_state_journal()
+        for k in range(start, start + count):
+            await interpreter.run_pipeline(interpreter.pipelines['plus'], context(USERS[k % len(USERS)]))
+            if k % 7 == 0:
+                await asyncio.sleep(0.03)
+        # Записи сбрасываются раз в state_flush_interval
+        await asyncio.sleep(0.2)
+        if stop:
+            await interpreter.stop_state_journal()
+
+
+def check_journal(workdir: Path):
+    """Восстановление из журнала после падения, снимок, устаревший журнал и оборванная запись"""
+    workdir.mkdir()
+    config_path = workdir / 'journal.yaml'
+    config_path.write_text(JOURNAL_CONFIG, encoding='utf-8')
+    journal_path = workdir / 'state' / 'bot.state.journal'
+
+    # Падение без снимка: всё восстанавливается из журнала
+    asyncio.run(click(journal_bot(config_path), 0, 30, stop=False))
+    interpreter = journal_bot(config_path)
+    expect(journal_state(interpreter), expected_state(30), "восстановление из журнала")
+
+    # Несколько снимков (state_snapshot_every) и остановка
+    asyncio.run(click(interpreter, 30, 100))
+    expect(interpreter.journal.metrics()['snapshots'] > 0, True, "снимок по числу записей")
+    interpreter = journal_bot(config_path)
+    expect(journal_state(interpreter), expected_state(130), "восстановление из снимка")
+
+    # Падение между записью снимка и очисткой журнала: старый журнал не применяется повторно
+    stale = journal_path.read_bytes()
+    asyncio.run(click(interpreter, 130, 10))
+    journal_path.write_bytes(stale + journal_frame(('v', None, 'total', -1)))
+    interpreter = journal_bot(config_path)
+    expect(journal_state(interpreter), expected_state(140), "устаревший журнал")
+
+    # Оборванная последняя запись отбрасывается, предыдущие применяются
+    asyncio.run(click(interpreter, 140, 5, stop=False))
+    with open(journal_path, 'ab') as f:
+        f.write(journal_frame(('v', None, 'total', 999))[:-3])
+    interpreter = journal_bot(config_path)
+    expect(journal_state(interpreter), expected_state(145), "оборванная запись журнала")
+
+
+# ---------------------------------------------------------------------------
+# Текстовые триггеры
+# ---------------------------------------------------------------------------
+
+def check_text_matcher(workdir: Path):
+    """Приоритет: точное совпадение > ключевое слово > регулярное выражение; позиция; порядок конфигурации"""
+    with quiet():
+        matcher = TextMatcher((
+            ('rate', 'regex', r'курс (\w+)'),
+            ('weather', 'keyword', 'погода'),
+            ('hello', 'exact', 'привет'),
+            ('hi', 'keyword', 'привет'),
+            ('news', 'keyword', 'новости'),
+            ('first', 'regex', r'\d+'),
+            ('second', 'regex', r'\d+'),
+            ('flags', 'regex', r'(?s)^start.end'),
+            ('twice', 'regex', r'(\w)\1'),
+        ))
+
+    def handler_of(text: str):
+        found = matcher.match(text)
+        return found[0] if found else None
+
+    expect(handler_of('  Привет '), 'hello', "точное совпадение важнее ключевого слова")
+    expect(handler_of('привет всем'), 'hi', "ключевое слово")
+    expect(handler_of('курс доллара и погода'), 'weather', "ключевое слово важнее регулярного выражения")
+    expect(handler_of('новости и погода'), 'news', "раньше в тексте")
+    expect(handler_of('погодаX'), None, "ключевое слово - только целым словом")
+    expect(handler_of('курс евро'), 'rate', "регулярное выражение")
+    expect(matcher.match('курс евро')[2], 'евро', "группы регулярного выражения")
+    expect(handler_of('номер 42'), 'first', "одинаковая позиция - раньше в конфигурации")
+    expect(handler_of('START\nend'), 'flags', "глобальные флаги в начале выражения")
+    expect(handler_of('zz'), 'twice', "обратная ссылка")
+
+
+# ---------------------------------------------------------------------------
+# Планировщик обновлений
+# ---------------------------------------------------------------------------
+
+async def scheduler_order():
+    scheduler = UpdateScheduler(concurrency=4, max_pending=8)
+    finished = collections.defaultdict(list)
+
+    async def job(chat_id: int, index: int):
+        # Более поздние обновления чата короче: без очереди они обогнали бы ранние
+        await asyncio.sleep(0.002 * (10 - index))
+        finished[chat_id].append(index)
+        return index
+
+    # Больше обновлений, чем max_pending: часть ждёт места в очереди
+    tasks = [asyncio.create_task(scheduler.run(chat_id, lambda chat_id=chat_id, index=index: job(chat_id, index)))
+             for index in range(10) for chat_id in range(3)]
+    results = await asyncio.gather(*tasks)
+    expect(results, [index for index in range(10) for _ in range(3)], "результаты обновлений")
+    for chat_id in range(3):
+        expect(finished[chat_id], list(range(10)), f"порядок обновлений чата {chat_id}")
+
+    # Отменённое обновление не оставляет очередь чата без выполняющего
+    async def cancelled():
+        raise asyncio.CancelledError()
+    await asyncio.gather(scheduler.run(7, cancelled), return_exceptions=True)
+    expect(await scheduler.run(7, lambda: job(7, 0)), 0, "обновление после отмены")
+    expect((scheduler.pending, scheduler.metrics()['chats']), (0, 0), "очереди после выполнения")
+
+
+def check_scheduler(workdir: Path):
+    """Обновления одного чата - строго по очереди, разные чаты - параллельно"""
+    asyncio.run(scheduler_order())
+
+
+# ---------------------------------------------------------------------------
+# Общие переменные в режиме workers
+# ---------------------------------------------------------------------------
+
+async def shared_writeback(address, authkey: bytes):
+    workers = []
+    for _ in range(2):
+        state = connect_shared_state(address, authkey)
+        interpreter = UnifiedBotInterpreter(variable_backend=SharedVariableBackend(state), cache_dir=False)
+        interpreter.bot_config.update(python_executor='thread', python_workers=4, python_timeout=5)
+        interpreter.variables = SharedVariables(state, 'variables')
+        interpreter.python_globals = SharedVariables(state, 'python_globals')
+        with quiet():
+            interpreter.start_python_executor()
+        workers.append(interpreter)
+
+    # Изменения на месте (Counter, список) и чтение-изменение-запись из двух "процессов"
+    code = "import time\nstats['clicks'] += 1\nseen.append(user_id)\ntime.sleep(0.002)\ntotal = total + 1"
+    try:
+        await asyncio.gather(*(
+            workers[k % 2].execute_python_async(code, context(k), 'plus') for k in range(100)
+        ))
+    finally:
+        for interpreter in workers:
+            interpreter.stop_python_executor()
+
+    variables = workers[0].variables.copy()
+    expect(type(variables['stats']).__name__, 'Counter', "тип изменённого на месте значения")
+    expect(variables['stats']['clicks'], 100, "изменения Counter на месте")
+    expect(sorted(variables['seen']), list(range(100)), "изменения списка на месте")
+    expect(variables['total'], 100, "чтение-изменение-запись под блокировкой")
+
+
+def check_shared_variables(workdir: Path):
+    """Python блоки рабочих процессов записывают изменения общих переменных обратно"""
+    authkey = b'selfcheck' * 4
+    manager = SharedStateManager(authkey=authkey)
+    manager.start()
+    try:
+        manager.state().seed({'stats': collections.Counter(), 'seen': [], 'total': 0}, {}, [])
+        asyncio.run(shared_writeback(manager.address, authkey))
+    finally:
+        manager.shutdown()
+
+
+CHECKS = {
+    'journal': check_journal,
+    'matcher': check_text_matcher,
+    'scheduler': check_scheduler,
+    'shared': check_shared_variables,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверки поведения ESYBOT (без сети и токена)")
+    parser.add_argument('checks', nargs='*', help=f"Какие проверки выполнить (по умолчанию все: {', '.join(CHECKS)})")
+    args = parser.parse_args()
+    unknown = set(args.checks) - set(CHECKS)
+    if unknown:
+        parser.error(f"неизвестные проверки: {', '.join(sorted(unknown))}")
+
+    failed = 0
+    with tempfile.TemporaryDirectory(prefix='esybot-check-') as workdir:
+        for name in args.checks or CHECKS:
+            check = CHECKS[name]
+            try:
+                check(Path(workdir) / name)
+            except Exception as e:
+                failed += 1
+                print(f"❌ {name}: {check.__doc__}")
+                print(f"   {e}" if isinstance(e, AssertionError) else traceback.format_exc())
+            else:
+                print(f"✅ {name}: {check.__doc__}")
+
+    if failed:
+        print(f"\n❌ Не пройдено проверок: {failed}")
+        sys.exit(1)
+    print("\n✅ Все проверки пройдены")
+
+
+if __name__ == "__main__":
+    main()